@@ -0,0 +1 @@
+"""Benchmarks for reCBZ, run with 'python -m benchmarks'. Not installed"""
@@ -0,0 +1,225 @@
+"""Run reCBZ against synthetic archives and report throughput and memory use.
+
+    python -m benchmarks --save baseline.json
+    python -m benchmarks --baseline baseline.json --threshold 10%
+
+Each scenario runs recbz in a fresh process, so numbers include startup and
+the worker pool, as a user would see them."""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from zipfile import ZipFile
+
+from benchmarks import fixtures
+
+ROOT = Path(__file__).resolve().parents[1]
+DEFAULT_FIXTURES = Path(tempfile.gettempdir()) / 'reCBZ-bench'
+# runs recbz, then reports the peak RSS of itself and its largest worker
+PROBE = """
+import json, os, resource, runpy, sys
+sys.argv = ['recbz', *sys.argv[1:]]
+try:
+    runpy.run_module('reCBZ', run_name='__main__', alter_sys=True)
+    code = 0
+except SystemExit as err:
+    code = err.code or 0
+try: # ru_maxrss survives exec, so it may be our parent's
+    with open('/proc/self/status') as file:
+        own = int(next(line for line in file if line.startswith('VmHWM')).split()[1])
+except OSError:
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+with open(os.environ['RECBZ_BENCH_RUSAGE'], 'w') as file:
+    json.dump({'code':code, 'own':own, 'workers':workers}, file)
+sys.exit(code)
+"""
+# metric: whether higher is better
+METRICS = {'pages_per_sec':True, 'mb_per_sec':True, 'peak_rss_mb':False,
+           'import_ms':False}
+
+
+def scenarios(books:dict) -> dict:
+    """name: (recbz args, input files)"""
+    results = {}
+    for kind in (*fixtures.KINDS, 'mixed'):
+        results[f'repack-{kind}'] = ([], [books[kind]])
+    results['repack-epub'] = ([], [books['mixed-epub']])
+    results['auto'] = (['--auto'], [books['mixed']])
+    joined = [books['screentone'], books['lineart'], books['color']]
+    results['join'] = (['--join'], joined)
+    results['epub-profile'] = (['--epub', '--profile', 'KOC'], [books['mixed']])
+    return results
+
+
+def _env(workdir:Path) -> dict:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (str(ROOT / 'src'),
+                                                      env.get('PYTHONPATH'))))
+    # keep the user's cache and manifest out of it
+    env['XDG_CACHE_HOME'] = str(workdir / 'cache')
+    env['TMPDIR'] = str(workdir / 'tmp')
+    (workdir / 'tmp').mkdir(exist_ok=True)
+    return env
+
+
+def page_count(path:Path) -> int:
+    exts = ('.jpg', '.jpeg', '.png', '.webp')
+    with ZipFile(path) as archive:
+        return sum(1 for name in archive.namelist() if name.lower().endswith(exts))
+
+
+def run_scenario(args:list, inputs:list, extra:list) -> dict:
+    """Run recbz once, in a scratch directory, return its measurements"""
+    with tempfile.TemporaryDirectory(prefix='reCBZ-bench-') as workdir:
+        workdir = Path(workdir)
+        env = _env(workdir)
+        env['RECBZ_BENCH_RUSAGE'] = str(workdir / 'rusage.json')
+        cmd = [sys.executable, '-c', PROBE, '--silent', '--nomanifest', *extra,
+               *args, *(str(path) for path in inputs)]
+        start_t = time.perf_counter()
+        proc = subprocess.run(cmd, cwd=workdir, env=env, capture_output=True,
+                              text=True)
+        seconds = time.perf_counter() - start_t
+        if proc.returncode != 0:
+            raise RuntimeError(f'recbz exited with {proc.returncode}:\n'
+                               f'{proc.stdout}{proc.stderr}')
+        rusage = json.loads((workdir / 'rusage.json').read_text())
+    pages = sum(page_count(path) for path in inputs)
+    size_mb = sum(path.stat().st_size for path in inputs) / 1024**2
+    return {'pages':pages, 'input_mb':round(size_mb, 2),
+            'seconds':round(seconds, 3),
+            'pages_per_sec':round(pages / seconds, 2),
+            'mb_per_sec':round(size_mb / seconds, 2),
+            # KiB on Linux
+            'peak_rss_mb':round(max(rusage['own'], rusage['workers']) / 1024, 1)}
+
+
+def run_import_time() -> dict:
+    """Time 'recbz --version', which should import little beyond config"""
+    with tempfile.TemporaryDirectory(prefix='reCBZ-bench-') as workdir:
+        cmd = [sys.executable, '-X', 'importtime', '-m', 'reCBZ', '--version']
+        start_t = time.perf_counter()
+        proc = subprocess.run(cmd, cwd=workdir, env=_env(Path(workdir)),
+                              capture_output=True, text=True, check=True)
+        seconds = time.perf_counter() - start_t
+    # top level entries only, nested imports are included in their parent
+    total_us = 0
+    for line in proc.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S.*)$', line)
+        if match:
+            total_us += int(match.group(1))
+    return {'seconds':round(seconds, 3), 'import_ms':round(total_us / 1000, 1)}
+
+
+def best_of(runs:list) -> dict:
+    return min(runs, key=lambda result: result['seconds'])
+
+
+def compare(results:dict, baseline:dict, threshold:float) -> list:
+    """Print results against baseline, return the regressions"""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        for metric, higher_better in METRICS.items():
+            if metric not in result:
+                continue
+            new_val = result[metric]
+            if old is None or not old.get(metric):
+                print(f'  {name:<22} {metric:<14} {new_val:>10}')
+                continue
+            change = (new_val - old[metric]) / old[metric]
+            worse = -change if higher_better else change
+            flag = ''
+            if worse > threshold:
+                flag = '  REGRESSION'
+                regressions.append((name, metric))
+            print(f'  {name:<22} {metric:<14} {new_val:>10} '
+                  f'{old[metric]:>10} {change:>+8.1%}{flag}')
+    return regressions
+
+
+def percentage(value:str) -> float:
+    if value.endswith('%'):
+        return float(value[:-1]) / 100
+    return float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+        description='benchmark recbz against synthetic archives')
+    parser.add_argument('--pages', type=int, default=16,
+        help='pages per fixture archive (default: 16)')
+    parser.add_argument('--scale', type=float, default=1.0,
+        help='fixture page size relative to 1200x1700 (default: 1.0)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fixtures', type=Path, default=DEFAULT_FIXTURES,
+        metavar='DIR', help=f'where to keep fixtures (default: {DEFAULT_FIXTURES})')
+    parser.add_argument('--repeat', type=int, default=1, metavar='N',
+        help='run each scenario N times, keep the fastest')
+    parser.add_argument('--only', metavar='REGEX',
+        help='only run scenarios matching REGEX')
+    parser.add_argument('--save', type=Path, metavar='FILE',
+        help='write results to FILE, for use as a baseline')
+    parser.add_argument('--baseline', type=Path, metavar='FILE',
+        help='compare results to FILE, exit 1 on regressions')
+    parser.add_argument('--threshold', type=percentage, default=0.1,
+        help='allowed regression before failing, e.g. 10%% (default)')
+    parser.add_argument('recbz_args', nargs=argparse.REMAINDER,
+        help='extra arguments for recbz, after --, e.g. -- --process 4')
+    args = parser.parse_args()
+    if args.pages < 10:
+        # --auto samples 5 pages from the middle, in steps of 2
+        parser.error('--pages must be at least 10')
+    extra = [arg for arg in args.recbz_args if arg != '--']
+
+    print(f'[i] Generating fixtures in {args.fixtures}')
+    books = fixtures.generate(args.fixtures, args.pages, args.scale, args.seed)
+    todo = scenarios(books)
+    todo['import'] = None
+    if args.only is not None:
+        todo = {name:val for name, val in todo.items() if re.search(args.only, name)}
+
+    results = {}
+    for name, scenario in todo.items():
+        print(f'[-] {name}', flush=True)
+        if scenario is None:
+            # import time is noisy, always take a few samples
+            runs = [run_import_time() for i in range(max(args.repeat, 5))]
+        else:
+            runs = [run_scenario(*scenario, extra) for i in range(args.repeat)]
+        results[name] = best_of(runs)
+
+    report = {'params':{'pages':args.pages, 'scale':args.scale,
+                        'seed':args.seed, 'recbz_args':extra},
+              'machine':{'python':platform.python_version(),
+                         'platform':platform.platform(),
+                         'cpus':os.cpu_count()},
+              'results':results}
+    regressions = []
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline['params'] != report['params']:
+            print('[!] Baseline was made with different parameters: '
+                  f'{baseline["params"]}')
+        print(f'  {"scenario":<22} {"metric":<14} {"new":>10} '
+              f'{"baseline":>10} {"change":>8}')
+        regressions = compare(results, baseline['results'], args.threshold)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.save is not None:
+        args.save.write_text(json.dumps(report, indent=2) + '\n')
+        print(f'[i] Saved results to {args.save}')
+    if regressions:
+        print(f'[!] {len(regressions)} regressions over {args.threshold:.0%}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""Deterministic synthetic comic archives, generated offline. The same seed
+and parameters always give the same pages, byte for byte"""
+import json
+from io import BytesIO
+from pathlib import Path
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# page width, height at scale 1.0. webtoon strips are much taller
+PAGE_SIZE = (1200, 1700)
+STRIP_SIZE = (800, 6000)
+# fixed timestamp, so archives are reproducible too
+DATE_TIME = (2020, 1, 1, 0, 0, 0)
+
+
+def _panels(draw, width:int, height:int, rng) -> None:
+    # a 2x3 grid with jittered gutters
+    gutter = max(2, min(width, height) // 60)
+    for row in range(3):
+        for col in range(2):
+            x0 = col * width // 2 + int(rng.integers(gutter, gutter * 2))
+            y0 = row * height // 3 + int(rng.integers(gutter, gutter * 2))
+            x1 = (col + 1) * width // 2 - int(rng.integers(gutter, gutter * 2))
+            y1 = (row + 1) * height // 3 - int(rng.integers(gutter, gutter * 2))
+            draw.rectangle((x0, y0, x1, y1), outline=0,
+                           width=max(1, gutter // 4))
+
+
+def screentone(size:tuple, rng) -> Image.Image:
+    """Grayscale page with halftone dots of varying density in each panel"""
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width]
+    pitch = 6
+    tone = np.zeros((height, width), dtype=np.float32)
+    for row in range(3):
+        for col in range(2):
+            density = rng.uniform(0.1, 0.6)
+            cell = (slice(row * height // 3, (row + 1) * height // 3),
+                    slice(col * width // 2, (col + 1) * width // 2))
+            tone[cell] = density
+    dist = np.hypot((x % pitch) - pitch / 2, (y % pitch) - pitch / 2)
+    dots = dist < tone * pitch * 0.7
+    img = Image.fromarray(np.where(dots, 30, 245).astype(np.uint8), 'L')
+    _panels(ImageDraw.Draw(img), width, height, rng)
+    return img
+
+
+def line_art(size:tuple, rng) -> Image.Image:
+    """Black and white page with random strokes and curves"""
+    width, height = size
+    img = Image.new('L', size, 255)
+    draw = ImageDraw.Draw(img)
+    _panels(draw, width, height, rng)
+    for i in range(400):
+        x0, x1 = rng.integers(0, width, 2)
+        y0, y1 = rng.integers(0, height, 2)
+        if i % 3 == 0:
+            box = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+            draw.arc(box, int(rng.integers(0, 360)), int(rng.integers(0, 360)),
+                     fill=0, width=int(rng.integers(1, 4)))
+        else:
+            draw.line((int(x0), int(y0), int(x1), int(y1)), fill=0,
+                      width=int(rng.integers(1, 4)))
+    return img
+
+
+def color(size:tuple, rng) -> Image.Image:
+    """RGB page with smooth gradients, flat fills and a little grain"""
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = []
+    for i in range(3):
+        fx, fy = rng.uniform(0.5, 3, 2)
+        phase = rng.uniform(0, np.pi)
+        wave = np.sin(x / width * fx * np.pi + phase) * np.cos(y / height * fy * np.pi)
+        channels.append(127 + 100 * wave + rng.normal(0, 4, (height, width)))
+    pixels = np.clip(np.stack(channels, axis=-1), 0, 255).astype(np.uint8)
+    img = Image.fromarray(pixels, 'RGB')
+    draw = ImageDraw.Draw(img)
+    for i in range(12):
+        x0, x1 = sorted(rng.integers(0, width, 2))
+        y0, y1 = sorted(rng.integers(0, height, 2))
+        fill = tuple(int(c) for c in rng.integers(0, 256, 3))
+        draw.ellipse((int(x0), int(y0), int(x1), int(y1)), fill=fill)
+    _panels(draw, width, height, rng)
+    return img
+
+
+def webtoon(size:tuple, rng) -> Image.Image:
+    """Tall RGB strip, mostly flat background with colored scenes"""
+    width, height = size
+    img = Image.new('RGB', size, (250, 250, 250))
+    margin = width // 20
+    top = 0
+    while top < height - 64:
+        scene = int(rng.integers(height // 10, height // 5))
+        tile = color((width - margin * 2, min(scene, height - top)), rng)
+        img.paste(tile, (margin, top))
+        top += scene + int(rng.integers(height // 30, height // 10)) # gap
+    return img
+
+
+KINDS = {'screentone':(screentone, PAGE_SIZE),
+         'lineart':(line_art, PAGE_SIZE),
+         'color':(color, PAGE_SIZE),
+         'webtoon':(webtoon, STRIP_SIZE)}
+
+
+def _scaled(size:tuple, scale:float) -> tuple:
+    return tuple(max(16, int(side * scale)) for side in size)
+
+
+def _encode(img:Image.Image, fmt:str) -> bytes:
+    buffer = BytesIO()
+    if fmt == 'jpeg':
+        img.convert('RGB').save(buffer, format='JPEG', quality=92)
+    else:
+        img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def book_pages(kind:str, pages:int, scale:float, seed:int) -> list:
+    """(name, data) for each page of a book of kind. 'mixed' cycles through
+    every kind, at varying sizes and formats"""
+    rng = np.random.default_rng(seed)
+    results = []
+    for i in range(pages):
+        if kind == 'mixed':
+            page_kind = tuple(KINDS)[i % len(KINDS)]
+            page_scale = scale * rng.choice((0.5, 0.75, 1.0, 1.5))
+            fmt = ('jpeg', 'png')[i % 2]
+        else:
+            page_kind, page_scale = kind, scale
+            fmt = 'png' if kind in ('screentone', 'lineart') else 'jpeg'
+        generate, size = KINDS[page_kind]
+        img = generate(_scaled(size, page_scale), rng)
+        ext = 'jpg' if fmt == 'jpeg' else 'png'
+        results.append((f'p{i:03d}.{ext}', _encode(img, fmt)))
+    return results
+
+
+def _writestr(archive:ZipFile, name:str, data, compress:int=ZIP_STORED) -> None:
+    info = ZipInfo(name, date_time=DATE_TIME)
+    info.compress_type = compress
+    archive.writestr(info, data)
+
+
+def write_cbz(path:Path, pages:list) -> None:
+    with ZipFile(path, 'w') as archive:
+        for name, data in pages:
+            _writestr(archive, name, data)
+
+
+def write_epub(path:Path, pages:list, title:str) -> None:
+    """Minimal fixed layout EPUB 3, one image per page"""
+    with ZipFile(path, 'w') as archive:
+        _writestr(archive, 'mimetype', 'application/epub+zip')
+        _writestr(archive, 'META-INF/container.xml',
+                  '<?xml version="1.0"?>\n<container version="1.0" '
+                  'xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                  '<rootfiles><rootfile full-path="OEBPS/content.opf" '
+                  'media-type="application/oebps-package+xml"/></rootfiles>'
+                  '</container>', ZIP_DEFLATED)
+        items, spine = [], []
+        for i, (name, data) in enumerate(pages):
+            mime = 'image/jpeg' if name.endswith('.jpg') else 'image/png'
+            _writestr(archive, f'OEBPS/images/{name}', data)
+            _writestr(archive, f'OEBPS/page{i:03d}.xhtml',
+                      '<?xml version="1.0"?>\n<html xmlns="http://www.w3.org/1999/xhtml">'
+                      f'<head><title>{i}</title></head><body>'
+                      f'<img src="images/{name}" alt=""/></body></html>',
+                      ZIP_DEFLATED)
+            items.append(f'<item id="img{i}" href="images/{name}" media-type="{mime}"/>'
+                         f'<item id="page{i}" href="page{i:03d}.xhtml" '
+                         'media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="page{i}"/>')
+        _writestr(archive, 'OEBPS/content.opf',
+                  '<?xml version="1.0"?>\n<package xmlns="http://www.idpf.org/2007/opf" '
+                  'version="3.0" unique-identifier="uid"><metadata '
+                  'xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                  f'<dc:identifier id="uid">bench-{title}</dc:identifier>'
+                  f'<dc:title>{title}</dc:title><dc:language>en</dc:language>'
+                  '<meta property="rendition:layout">pre-paginated</meta>'
+                  f'</metadata><manifest>{"".join(items)}</manifest>'
+                  f'<spine>{"".join(spine)}</spine></package>', ZIP_DEFLATED)
+
+
+def generate(dest:Path, pages:int=16, scale:float=1.0, seed:int=0) -> dict:
+    """Write one cbz per kind, plus a mixed cbz and epub, to dest. Existing
+    fixtures made with the same parameters are reused. Returns name: path"""
+    dest = Path(dest)
+    dest.mkdir(parents=True, exist_ok=True)
+    params = {'pages':pages, 'scale':scale, 'seed':seed}
+    stamp = dest / 'fixtures.json'
+    books = {kind:dest / f'{kind}.cbz' for kind in (*KINDS, 'mixed')}
+    books['mixed-epub'] = dest / 'mixed-epub.epub'
+    if (stamp.exists() and json.loads(stamp.read_text()) == params
+        and all(path.exists() for path in books.values())):
+        return books
+    for i, kind in enumerate((*KINDS, 'mixed')):
+        pages_data = book_pages(kind, pages, scale, seed + i)
+        write_cbz(books[kind], pages_data)
+        if kind == 'mixed':
+            write_epub(books['mixed-epub'], pages_data, 'mixed')
+    stamp.write_text(json.dumps(params))
+    return books
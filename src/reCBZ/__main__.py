@@ -1,15 +1,20 @@
 import argparse
 import platform
-import zipfile
 import re
 import sys
 import shutil
+import dataclasses
 from pathlib import Path
 
 import reCBZ
 import reCBZ.config as config
-from reCBZ import wrappers, util
+from reCBZ import util
 from reCBZ.profiles import ProfileDict
+# everything else is imported once needed, so --version, --profiles, etc.
+# don't wait for PIL and numpy
+
+# pseudo profile, for outputs without a profile alongside others
+NO_PROFILE = 'NONE'
 
 
 def print_title() -> None:
@@ -41,6 +46,79 @@ def unix_like_glob(arglist:list) -> list:
     return new
 
 
+def clean_global_cache() -> None:
+    g_cache = reCBZ.GLOBAL_CACHEDIR
+    if g_cache.exists():
+        try:
+            util.mylog(f'cleanup(): {g_cache}')
+            shutil.rmtree(g_cache)
+        except PermissionError:
+            util.mylog(f"PermissionError, couldn't clean {g_cache}")
+
+
+def watch_dir(directory:str, mode, records, settings) -> None:
+    """Repack files added to directory until interrupted"""
+    from reCBZ import wrappers, manifest, watch
+    key = manifest.settings_key(mode, settings)
+    written = set()
+    def ignore(path):
+        if path in written:
+            return True
+        if records is None:
+            return manifest.has_comment(path)
+        return records.is_current(path, key)
+    if config.loglevel >= 0:
+        print(f'[i] Watching {directory}, press Ctrl+C to stop')
+    with util.warm_pool():
+        for filename in watch.watch(directory, ignore):
+            if config.verify_inputs and wrappers.verify_archives([filename]):
+                continue # until it's written again
+            try:
+                status, new_fps = wrappers.process_archive(filename, mode,
+                                                           records, settings)
+            except Exception as err: # keep watching
+                print(f'{reCBZ.CMDNAME}: watch: {Path(filename).name}: {err!r}')
+                continue
+            # don't pick up our own output
+            written.update(Path(new_fp).resolve() for new_fp in new_fps)
+            if status == 'skipped' and config.loglevel >= 0:
+                print(f'{reCBZ.CMDNAME}: min-savings: skipped {Path(filename).name}')
+
+
+def queue_dir(directory:str, command, paths:list, mode, settings) -> int:
+    """Add paths to the queue in directory, or with command 'work', convert
+    what's in it until it's drained. Returns an exit code"""
+    from reCBZ import workqueue
+    if command == 'work':
+        if config.loglevel >= 0:
+            print(f'[i] Working on {directory}')
+        done = workqueue.work(directory)
+        if config.loglevel >= 0:
+            print(f'[i] Queue drained, ran {done} tasks')
+        queue = workqueue.WorkQueue(directory)
+        failures = queue.failures()
+        queue.close()
+        [print(f'failed: {Path(source).name}: {error}')
+         for source, error in failures]
+        return 2 if len(failures) > 0 else 0
+    queue = workqueue.WorkQueue(directory)
+    exit_code = 0
+    try:
+        for filename in paths:
+            try:
+                count = queue.enqueue(filename, mode, settings)
+            except ValueError as err:
+                print(f'{reCBZ.CMDNAME}: queue: {err}')
+                exit_code = 1
+                continue
+            if config.loglevel >= 0:
+                chunks = f'in {count} chunks:' if count > 1 else ''
+                print(util.shorten('[i] Queued', chunks, filename))
+    finally:
+        queue.close()
+    return exit_code
+
+
 def main():
     # o god who art in heaven please guard mine anime girls
     mutually_exclusive_groups = []
@@ -48,7 +126,8 @@ def main():
     desc='''accepted formats: .zip, .epub, .cbz. repacks to .cbz by default'''
     parser = argparse.ArgumentParser(
             prog=reCBZ.CMDNAME,
-            usage="%(prog)s [options] files",
+            usage="%(prog)s [options] files\n       %(prog)s [options] serve\n"
+                  "       %(prog)s [options] --queue DIR files|work|status",
             description=desc,
             epilog=f"for detailed documentation, see {wiki}",)
 
@@ -102,20 +181,112 @@ def main():
         dest="mode",
         action="store_const",
         help="calculate size for each image format, pick smallest one")
+    parser.add_argument( "--floor",
+        default=None,
+        metavar="SCORE",
+        dest="quality_floor",
+        type=float,
+        help="lowest quality score (SSIM by default) --auto may accept")
+    parser.add_argument( "--metric",
+        default=None,
+        choices=('ssim', 'psnr'),
+        dest="quality_metric",
+        type=str,
+        help="score formats with ssim or psnr in --compare and --auto")
     parser.add_argument( "-J" ,"--join", # mode_group
         default=None,
         const='join',
         dest="mode",
         action="store_const",
         help="append the contents of each file to the leftmost file")
+    parser.add_argument( "--append", # mode_group
+        default=None,
+        const='append',
+        dest="mode",
+        action="store_const",
+        help="add each file as a new chapter to the leftmost (joined) file")
+    parser.add_argument( "--min-savings",
+        default=None,
+        metavar="RATIO",
+        dest="min_savings",
+        type=util.parse_ratio,
+        help="skip files projected to shrink by less than this, e.g. 10%%")
     parser.add_argument( "--noprev",
         default=False,
         dest="noprev",
         action="store_true",
-        help="ignore previously repacked files")
+        help="ignore files repacked before, or written by reCBZ, with the "
+             "same settings")
+    parser.add_argument( "--watch",
+        default=None,
+        metavar="DIR",
+        dest="watch_dir",
+        type=str,
+        help="keep running, repacking files as they're added to DIR")
+    parser.add_argument( "--port",
+        default=None,
+        metavar="PORT",
+        dest="serve_port",
+        type=int,
+        help="port for 'recbz serve', a local HTTP API for submitting jobs")
+    parser.add_argument( "--manifest",
+        default=None,
+        metavar="FILE",
+        dest="manifest_path",
+        type=str,
+        help="where to record repacked files (default: ~/.cache/reCBZ)")
+    parser.add_argument( "--nomanifest",
+        default=None,
+        const=False,
+        dest="manifest",
+        action="store_const",
+        help="don't record repacked files")
+    parser.add_argument( "--verify",
+        default=None,
+        dest="verify_inputs",
+        action="store_true",
+        help="check inputs for corruption first, skip the broken ones")
+    parser.add_argument( "--metrics",
+        default=None,
+        metavar="FILE",
+        dest="metrics_file",
+        type=str,
+        help="write timings of each stage to FILE, as JSON (or CSV: .csv)")
+    parser.add_argument( "--profile-workers",
+        default=None,
+        metavar="DIR",
+        dest="profile_workers",
+        type=str,
+        help="profile page workers with cProfile, merge results into DIR")
+    parser.add_argument( "--workdir",
+        default=None,
+        metavar="DIR",
+        dest="work_dir",
+        type=str,
+        help="keep converted pages in DIR, so interrupted runs can resume")
+    parser.add_argument( "--cache-dir",
+        default=None,
+        metavar="DIR",
+        dest="cache_dir",
+        type=str,
+        help="unpack and convert books in DIR. 'ram' for a RAM disk (/dev/shm)")
+    parser.add_argument( "--min-free",
+        default=None,
+        metavar="SIZE",
+        dest="cache_min_free",
+        type=str,
+        help="leave SIZE free on the cache's disk, e.g. 2G or 10%%. books "
+             "wait for room before converting")
+    parser.add_argument( "--queue",
+        default=None,
+        metavar="DIR",
+        dest="queue_dir",
+        type=str,
+        help="send files to a queue in DIR, on storage shared by other "
+             "hosts. 'work' converts them, 'status' shows progress")
     log_group = ('verbose', 'silent')
     mutually_exclusive_groups.append(log_group)
-    mode_group = ('compare', 'assist', 'a', 'auto', 'A', 'join', 'J')
+    mode_group = ('compare', 'assist', 'a', 'auto', 'A', 'join', 'J', 'append')
     mutually_exclusive_groups.append(mode_group)
 
     archive_group = parser.add_argument_group(title="archive options")
@@ -126,42 +297,51 @@ def main():
         metavar="",
         dest="profile",
         type=str,
-        help="target eReader profile. run --profiles to see options")
+        help="target eReader profile(s), e.g. KOC,PW5. run --profiles to see options")
     archive_group.add_argument( "--profiles",
         default=False,
         dest="show_profiles",
         action='store_true',
         help=argparse.SUPPRESS)
-    archive_group.add_argument( "--epub", # ext_group
+    archive_group.add_argument( "--epub",
         default=None,
         const='epub',
-        dest="archive_format",
-        action="store_const",
+        dest="archive_formats",
+        action="append_const",
         help="save archive as epub")
-    archive_group.add_argument( "--zip", # ext_group
+    archive_group.add_argument( "--zip",
         default=None,
         const='zip',
-        dest="archive_format",
-        action="store_const",
+        dest="archive_formats",
+        action="append_const",
         help="save archive as zip")
-    archive_group.add_argument( "--cbz", # ext_group
+    archive_group.add_argument( "--cbz",
         default=None,
         const='cbz',
-        dest="archive_format",
-        action="store_const",
+        dest="archive_formats",
+        action="append_const",
         help="save archive as cbz")
     archive_group.add_argument( "--compress",
         default=None,
         dest="compress_zip",
         action="store_true",
         help="attempt to further compress the archive when repacking")
+    archive_group.add_argument( "--target-size",
+        default=None,
+        metavar="SIZE",
+        dest="target_size",
+        type=str,
+        help="lower quality to fit the archive in SIZE, e.g. 80M, or 50%%")
+    archive_group.add_argument( "--dropdupes",
+        default=None,
+        dest="drop_dupes",
+        action="store_true",
+        help="drop duplicate pages from cbz/zip archives")
     archive_group.add_argument( "--rtl",
         default=None,
         dest="right_to_left",
         action="store_true",
         help="sort pages from right to left. only affects epub")
-    ext_group = ('epub', 'zip', 'cbz')
-    mutually_exclusive_groups.append(ext_group)
 
     images_group = parser.add_argument_group(title="image options")
     images_group.add_argument( "-c", "--convert",
@@ -185,6 +365,12 @@ def main():
         dest="img_quality",
         type=int,
         help="save quality for lossy formats. >90 not recommended")
+    images_group.add_argument( "--adaptive",
+        default=None,
+        metavar="MIN-MAX",
+        dest="adaptive_str",
+        type=str,
+        help="pick quality per page from this range, based on detail")
     images_group.add_argument( "--size",
         default=None,
         metavar="WidthxHeight",
@@ -207,6 +393,11 @@ def main():
         dest="blacklisted_fmts",
         action="store_const",
         help="exclude webp from --auto and --assist")
+    images_group.add_argument( "--noguard",
+        default=None,
+        dest="size_guard",
+        action="store_false",
+        help="always use converted pages, even if larger than the source")
     images_group.add_argument( "--bw", # color_group
         default=None,
         dest="grayscale",
@@ -264,7 +455,10 @@ def main():
         group_matches = []
         for arg in sys.argv:
             for mutex_arg in mutex_group:
-                p = re.compile(f'^[-]{{1,2}}{mutex_arg}')
+                if len(mutex_arg) == 1: # short flag, don't match --a...
+                    p = re.compile(f'^-{mutex_arg}$')
+                else:
+                    p = re.compile(f'^[-]{{1,2}}{mutex_arg}')
                 if p.match(arg) and arg not in group_matches:
                     group_matches.append(arg)
         if len(group_matches) >= 2: # only handle one pair at a time
@@ -276,29 +470,69 @@ def main():
         exit(1)
 
     # set profile first, ensure it can be overridden by explicit options
+    prof_names = []
     if args.profile is not None:
-        prof_name = args.profile.upper()
-        try:
-            config.set_profile(prof_name)
-        except ValueError:
-            print(f'{reCBZ.CMDNAME}: profile: invalid option "{prof_name}"')
-            exit(1)
+        prof_names = [name.strip().upper() for name in args.profile.split(',')]
+        for prof_name in prof_names:
+            if prof_name not in ProfileDict and prof_name != NO_PROFILE:
+                print(f'{reCBZ.CMDNAME}: profile: invalid option "{prof_name}"')
+                exit(1)
+        if len(prof_names) == 1 and prof_names[0] != NO_PROFILE:
+            config.set_profile(prof_names[0])
 
+    # explicit options, which targets inherit as well
+    explicit = {}
     if args.size_str is not None:
         newsize = args.size_str.lower().strip()
         try:
             newsize = tuple(map(int,newsize.split('x')))
             assert len(newsize) == 2
             config.img_size = newsize
+            explicit['img_size'] = newsize
         except (ValueError, AssertionError):
             print(f'{reCBZ.CMDNAME}: size: invalid option "{args.size_str}"')
             exit(1)
 
+    if args.adaptive_str is not None:
+        try:
+            adaptive = tuple(map(int, args.adaptive_str.strip().split('-')))
+            assert len(adaptive) == 2
+            assert 0 < adaptive[0] <= adaptive[1] <= 100
+            config.adaptive_quality = adaptive
+        except (ValueError, AssertionError):
+            print(f'{reCBZ.CMDNAME}: adaptive: invalid option "{args.adaptive_str}"')
+            exit(1)
+
     # this is probably not the most pythonic way to do this
     # I'm sorry guido-san...
+    job_options = {field.name for field in dataclasses.fields(config.Settings)}
     for key, val in args.__dict__.items():
         if key in config.__dict__.keys() and val is not None:
             setattr(config, key, val)
+            if key in job_options: # not loglevel, processes, etc.
+                explicit[key] = val
+    if config.quality_floor > 0 and not config.quality_metric:
+        # a floor needs scores
+        config.quality_metric = 'ssim'
+        explicit['quality_metric'] = 'ssim'
+
+    book_formats = args.archive_formats or []
+    if len(prof_names) > 1 or len(book_formats) > 1:
+        # one output for each profile and format. pages are decoded only once
+        for prof_name in prof_names or [NO_PROFILE]:
+            for book_format in book_formats or [None]:
+                if prof_name == NO_PROFILE:
+                    settings = {'ebook_profile':None}
+                else:
+                    settings = config.profile_settings(prof_name)
+                settings.update(explicit)
+                if book_format is not None:
+                    settings['archive_format'] = book_format
+                label = f"{prof_name}-{settings.get('archive_format', config.archive_format)}"
+                if label not in (target[0] for target in config.targets):
+                    config.targets.append((label, settings))
+    elif len(book_formats) == 1:
+        config.archive_format = book_formats[0]
 
     if args.show_config:
         for section in config._cfg.items():
@@ -316,8 +550,68 @@ def main():
         print(f'{reCBZ.CMDNAME} -p ...')
         for prof_key, prof_class in ProfileDict.items():
             print(prof_key, '=', prof_class.desc)
+        print(NO_PROFILE, '=', 'No profile (alongside others, e.g. KOC,NONE)')
+        exit(0)
+
+    cache_root = config.cache_root()
+    if config.cache_dir == 'ram' and cache_root != Path('/dev/shm'):
+        print(f'{reCBZ.CMDNAME}: cache: no RAM disk, using {cache_root}')
+    try:
+        cache_root.mkdir(parents=True, exist_ok=True)
+        if config.cache_min_free:
+            util.parse_size(config.cache_min_free, 1)
+    except (OSError, ValueError) as err:
+        print(f'{reCBZ.CMDNAME}: cache: {err}')
+        exit(1)
+    reCBZ.GLOBAL_CACHEDIR = cache_root / reCBZ.GLOBAL_CACHEDIR.name
+
+    if unknown_args[:1] == ['serve'] and not Path('serve').is_file():
+        if len(unknown_args) > 1 or args.mode is not None:
+            print(f'{reCBZ.CMDNAME}: serve: files and modes are sent as jobs')
+            exit(1)
+        from reCBZ import server
+        try:
+            server.serve(config.serve_host, config.serve_port)
+        except OSError as err:
+            print(f'{reCBZ.CMDNAME}: serve: {err}')
+            exit(1)
+        except KeyboardInterrupt:
+            print('\nGoooooooooodbye')
+        finally:
+            clean_global_cache()
+        exit(0)
+
+    queue_cmd = None
+    if args.queue_dir is not None:
+        if unknown_args[:1] in (['work'], ['status']) and not Path(unknown_args[0]).is_file():
+            queue_cmd = unknown_args.pop(0)
+            if len(unknown_args) > 0 or args.mode is not None:
+                print(f'{reCBZ.CMDNAME}: queue: {queue_cmd}: files and modes are ' +
+                      'given when queueing')
+                exit(1)
+        elif args.mode not in (None, 'auto') or args.watch_dir is not None:
+            print(f'{reCBZ.CMDNAME}: queue: only allowed with --auto or no mode')
+            exit(1)
+        if config.work_dir:
+            print(f'{reCBZ.CMDNAME}: queue: not allowed with --workdir, ' +
+                  'nodes share the one in the queue')
+            exit(1)
+    if queue_cmd == 'status':
+        from reCBZ import workqueue
+        queue = workqueue.WorkQueue(args.queue_dir)
+        counts = queue.counts()
+        for name, table in counts.items():
+            print(f'{name}:'.ljust(7), ', '.join(f'{count} {status}' for
+                                               status, count in table.items())
+                                      or 'none')
+        [print(f'failed: {Path(source).name}: {error}')
+         for source, error in queue.failures()]
+        queue.close()
         exit(0)
 
+    import sqlite3
+    from reCBZ import wrappers, manifest
+
     # parse files
     if platform.system() == 'Windows':
         unknown_args = unix_like_glob(unknown_args)
@@ -334,22 +628,64 @@ def main():
             print(f'\nunknown file or option: {arg}')
             exit(1)
 
-    if len(paths) <= 0:
+    if args.watch_dir is not None:
+        if not Path(args.watch_dir).is_dir():
+            print(f'{reCBZ.CMDNAME}: watch: {args.watch_dir}: not a directory')
+            exit(1)
+        if len(paths) > 0 or args.mode not in (None, 'auto'):
+            print(f'{reCBZ.CMDNAME}: watch: not allowed with input files or ' +
+                  'modes other than --auto')
+            exit(1)
+    elif len(paths) <= 0 and queue_cmd is None:
         print(f'{reCBZ.CMDNAME}: missing input file (see --help)')
         parser.print_usage()
         exit(1)
 
-    if args.mode == 'join':
+    if len(config.targets) > 0:
+        if args.mode is not None or config.target_size or config.min_savings:
+            print(f'{reCBZ.CMDNAME}: several profiles/formats: not allowed with ' +
+                  'other modes, --target-size or --min-savings')
+            exit(1)
+        if config.overwrite:
+            print(f'{reCBZ.CMDNAME}: several profiles/formats: not allowed with --overwrite')
+            exit(1)
+
+    if args.mode in ('join', 'append'):
         if not len(paths) >= 2:
-            print(f'{reCBZ.CMDNAME}: join: at least two files are needed')
+            print(f'{reCBZ.CMDNAME}: {args.mode}: at least two files are needed')
             exit(1)
 
+    if config.target_size:
+        try:
+            util.parse_size(config.target_size, 1)
+        except ValueError:
+            print(f'{reCBZ.CMDNAME}: target-size: invalid option "{config.target_size}"')
+            exit(1)
+        if args.mode not in (None, 'auto'):
+            print(f'{reCBZ.CMDNAME}: target-size: only allowed with --auto or no mode')
+            exit(1)
+
+    if args.noprev and not config.manifest:
+        print(f'{reCBZ.CMDNAME}: noprev: not allowed with --nomanifest')
+        exit(1)
+    records = None
+    if config.manifest and (args.noprev or args.mode in (None, 'auto')):
+        try:
+            # only hash files if something will look them up
+            records = manifest.Manifest(config.manifest_path or None,
+                                        hashing=args.noprev or args.watch_dir is not None)
+        except (sqlite3.Error, OSError) as err:
+            print(f'{reCBZ.CMDNAME}: manifest: {err}, continuing without it')
+    settings = config.current()
+    key = manifest.settings_key(args.mode, settings)
+
     if args.noprev:
-        new = []
-        for filename in paths:
-            comment = zipfile.ZipFile(filename).comment
-            if not comment == str.encode(config.ZIPCOMMENT):
-                new.append(filename)
+        if records is not None:
+            is_current = records.is_current
+        else: # as before the manifest
+            is_current = lambda filename, key: manifest.has_comment(filename)
+        new = [filename for filename in paths
+               if not is_current(filename, key)]
         diff = len(paths) - len(new)
         if diff > 0:
             print(f'{reCBZ.CMDNAME}: noprev: ignoring {diff} files')
@@ -358,40 +694,79 @@ def main():
             else:
                 paths = new
 
+    # before anything starts workers, verify_archives included
+    if config.metrics_file:
+        from reCBZ import metrics
+        metrics.start()
+    if config.profile_workers:
+        from reCBZ import profiling
+        profiling.prepare(config.profile_workers)
+    broken = {}
+    if config.verify_inputs and len(paths) > 0:
+        broken = wrappers.verify_archives(paths)
+        if len(broken) > 0:
+            if args.mode in ('join', 'append') or len(broken) == len(paths):
+                print(f'{reCBZ.CMDNAME}: verify: {len(broken)} broken files, aborting')
+                exit(2)
+            print(f'{reCBZ.CMDNAME}: verify: skipping {len(broken)} broken files')
+            paths = [filename for filename in paths if filename not in broken]
+
     # everything passed. do stuff
-    exit_code = 0
+    if config.work_dir:
+        from reCBZ import journal
+        try:
+            journal.start(config.work_dir)
+        except (sqlite3.Error, OSError) as err:
+            print(f'{reCBZ.CMDNAME}: workdir: {err}')
+            exit(1)
+    exit_code = 2 if len(broken) > 0 else 0
+    skipped = []
     if reCBZ.SHOWTITLE and config.loglevel >= 0: print_title()
     try:
         if args.mode == 'join':
-            wrappers.join_archives(paths[0], paths[1:])
-        for filename in paths:
+            wrappers.join_archives(paths[0], paths[1:], settings)
+        elif args.mode == 'append':
             try:
-                if args.mode is None:
-                    wrappers.repack_archive(filename)
-                elif args.mode == 'unpack':
-                    wrappers.unpack_archive(filename)
-                elif args.mode == 'compare':
-                    wrappers.compare_fmts_archive(filename)
-                elif args.mode == 'assist':
-                    wrappers.assist_repack_archive(filename)
-                elif args.mode == 'auto':
-                    wrappers.auto_repack_archive(filename)
-            except (wrappers.AbortedRepackError, wrappers.AbortedCompareError):
+                wrappers.append_archives(paths[0], paths[1:], settings)
+            except ValueError as err:
+                print(f'{reCBZ.CMDNAME}: append: {err}')
+                exit_code = 1
+        if args.watch_dir is not None:
+            watch_dir(args.watch_dir, args.mode, records, settings)
+        if args.queue_dir is not None:
+            exit_code = max(exit_code, queue_dir(args.queue_dir, queue_cmd, paths,
+                                                 args.mode, settings))
+            paths = [] # converted elsewhere
+        for filename in paths:
+            status, _ = wrappers.process_archive(filename, args.mode, records,
+                                                 settings)
+            if status == 'skipped':
+                skipped.append(filename)
+            elif status == 'aborted':
                 exit_code = 2
-                continue
+        if len(skipped) > 0 and config.loglevel >= 0:
+            print(f'{reCBZ.CMDNAME}: min-savings: skipped {len(skipped)} files')
+            [print(f'skipped: {Path(filename).name}') for filename in skipped]
     except (KeyboardInterrupt, util.MPrunnerInterrupt):
         print('\nGoooooooooodbye')
         exit(1)
     except wrappers.AbortedRepackError:
         exit_code = 2
     finally:
-        g_cache = reCBZ.GLOBAL_CACHEDIR
-        if g_cache.exists():
+        if records is not None:
+            records.close()
+        if config.work_dir:
+            journal.active().close()
+        if config.metrics_file:
             try:
-                util.mylog(f'cleanup(): {g_cache}')
-                shutil.rmtree(g_cache)
-            except PermissionError:
-                util.mylog(f"PermissionError, couldn't clean {g_cache}")
+                metrics.active().write(config.metrics_file)
+            except OSError as err:
+                print(f'{reCBZ.CMDNAME}: metrics: {err}')
+        if config.profile_workers:
+            merged = profiling.merge(config.profile_workers)
+            if merged is not None and config.loglevel >= 0:
+                print(f'[i] Worker profile: {merged}')
+        clean_global_cache()
 
     return exit_code
 
@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import os
 import re
-import time
+import copy
+import mmap
+import zlib
 import shutil
+import struct
+import hashlib
 import tempfile
+from io import BytesIO
 from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED, BadZipFile
 from functools import partial
 from pathlib import Path
@@ -13,8 +19,10 @@ from PIL import Image, UnidentifiedImageError
 
 import reCBZ
 import reCBZ.config as config
+from reCBZ import metrics, journal
 from reCBZ.formats import *
-from reCBZ.util import mylog, map_workers, worker_sigint_CTRL_C, human_sort
+from reCBZ.util import (mylog, map_workers, worker_sigint_CTRL_C, human_sort,
+                        reserve_cache, release_cache)
 
 # TODO:
 # include docstrings
@@ -24,42 +32,106 @@ SOURCE_NAME:str = 'Source'
 chapter_prefix:str = 'v' # :) :D C:
 
 
-def write_zip(savepath, chapters):
+def _zip_page(new_zip, page, settings, parent=None) -> None:
+    rel_path = Path(page.rel_path)
+    if page.dupe_of is not None:
+        if settings.drop_dupes:
+            mylog(f"ZIP: drop '{page.name}', duplicate of '{page.dupe_of.name}'")
+            return
+        # converted once, stored under its own name
+        rel_path = rel_path.with_suffix(page.dupe_of.fp.suffix)
+    if parent is not None:
+        dest = Path(parent) / rel_path
+    else:
+        dest = rel_path
+    source = page.dupe_of if page.dupe_of is not None else page
+    mylog(f"ZIP: write '{source.name}' to {dest}")
+    if settings.compress_zip:
+        new_zip.write(source.fp, dest, ZIP_DEFLATED, 9)
+    else:
+        new_zip.write(source.fp, dest, ZIP_STORED)
+
+
+@metrics.stage('write_zip')
+def write_zip(savepath, chapters, settings, extras=()):
+    """extras are (name, bytes) pairs, written as they are after the pages"""
     new_zip = ZipFile(savepath,'w')
     lead_zeroes = len(str(len(chapters)))
     for i, chapter in enumerate(chapters):
         for page in chapter:
-
             if len(chapters) > 1: # no parent if there's only one chapter
-                dest = Path(f'{chapter_prefix}{i+1:0{lead_zeroes}d}') / page.rel_path
+                _zip_page(new_zip, page, settings,
+                          f'{chapter_prefix}{i+1:0{lead_zeroes}d}')
             else:
-                dest = Path(page.rel_path)
-            mylog(f"ZIP: write '{page.name}' to {dest}")
-            if config.compress_zip:
-                new_zip.write(page.fp, dest, ZIP_DEFLATED, 9)
-            else:
-                new_zip.write(page.fp, dest, ZIP_STORED)
+                _zip_page(new_zip, page, settings)
+    for name, data in extras:
+        mylog(f"ZIP: write '{name}'")
+        new_zip.writestr(name, data, ZIP_DEFLATED, 9)
     new_zip.comment = str.encode(config.ZIPCOMMENT)
     new_zip.close()
     return savepath
 
 
-def write_epub(savepath, chapters):
+def chapter_numbering(savepath) -> tuple:
+    """Number and digits of the last chapter of a zip written by write_zip.
+    Raises ValueError if it has no chapters or wasn't written by reCBZ"""
+    if Path(savepath).suffix[1:] not in ('cbz', 'zip'):
+        raise ValueError(f"'{savepath}': can only append to cbz/zip")
+    pattern = re.compile(f'^{chapter_prefix}(\\d+)/')
+    try:
+        with ZipFile(savepath) as old_zip:
+            comment = old_zip.comment
+            matches = [pattern.match(name) for name in old_zip.namelist()]
+    except BadZipFile:
+        raise ValueError(f"'{savepath}': not a zip file")
+    if comment != str.encode(config.ZIPCOMMENT):
+        raise ValueError(f"'{savepath}': not repacked with reCBZ")
+    numbers = [match.group(1) for match in matches if match is not None]
+    if len(numbers) == 0:
+        raise ValueError(f"'{savepath}': not a joined volume (no chapters)")
+    last = max(int(number) for number in numbers)
+    lead_zeroes = max(len(number) for number in numbers)
+    return last, lead_zeroes
+
+
+@metrics.stage('write_zip')
+def append_zip(savepath, chapters, settings):
+    """Add chapters to a zip written by write_zip, after its last chapter.
+    Existing files are left untouched, only the central directory is
+    rewritten"""
+    last, lead_zeroes = chapter_numbering(savepath)
+    new_zip = ZipFile(savepath, 'a')
+    for i, chapter in enumerate(chapters, start=last+1):
+        for page in chapter:
+            _zip_page(new_zip, page, settings,
+                      f'{chapter_prefix}{i:0{lead_zeroes}d}')
+    new_zip.comment = str.encode(config.ZIPCOMMENT)
+    new_zip.close()
+    return savepath
+
+
+@metrics.stage('write_epub')
+def write_epub(savepath, chapters, settings, title:str=None):
+    """savepath is a path or a writable binary file. title defaults to the
+    name of the path"""
     from reCBZ import epub
     pages = list(chain(*chapters))
-    title = Path(savepath).stem
+    if title is None:
+        title = Path(savepath).stem
+    if not hasattr(savepath, 'write') and settings.ebook_profile is not None:
+        savepath = f'{Path(savepath).with_suffix("")}{settings.ebook_profile.epub_ext}'
     mylog(f'Write .epub: {title}.epub', progress=True)
     if len(chapters) > 1:
-        savepath = epub.multi_chapter_epub(title, chapters)
+        savepath = epub.multi_chapter_epub(title, chapters, settings, savepath)
     else:
-        savepath = epub.single_chapter_epub(title, pages)
+        savepath = epub.single_chapter_epub(title, pages, settings, savepath)
 
     # if Config.compress_zip:
     #     ZipFile(savepath, mode='w', compression=ZIP_DEFLATED, compresslevel=9).write(savepath)
     return savepath
 
 
-def write_mobi(savepath, chapters):
+def write_mobi(savepath, chapters, settings):
     import subprocess
     try:
         subprocess.run(["kindlegen", "", "/dev/null"], capture_output=True)
@@ -68,6 +140,91 @@ def write_mobi(savepath, chapters):
     pass
 
 
+def _open_source(source):
+    """Random access to source, bytes or a binary file object. Unseekable
+    files (e.g. pipes) are read into memory"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return BytesIO(source)
+    try:
+        seekable = source.seekable()
+    except AttributeError:
+        seekable = False
+    if seekable:
+        return source
+    return BytesIO(source.read())
+
+
+def index_members(source_zip, epub:bool=False) -> dict:
+    """Sort the members of source_zip by what's done with them: 'image' are
+    converted, 'meta' are kept as they are, 'epub' are rebuilt when writing
+    (only in epubs), and 'other' can't be converted. Names decide the last
+    three, the first bytes of each member whether it's an image, so nothing
+    else has to be extracted or sent to workers"""
+    members = {'image':[], 'meta':[], 'epub':[], 'other':[]}
+    for info in source_zip.infolist():
+        if info.is_dir():
+            continue
+        if reCBZ.META_FILES.match(info.filename):
+            kind = 'meta'
+        elif epub and reCBZ.EPUB_FILES.match(info.filename):
+            kind = 'epub'
+        else:
+            with source_zip.open(info) as file:
+                header = file.read(HEADER_SIZE)
+            kind = 'image' if is_image(header) else 'other'
+        members[kind].append(info)
+    return members
+
+
+def read_member(path:str, info) -> bytes:
+    """Read and decompress info, a member of the zip at path, straight from
+    its offset in a memory map of the file, without reading the central
+    directory again. Raises IOError if it's corrupt"""
+    if info.flag_bits & 0x1 or info.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+        # encrypted, bzip2, lzma: rare enough to leave to zipfile
+        with ZipFile(path) as source_zip:
+            try:
+                return source_zip.read(info)
+            except (BadZipFile, RuntimeError, NotImplementedError) as err:
+                raise IOError(f"'{info.filename}': {err}")
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            header = view[info.header_offset:info.header_offset + 30]
+            if len(header) < 30 or header[:4] != b'PK\x03\x04':
+                raise IOError(f"'{info.filename}': bad local file header")
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            start = info.header_offset + 30 + name_len + extra_len
+            data = view[start:start + info.compress_size]
+    try:
+        if info.compress_type == ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+    except zlib.error as err:
+        raise IOError(f"'{info.filename}': {err}")
+    if zlib.crc32(data) != info.CRC:
+        raise IOError(f"'{info.filename}': bad CRC-32")
+    return data
+
+
+_WINDOWS_ILLEGAL = str.maketrans(':<>|"?*', '_' * 7)
+
+
+def _member_path(dest_dir:Path, info) -> Path:
+    # where ZipFile.extract would put it
+    arcname = info.filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    arcname = os.path.sep.join(part for part in arcname.split(os.path.sep)
+                               if part not in ('', os.path.curdir, os.path.pardir))
+    if os.path.sep == '\\':
+        # characters windows doesn't allow, and trailing dots
+        arcname = arcname.translate(_WINDOWS_ILLEGAL)
+        arcname = os.path.sep.join(part.rstrip('.') for part
+                                   in arcname.split(os.path.sep)
+                                   if part.rstrip('.'))
+    return dest_dir / arcname
+
+
 def get_format_class(name):
     if name in (None, ''): return None
     else:
@@ -77,31 +234,36 @@ def get_format_class(name):
             raise ValueError(f"Invalid format name '{name}'")
 
 
-@worker_sigint_CTRL_C
-def convert_page_worker(source, options, savedir=None):
-    start_t = time.perf_counter()
-    # page = copy.deepcopy(source)
-    page = Page(source.fp) # create a copy
-
+def _open_page(page, ignore_err:bool, laps) -> tuple:
+    """Returns the format and decoded image of page, or None if it can't be
+    opened and ignore_err is set"""
     # ensure file can be opened as image, and that it's a valid format
     try:
-        mylog(f'Read file: {page.name}', progress=True)
-        log_buff = f'/open:  {page.fp}\n'
-        source_fmt = page.fmt
-        img = page.img
+        fmt, img = page.fmt, page.img
+        laps.lap('open')
+        img.load() # truncated or corrupt pages only fail here
+        laps.lap('decode')
+        return fmt, img
     except (IOError, UnidentifiedImageError) as err:
-        if config.ignore_page_err:
+        if ignore_err:
             mylog(f"{page.fp}: can't open file as image, ignoring...'")
-            return False, page
+            return None
         else:
             raise err
     except KeyError as err:
-        if config.ignore_page_err:
+        if ignore_err:
             mylog(f"{page.fp}: invalid image format, ignoring...'")
-            return False, page
+            return None
         else:
             raise err
 
+
+def _convert_img(source, page, source_fmt, img, options, new_dir, log_buff,
+                 laps) -> tuple:
+    source_size = source.file_size
+    transformed = False
+    page.img = img
+
     # determine target (new) format
     if options['format']:
         new_fmt = options['format']
@@ -119,6 +281,7 @@ def convert_page_worker(source, options, savedir=None):
     if options['grayscale']:
         log_buff += '|trans: mode L\n' # me lol
         img = img.convert('L')
+        transformed = True
 
     if all(options['size']):
         log_buff += f'|trans: resize to {options["size"]}\n'
@@ -132,46 +295,247 @@ def convert_page_worker(source, options, savedir=None):
         if (width > n_width and height > n_height
             and not options['nodown']):
             img = img.resize((new_size), config.RESAMPLE_TYPE)
+            transformed = True
         # upscaling
         elif not options['noup']:
             img = img.resize((new_size), config.RESAMPLE_TYPE)
+            transformed = True
 
-    LossyFmt.quality = options['quality']
+    if options['scale'] != 1.0:
+        width, height = img.size
+        new_size = (max(1, round(width * options['scale'])),
+                    max(1, round(height * options['scale'])))
+        log_buff += f'|trans: scale to {new_size}\n'
+        img = img.resize(new_size, config.RESAMPLE_TYPE)
+        transformed = True
+
+    quality = options['quality']
+    if all(options['adaptive']) and not new_fmt.lossless:
+        from reCBZ.similarity import complexity # numpy is slow to import
+        low, high = options['adaptive']
+        detail = complexity(img)
+        quality = round(low + (high - low) * detail)
+        log_buff += f'|trans: complexity {detail:.2f}, quality {quality}\n'
 
     # save
+    laps.lap('transform')
     page.img = img
     ext = page.fmt.ext[0]
-    if savedir:
-        new_fp = Path.joinpath(savedir, f'{page.stem}{ext}')
-    else:
-        new_fp = Path.joinpath(page.fp.parents[0], f'{page.stem}{ext}')
+    new_fp = Path.joinpath(new_dir, f'{page.stem}{ext}')
     log_buff += f'|trans: {source_fmt.name} -> {new_fmt.name}\n'
-    page.save(new_fp)
+    data = page.encode(quality)
+    laps.lap('encode')
+    # for --metrics
+    stats = {'page':source.name, 'timings':laps.timings,
+             'fmt_in':source_fmt.name, 'bytes_in':source_size}
+
+    # size guard: if the source is already smaller (or close enough), keep it.
+    # only when the pixels are unchanged, a resized or desaturated page isn't
+    # interchangeable with the original
+    guard = options['size_guard']
+    if (guard is not None and not transformed
+        and source_fmt in options['allowed_fmts']
+        and len(data) >= source_size * (1 - guard)):
+        page.close()
+        kept = Page(source.fp, source.member)
+        kept.materialize()
+        elapsed = f'{sum(laps.timings.values()):.2f}s'
+        mylog(f'{log_buff}\\keep: {source.fp}: {len(data)} >= ' +
+              f'{source_size} bytes: took {elapsed}')
+        return True, kept, {'kept':True, **stats,
+                                       'fmt_out':source_fmt.name,
+                                       'bytes_out':source_size}
 
-    end_t = time.perf_counter()
-    elapsed = f'{end_t-start_t:.2f}s'
+    info = {'kept':False, **stats, 'fmt_out':new_fmt.name,
+            'bytes_out':len(data)}
+    if options['metric'] is not None:
+        from reCBZ.similarity import MetricDict
+        # compare with the transformed source, so resizing isn't penalized
+        with Image.open(BytesIO(data)) as encoded:
+            info['metric'] = MetricDict[options['metric']](img, encoded)
+        log_buff += f"|trans: {options['metric']} {info['metric']:.4f}\n"
+        laps.lap('metric')
+    page.save(new_fp, data)
+    laps.lap('save')
+
+    elapsed = f'{sum(laps.timings.values()):.2f}s'
     mylog(f'{log_buff}\\write: {new_fp}: took {elapsed}')
-    mylog(f'Save file: {new_fp.name}', progress=True)
-    return True, page
+    return True, page, info
+
+
+@worker_sigint_CTRL_C
+def convert_page_worker(source, options, savedir=None):
+    laps = metrics.Laps()
+    # page = copy.deepcopy(source)
+    page = Page(source.fp, source.member) # create a copy
+    log_buff = f'/open:  {page.fp}\n'
+    opened = _open_page(page, options['ignore_err'], laps)
+    if opened is None:
+        return False, page, {}
+    source_fmt, img = opened
+    if savedir:
+        new_dir = savedir
+    else:
+        new_dir = page.fp.parents[0]
+        new_dir.mkdir(parents=True, exist_ok=True) # unless it was extracted
+    result = _convert_img(source, page, source_fmt, img, options, new_dir,
+                          log_buff, laps)
+    # extracted pages aren't needed once converted, free the cache early.
+    # samples (savedir) are converted again afterwards
+    if savedir is None and result[0] and result[1].fp != source.fp:
+        _remove_extracted(source)
+    return result
+
+
+def _remove_extracted(source) -> None:
+    if source.member is None:
+        mylog(f'remove: {source.fp}')
+        source.fp.unlink(missing_ok=True)
+
+
+def _saved_bytes(result) -> int:
+    """Bytes saved by a page worker, for progress"""
+    if not isinstance(result, tuple): # interrupted
+        return 0
+    if len(result) > 0 and isinstance(result[0], tuple): # fanout_page_worker
+        return sum(_saved_bytes(item) for item in result)
+    info = result[2]
+    return info.get('bytes_in', 0) - info.get('bytes_out', 0)
+
+
+def target_dir(page, label:str) -> Path:
+    """Where converted copies of page are saved for the target named label.
+    A sibling of the page's book directory, so relative paths are preserved"""
+    return page.local_cache.with_name(f'{page.local_cache.name}_{label}')
+
+
+@worker_sigint_CTRL_C
+def fanout_page_worker(source, targets:tuple) -> tuple:
+    """Decode the page once, then convert it for each of targets, a tuple of
+    (label, options) pairs. Returns one result per target"""
+    laps = metrics.Laps()
+    decoded = Page(source.fp, source.member)
+    # every target shares the page, and so its error handling
+    opened = _open_page(decoded, all(options['ignore_err'] for label, options
+                                     in targets), laps)
+    if opened is None:
+        return tuple((False, decoded, {}) for target in targets)
+    source_fmt, img = opened
+
+    results = []
+    for label, options in targets:
+        if len(results) > 0: # decoding is counted once, with the first
+            laps = metrics.Laps()
+        page = Page(source.fp, source.member)
+        page.fmt = source_fmt
+        new_dir = target_dir(page, label) / page.rel_path.parent
+        new_dir.mkdir(parents=True, exist_ok=True)
+        log_buff = f'/open:  {page.fp} ({label})\n'
+        # copy, as transforms which don't apply return the same image
+        results.append(_convert_img(source, page, source_fmt, img.copy(),
+                                    options, new_dir, log_buff, laps))
+    decoded.close()
+    if all(result[0] and not result[2].get('kept') for result in results):
+        _remove_extracted(source)
+    return tuple(results)
+
+
+@worker_sigint_CTRL_C
+def hash_page_worker(page, perceptual=False) -> tuple:
+    try:
+        data = page.read()
+    except IOError: # corrupt, it'll fail to convert as well
+        return hashlib.blake2b(page.name.encode()).digest(), None
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    phash = None
+    if perceptual:
+        from reCBZ.similarity import dhash
+        try:
+            with Image.open(BytesIO(data)) as img:
+                phash = dhash(img)
+        except (IOError, UnidentifiedImageError):
+            pass
+    return digest, phash
+
+
+def _dupe_key(page) -> tuple:
+    if page.member is not None:
+        info = page.member[1]
+        return info.file_size, info.CRC
+    return page.file_size, None
+
+
+def verify_image(data:bytes):
+    """What's wrong with data, an image, going by its headers and structure,
+    without decoding its pixels. None if nothing"""
+    try:
+        with Image.open(BytesIO(data)) as img:
+            fmt = img.format
+            img.verify() # e.g. PNG chunk CRCs, up to IEND
+    except Exception as err: # PIL raises just about anything
+        return str(err) or type(err).__name__
+    # FFD9 may turn up earlier, e.g. in a comment or EXIF thumbnail
+    if fmt == 'JPEG' and not data.rstrip(b'\x00\xff').endswith(b'\xff\xd9'):
+        return 'truncated (no end of image marker)'
+    return None
+
+
+@worker_sigint_CTRL_C
+def verify_archive_worker(path) -> list:
+    """Check the zip structure of path, the CRC of every member, and the
+    headers of its images. Returns what's wrong as (member, problem) pairs"""
+    try:
+        with ZipFile(path) as source_zip:
+            infos = [info for info in source_zip.infolist() if not info.is_dir()]
+    except (BadZipFile, OSError, EOFError) as err:
+        return [('', str(err))]
+    problems = []
+    for info in infos:
+        try:
+            data = read_member(str(path), info)
+        except IOError as err:
+            problems.append((info.filename, str(err).split(': ', 1)[-1]))
+            continue
+        if is_image(data[:HEADER_SIZE]):
+            problem = verify_image(data)
+            if problem is not None:
+                problems.append((info.filename, problem))
+        elif Path(info.filename).suffix.lower() in ('.png', '.jpg', '.jpeg', '.webp'):
+            problems.append((info.filename, 'not a PNG, JPEG or WebP image'))
+    if len(problems) == 0 and len(infos) == 0:
+        problems.append(('', 'no files in archive'))
+    return problems
 
 
 class Page():
-    def __init__(self, file_name):
+    def __init__(self, file_name, member:tuple=None):
+        """member is the (zip path, ZipInfo) a page which wasn't extracted
+        is read from, file_name where it would have been extracted to"""
         self.fp = Path(file_name)
+        self.member = member
         # i tried for hours but windows can't correctly pickle the
         # GLOBAL_CACHEDIR, it's not thread safe for whatever reason. some
         # instances will init with a new UUID which can't be compared.
-        # this is the least hacky way I could come up with to keep Unix parity
-        uuid_part = [part for part in self.fp.parts if reCBZ.CACHE_PREFIX in part]
-        global_cache = Path(tempfile.gettempdir()) / uuid_part[0]
-        local_cache = global_cache / self.fp.relative_to(global_cache).parts[0]
-        self.rel_path = self.fp.relative_to(local_cache)
-        self.name = str(self.fp.name)
-        self.stem = str(self.fp.stem)
+        # so the cache dirs are found in the page's own path instead
+        self._locate()
         self._img:Image.Image
         self._fmt = None
+        # first bytes of a page read from its member, see fmt
+        self._header = None
+        # set on duplicates, which reuse the converted original
+        self.dupe_of = None
         self._closed = True
 
+    def _locate(self):
+        # the cache may be anywhere, see config.cache_dir
+        parts = self.fp.parts
+        depth = next(i for i, part in enumerate(parts) if reCBZ.CACHE_PREFIX in part)
+        global_cache = Path(*parts[:depth + 1])
+        self.local_cache = global_cache / self.fp.relative_to(global_cache).parts[0]
+        self.rel_path = self.fp.relative_to(self.local_cache)
+        self.name = str(self.fp.name)
+        self.stem = str(self.fp.stem)
+
     @property
     def fmt(self):
         if self._fmt is not None:
@@ -186,11 +550,15 @@ class Page():
                 return Jpeg
             elif PIL_fmt == "WEBP":
                 # https://github.com/python-pillow/Pillow/discussions/6716
-                with open(self.fp, "rb") as file:
-                    if file.read(16)[-1:] == b"L":
-                        return WebpLossless
-                    else:
-                        return WebpLossy
+                if self._header is not None: # read along with img
+                    header = self._header
+                else:
+                    with open(self.fp, "rb") as file:
+                        header = file.read(16)
+                if header[-1:] == b"L":
+                    return WebpLossless
+                else:
+                    return WebpLossy
             else:
                 raise KeyError(f"'{PIL_fmt}': invalid format")
 
@@ -201,7 +569,12 @@ class Page():
     @property
     def img(self):
         if self._closed:
-            self._img = Image.open(self.fp)
+            if self.member is not None:
+                data = self.read()
+                self._header = data[:16]
+                self._img = Image.open(BytesIO(data))
+            else:
+                self._img = Image.open(self.fp)
             self._closed = False
             return self._img
         else:
@@ -216,6 +589,33 @@ class Page():
     def size(self):
         return self.img.size
 
+    @property
+    def file_size(self) -> int:
+        if self.member is not None:
+            return self.member[1].file_size
+        return self.fp.stat().st_size
+
+    def read(self) -> bytes:
+        if self.member is not None:
+            return read_member(*self.member)
+        return self.fp.read_bytes()
+
+    def fingerprint(self) -> bytes:
+        """What identifies the page's contents. For pages in a zip, its
+        member's name, size and CRC, so the member isn't read"""
+        if self.member is not None:
+            info = self.member[1]
+            return f'{info.filename}\0{info.file_size}\0{info.CRC}'.encode()
+        return self.read()
+
+    def materialize(self) -> None:
+        """Write a page which wasn't extracted to fp, for what needs a file"""
+        if self.member is None:
+            return
+        self.fp.parent.mkdir(parents=True, exist_ok=True)
+        self.fp.write_bytes(self.read())
+        self.member = None
+
     @property
     def landscape(self):
         if self.size[0] > self.size[1]:
@@ -223,43 +623,101 @@ class Page():
         else:
             return False
 
-    def save(self, dest):
-        self.fmt.save(self.img, dest)
+    def encode(self, quality:int=None) -> bytes:
+        buffer = BytesIO()
+        self.fmt.save(self.img, buffer, quality)
+        return buffer.getvalue()
+
+    def save(self, dest, data:bytes=None):
+        if data is None:
+            data = self.encode()
+        with open(dest, 'wb') as file:
+            file.write(data)
         self.fp = Path(dest)
-        self.name = str(self.fp.name)
-        self.stem = str(self.fp.stem)
-        self._img.close()
-        self._closed = True
+        self.member = None
+        self._locate()
+        self.close()
+
+    def close(self):
+        if not self._closed:
+            self._img.close()
+            self._closed = True
 
     def __reduce__(self):
         # pickle pee. pum pa rum
         # https://stackoverflow.com/q/19855156/
-        return (self.__class__, (self.fp, ))
+        return (self.__class__, (self.fp, self.member))
+
+
+def page_options(settings) -> dict:
+    """Options for convert_page_worker, from settings"""
+    options = {}
+    options['format'] = get_format_class(settings.img_format)
+    options['quality'] = settings.img_quality
+    options['adaptive'] = settings.adaptive_quality
+    options['size'] = settings.img_size
+    options['grayscale'] = settings.grayscale
+    options['noup'] = settings.no_upscale
+    options['nodown'] = settings.no_downscale
+    options['scale'] = 1.0
+    options['metric'] = None
+    if settings.size_guard:
+        options['size_guard'] = settings.size_guard_threshold
+    else:
+        options['size_guard'] = None
+    options['allowed_fmts'] = settings.allowed_page_formats()
+    options['ignore_err'] = settings.ignore_page_err
+    return options
 
 
 class ComicArchive():
-    def __init__(self, filename:str):
+    def __init__(self, filename, settings=None, name:str=None):
+        """filename is a path, bytes, or a binary file object. name is used
+        in place of its path when it's not a file on disk (defaults to the
+        file object's name). settings defaults to config.current()"""
         mylog('Archive: __init__')
-        if Path(filename).exists():
-            self.fp:Path = Path(filename)
+        if isinstance(filename, (str, Path)):
+            if not Path(filename).exists():
+                raise ValueError(f"{filename}: invalid path")
+            self._source = Path(filename)
+            name = filename
         else:
-            raise ValueError(f"{filename}: invalid path")
-        self._page_opt = {}
-        self._page_opt['format'] = get_format_class(config.img_format)
-        self._page_opt['quality'] = config.img_quality
-        self._page_opt['size'] = config.img_size
-        self._page_opt['grayscale'] = config.grayscale
-        self._page_opt['noup'] = config.no_upscale
-        self._page_opt['nodown'] = config.no_downscale
+            self._source = _open_source(filename)
+            if name is None:
+                name = getattr(filename, 'name', None)
+            if not isinstance(name, (str, Path)):
+                name = 'book.cbz'
+        self.fp:Path = Path(name)
+        if settings is None:
+            settings = config.current()
+        self.settings = settings
+        self._page_opt = page_options(settings)
         self._index:list = []
         self._chapter_lengths = []
         self._chapters = []
         self._bad_files = []
+        self._skipped_files = []
+        self._dupe_files = []
+        self._members = None
+        self._other_files = []
+        self._meta_files = []
+        self._claim = None
+        reCBZ.GLOBAL_CACHEDIR.mkdir(exist_ok=True)
         self._cachedir = Path(tempfile.mkdtemp(prefix='book_', dir=reCBZ.GLOBAL_CACHEDIR))
 
     @property
     def bad_files(self):
-        return self._bad_files
+        # including members which were never extracted, see index_members
+        return self._other_files + self._bad_files
+
+    @property
+    def skipped_files(self):
+        # pages where the source was kept, as converting didn't save space
+        return self._skipped_files
+
+    @property
+    def dupe_files(self):
+        return self._dupe_files
 
     def fetch_pages(self):
         if len(self._index) == 0:
@@ -277,32 +735,70 @@ class ComicArchive():
             del index_copy[:length]
         return chapters
 
-    def extract(self, count:int=0, raw:bool=False) -> tuple:
+    def _index_members(self, source_zip) -> dict:
+        if self._members is None:
+            self._members = index_members(source_zip, self.fp.suffix == '.epub')
+            self._other_files = [self._cachedir / info.filename
+                                 for info in self._members['other']]
+            # read now, the source is gone by the time it's written over
+            self._meta_files = [(info.filename, source_zip.read(info))
+                                for info in self._members['meta']]
+            mylog(f'index: {self.fp}: ' + ', '.join(
+                f'{len(infos)} {kind}' for kind, infos in self._members.items()))
+        return self._members
+
+    @metrics.stage('extract')
+    def extract(self, count:int=0, raw:bool=False, spread:bool=False) -> tuple:
         try:
-            source_zip = ZipFile(self.fp)
+            source_zip = ZipFile(self._source)
         except BadZipFile as err:
             raise ValueError(f"Fatal: '{self.fp}': not a zip file")
 
-        compressed_files = source_zip.namelist()
-        assert len(compressed_files) >= 1, 'no files in archive'
-        if count > 0:
+        compressed_files = self._index_members(source_zip)['image']
+        assert len(compressed_files) >= 1, 'no images in archive'
+        if count > 0 and spread:
+            # select x images spread evenly across the archive, so the sample
+            # is representative of the whole book (covers, color inserts, etc)
+            if count > len(compressed_files):
+                raise ValueError(f"{self.fp} is smaller than samples")
+            step = len(compressed_files) / count
+            compressed_files = [compressed_files[int(step * i + step / 2)]
+                                for i in range(count)]
+        elif count > 0:
             # select x images from the middle of the archive, in increments of 2
             if count * 2 > len(compressed_files):
                 raise ValueError(f"{self.fp} is smaller than samples * 2")
             delta = int(len(compressed_files) / 2)
             compressed_files = compressed_files[delta-count:delta+count:2]
+        elif self._claim is None:
+            # room for a converted copy per output, and the extracted pages
+            nbytes = sum(info.file_size for info in compressed_files)
+            copies = max(1, len(self.settings.targets))
+            if not isinstance(self._source, Path):
+                copies += 1
+            with metrics.stage('cache_wait'):
+                self._claim = reserve_cache(self._cachedir, nbytes * copies)
 
-        mylog(f'Extracting: {self.fp}', progress=True)
-        for file in compressed_files:
-            source_zip.extract(file, self._cachedir)
+        if isinstance(self._source, Path):
+            # workers read their own pages from the source, see read_member.
+            # a later member with the same name wins, as it would extracting
+            source = str(self._source.resolve())
+            members = {str(_member_path(self._cachedir, info)):(source, info)
+                       for info in compressed_files}
+        else: # not a file, extract it
+            mylog(f'Extracting: {self.fp}', progress=True)
+            for file in compressed_files:
+                source_zip.extract(file, self._cachedir)
+            # god bless you Georgy https://stackoverflow.com/a/50927977/
+            members = {str(path):None for path
+                       in filter(Path.is_file, Path(self._cachedir).rglob('*'))}
+        source_zip.close()
 
-        # god bless you Georgy https://stackoverflow.com/a/50927977/
-        raw_paths = tuple(filter(Path.is_file, Path(self._cachedir).rglob('*')))
         # solves the need to invert files in EPUB, where the destination can't
         # be inferred from the original filepath. critical, because files are
         # randomly ordered on Windows (probably due to the ZLIB implementation)
-        sorted_paths = tuple(human_sort(raw_paths))
-        sorted_pages = tuple(Page(path) for path in sorted_paths)
+        sorted_paths = tuple(human_sort(list(members)))
+        sorted_pages = tuple(Page(path, members[path]) for path in sorted_paths)
 
         mylog('', progress=True)
         if raw: return sorted_paths
@@ -335,51 +831,214 @@ class ComicArchive():
         self._index.extend(new_chapter)
         return tuple(self.fetch_pages())
 
-    def convert_pages(self, fmt=None, quality=None, grayscale=None, size=None) -> tuple:
+    def convert_pages(self, fmt=None, quality=None, grayscale=None, size=None,
+                      scale=None, adaptive=None, span:tuple=None) -> tuple:
+        """Convert every page, or with span, a (start, stop) slice of them
+        only, into the journal. The latter converts a chunk of the book for
+        whichever node assembles it, see workqueue"""
         # TODO assert values are the right type
         options = dict(self._page_opt)
         if fmt is not None: options['format'] = get_format_class(fmt)
         if quality is not None: options['quality'] = int(quality)
+        if adaptive is not None: options['adaptive'] = adaptive
         if grayscale is not None: options['grayscale'] = bool(grayscale)
         if size is not None: options['size'] = size
+        if scale is not None: options['scale'] = float(scale)
 
+        pages = self.fetch_pages()
+        if span is not None:
+            # dupes are left to the assembler, which sees the whole book
+            pages = pages[slice(*span)]
+            dupes = {}
+        else:
+            dupes = self.find_dupes() if self.settings.dedupe else {}
+        unique_pages = [page for i, page in enumerate(pages) if i not in dupes]
         worker = partial(convert_page_worker, options=options)
-        results = map_workers(worker, self.fetch_pages())
-
-        self._bad_files = [item[1].fp for item in results if item[0] is False]
-        self._index = [item[1] for item in results if item[0]]
+        results, todo, record = self._resume(unique_pages, options)
+        with metrics.stage('convert'):
+            converted = map_workers(worker, [unique_pages[i] for i in todo],
+                                    saved=_saved_bytes, each=record,
+                                    progress=f'Converting {self.fp.name}')
+        metrics.record_pages('convert', self.fp.name, converted)
+        for i, result in zip(todo, converted):
+            results[i] = result
+        if span is not None:
+            mylog('', progress=True)
+            return tuple(result[1] for result in results
+                         if isinstance(result, tuple) and result[0])
+        self._assemble(pages, dupes, results)
         mylog('', progress=True)
         return tuple(self._index)
 
-    def compute_fmt_sizes(self) -> tuple:
-        def compute_single_fmt(sample_pages, cachedir, fmt) -> tuple:
-            fmtdir = Path.joinpath(cachedir, fmt.name)
-            Path.mkdir(fmtdir)
+    def _resume(self, pages, options) -> tuple:
+        """Results of pages converted by a previous run, from the journal
+        (see --workdir), the indexes of pages left to convert, and a callback
+        which records each of those once converted"""
+        records = journal.active()
+        results = [None] * len(pages)
+        if records is None:
+            return results, list(range(len(pages))), None
+        opt_key = journal.options_key(options)
+        keys = [journal.page_key(page.fingerprint(), opt_key) for page in pages]
+        for i, page in enumerate(pages):
+            info = records.restore_page(keys[i], page.fp.parent, page.stem)
+            if info is None:
+                continue
+            if info['kept']:
+                page.materialize()
+                results[i] = True, Page(page.fp), info
+            else:
+                results[i] = True, Page(info.pop('restored')), info
+        todo = [i for i, result in enumerate(results) if result is None]
+        if len(todo) < len(pages) and config.loglevel >= 0:
+            print(f'[i] Resuming: {len(pages) - len(todo)} pages converted before')
+
+        def record(j, result):
+            if isinstance(result, tuple) and result[0]: # not failed/interrupted
+                records.record_page(keys[todo[j]], self.fp, result[1].fp, result[2])
+        return results, todo, record
+
+    def convert_targets(self, targets:tuple) -> tuple:
+        """Convert every page for each of targets, (label, Settings) pairs,
+        decoding each page only once. Returns a copy of the book for each
+        target, holding its converted pages"""
+        target_opts = [(label, page_options(settings))
+                       for label, settings in targets]
+        pages = self.fetch_pages()
+        dupes = self.find_dupes() if self.settings.dedupe else {}
+        unique_pages = [page for i, page in enumerate(pages) if i not in dupes]
+        worker = partial(fanout_page_worker, targets=tuple(target_opts))
+        with metrics.stage('convert'):
+            results = map_workers(worker, unique_pages, saved=_saved_bytes,
+                                  progress=f'Converting {self.fp.name} '
+                                           f'({len(targets)} outputs)')
+        for i, (label, options) in enumerate(target_opts):
+            metrics.record_pages(f'convert {label}', self.fp.name,
+                                 [result[i] for result in results])
+
+        books = []
+        for i, (label, options) in enumerate(target_opts):
+            book = copy.copy(self)
+            book.settings = targets[i][1]
+            book._page_opt = options
+            book._assemble(pages, dupes, [result[i] for result in results])
+            books.append(book)
+        mylog('', progress=True)
+        return tuple(books)
 
+    def _assemble(self, pages, dupes:dict, results:list) -> None:
+        # rebuild the index from worker results, in the original order
+        self._bad_files = [item[1].fp for item in results if item[0] is False]
+        self._skipped_files = [item[1].fp for item in results
+                               if item[2].get('kept')]
+        # put duplicates back where they were, pointing at their original
+        converted = {}
+        unique_results = iter(results)
+        for i, page in enumerate(pages):
+            if i not in dupes:
+                converted[i] = next(unique_results)
+                continue
+            success, original, info = converted[dupes[i]]
+            if success:
+                dupe = Page(page.fp)
+                dupe.dupe_of = original
+                converted[i] = True, dupe, {}
+            else:
+                converted[i] = False, page, {}
+                self._bad_files.append(page.fp)
+        self._dupe_files = [page.fp for i, page in enumerate(pages) if i in dupes]
+        self._index = [item[1] for i, item in sorted(converted.items()) if item[0]]
+
+    def find_dupes(self) -> dict:
+        """Map the index of each page which duplicates an earlier one, to the
+        index of the first occurrence. With dedupe_distance >= 0, nearly
+        identical images (by perceptual hash) count as duplicates too"""
+        pages = self.fetch_pages()
+        perceptual = self.settings.dedupe_distance >= 0
+        if perceptual: # every page needs its perceptual hash
+            suspects = list(range(len(pages)))
+        else:
+            # identical pages share a size (and a CRC, in a zip), so only
+            # pages which collide on those are worth reading and hashing
+            groups = {}
+            for i, page in enumerate(pages):
+                groups.setdefault(_dupe_key(page), []).append(i)
+            suspects = sorted(i for group in groups.values() if len(group) > 1 for i in group)
+            if not suspects:
+                return {}
+        worker = partial(hash_page_worker, perceptual=perceptual)
+        with metrics.stage('dedupe'):
+            hashes = map_workers(worker, [pages[i] for i in suspects],
+                                 progress=f'Hashing {self.fp.name}')
+
+        dupes = {}
+        first_seen = {}
+        phashes = []
+        for i, (digest, phash) in zip(suspects, hashes):
+            if digest in first_seen:
+                dupes[i] = first_seen[digest]
+                continue
+            first_seen[digest] = i
+            if phash is None:
+                continue
+            for j, other in phashes:
+                if bin(phash ^ other).count('1') <= self.settings.dedupe_distance:
+                    dupes[i] = j
+                    break
+            else:
+                phashes.append((i, phash))
+        for i, j in dupes.items():
+            mylog(f'dupe: {pages[i].fp} == {pages[j].fp}')
+        return dupes
+
+    def book_size(self) -> int:
+        """Uncompressed size of every image in the archive, in bytes"""
+        with ZipFile(self._source) as source_zip:
+            return sum(info.file_size for info in self._index_members(source_zip)['image'])
+
+    def _convert_samples(self, sample_pages, options, label:str) -> tuple:
+        sampledir = Path.joinpath(self._cachedir, label)
+        Path.mkdir(sampledir)
+        worker = partial(convert_page_worker, savedir=sampledir, options=options)
+        with metrics.stage('sample'):
+            results = map_workers(worker, sample_pages, progress=f'Sampling {label}')
+        metrics.record_pages('sample', self.fp.name, results)
+
+        # pages don't need to be sorted here, as they're discarded
+        converted = [item for item in results if item[0]]
+        nbytes = sum(item[1].fp.stat().st_size for item in converted)
+        if options['metric'] is not None and len(converted) > 0:
+            metric = sum(item[2]['metric'] for item in converted) / len(converted)
+        else:
+            metric = None
+        return nbytes, metric
+
+    def compute_fmt_sizes(self) -> tuple:
+        def compute_single_fmt(sample_pages, fmt) -> tuple:
             options = dict(self._page_opt) # ensure it's a copy
             options['format'] = fmt
-            worker = partial(convert_page_worker, savedir=fmtdir, options=options)
-            results = map_workers(worker, sample_pages)
-
-            # pages don't need to be sorted here, as they're discarded
-            converted_pages = [item[1] for item in results if item[0]]
-            nbytes = sum(page.fp.stat().st_size for page in converted_pages)
-            return nbytes, fmt.desc, fmt.name
+            # measure the format itself, not the source
+            options['size_guard'] = None
+            if self.settings.quality_metric:
+                options['metric'] = self.settings.quality_metric
+            nbytes, metric = self._convert_samples(sample_pages, options, fmt.name)
+            return nbytes, fmt.desc, fmt.name, metric
 
         # extract images and compute their original size
         # manually call extract so we don't overwrite _pages cache
-        source_pages = self.extract(count=config.samples_count)
-        nbytes = sum(page.fp.stat().st_size for page in source_pages)
+        source_pages = self.extract(count=self.settings.samples_count)
+        nbytes = sum(page.file_size for page in source_pages)
         mylog(f'reference format: {source_pages[0].name}')
         source_fmt = source_pages[0].fmt
         source_fsize = [nbytes, f'{SOURCE_NAME} ({source_fmt.desc})',
-                        source_fmt.name]
+                        source_fmt.name, None]
 
         # compute the size of each format after converting.
         # one thread per individual format. n processes per thread
         fmt_fsizes = []
-        worker = partial(compute_single_fmt, source_pages, self._cachedir)
-        results = map_workers(worker, config.allowed_page_formats(), multithread=True)
+        worker = partial(compute_single_fmt, source_pages)
+        results = map_workers(worker, self.settings.allowed_page_formats(),
+                              multithread=True)
         fmt_fsizes.extend(results)
 
         # finally, compare
@@ -390,35 +1049,132 @@ class ComicArchive():
         mylog('', progress=True)
         return tuple(sorted_fmts)
 
-    def write_archive(self, book_format='cbz', file_name:str='') -> str:
+    def _extract_sample(self) -> tuple:
+        sample_pages = self.extract(count=self.settings.samples_count, spread=True)
+        source_bytes = sum(page.file_size for page in sample_pages)
+        return sample_pages, source_bytes, self.book_size()
+
+    def predict_size(self) -> tuple:
+        """Convert a sample of pages spread across the book with the present
+        settings. Returns the size of every image in the book, and its
+        predicted size after converting"""
+        sample_pages, source_bytes, book_bytes = self._extract_sample()
+        options = dict(self._page_opt)
+        nbytes = self._convert_samples(sample_pages, options, 'predict')[0]
+        mylog('', progress=True)
+        return book_bytes, int(book_bytes * nbytes / source_bytes)
+
+    def fit_target_size(self, target:int, fmts:tuple=(None,)) -> dict:
+        """Find the highest quality (and failing that, the largest scale) at
+        which the book is predicted to fit in target bytes, for each of fmts.
+        None keeps the format of each page. Predictions are extrapolated from
+        a sample of pages spread across the book"""
+        sample_pages, source_bytes, book_bytes = self._extract_sample()
+        encoded = {} # every sample is encoded at most once
+
+        def predict(fmt, quality:int, scale:float) -> int:
+            key = (fmt, quality, scale)
+            if key not in encoded:
+                options = dict(self._page_opt)
+                options['format'] = fmt
+                options['quality'] = quality
+                options['adaptive'] = (0, 0) # search a single quality
+                options['scale'] = scale
+                fmt_name = fmt.name if fmt is not None else SOURCE_NAME
+                label = f'{fmt_name}_{quality}_{scale:.2f}'
+                encoded[key] = self._convert_samples(sample_pages, options, label)[0]
+                mylog(f'fit: {label}: {encoded[key]} bytes')
+            return int(book_bytes * encoded[key] / source_bytes)
+
+        def highest_passing(values:list, test) -> int:
+            # binary search, assumes test passes for every value up to a point
+            low, high = 0, len(values) - 1
+            if not test(values[low]):
+                return -1
+            while low < high:
+                mid = (low + high + 1) // 2
+                if test(values[mid]): low = mid
+                else: high = mid - 1
+            return low
+
+        qualities = list(range(self.settings.target_min_quality, 96))
+        min_scale = int(self.settings.target_min_scale * 100)
+        scales = [step / 100 for step in range(min_scale, 100, 5)] + [1.0]
+        candidates = []
+        for fmt in fmts:
+            mylog(f'Fitting: {self.fp}', progress=True)
+            if fmt is not None and fmt.lossless:
+                fmt_qualities = [fmt.quality] # quality is ignored
+            else:
+                fmt_qualities = qualities
+            i = highest_passing(fmt_qualities,
+                                lambda q: predict(fmt, q, 1.0) <= target)
+            if i >= 0:
+                quality, scale = fmt_qualities[i], 1.0
+            else:
+                quality = fmt_qualities[0]
+                i = highest_passing(scales,
+                                    lambda s: predict(fmt, quality, s) <= target)
+                scale = scales[i] if i >= 0 else scales[0]
+            predicted = predict(fmt, quality, scale)
+            candidates.append((predicted <= target, scale, quality, -predicted, fmt))
+
+        # prefer whatever fits, then the least downscaling, then quality
+        fits, scale, quality, predicted, fmt = max(candidates, key=lambda c: c[:4])
+        mylog('', progress=True)
+        return {'format':fmt.name if fmt is not None else None,
+                'quality':quality,
+                'scale':scale,
+                'predicted':-predicted,
+                'fits':fits}
+
+    def write_archive(self, book_format='cbz', file_name:str='', stream=None):
+        """Write the book to file_name plus the format's extension (defaults
+        to the book's name, in the current dir), or to stream, a writable
+        binary file object, which may be unseekable (e.g. a pipe or socket).
+        Returns the path written, or stream"""
         if book_format not in VALID_BOOK_FORMATS:
             raise ValueError(f"Invalid format '{book_format}'")
 
-        if file_name != '':
-            parent = Path(file_name).parents[0]
-            if not (parent.exists() and parent.is_dir()):
-                raise ValueError(f"Parent folder '{parent}' does not exist")
-            new_path = Path(f'{file_name}.{book_format}')
+        if stream is not None:
+            title = Path(file_name).name if file_name != '' else self.fp.stem
+            dest = stream
         else:
-            # write to current dir
-            new_path = Path(f'{self.fp.stem}.{book_format}')
-        if new_path.exists():
-            mylog(f'Write .{book_format}: {new_path}', progress=True)
-            mylog(f'{new_path} exists, removing...')
-            new_path.unlink()
-
-        new_path = str(new_path)
+            if file_name != '':
+                parent = Path(file_name).parents[0]
+                if not (parent.exists() and parent.is_dir()):
+                    raise ValueError(f"Parent folder '{parent}' does not exist")
+                new_path = Path(f'{file_name}.{book_format}')
+            else:
+                # write to current dir
+                new_path = Path(f'{self.fp.stem}.{book_format}')
+            if new_path.exists():
+                mylog(f'Write .{book_format}: {new_path}', progress=True)
+                mylog(f'{new_path} exists, removing...')
+                new_path.unlink()
+            title = new_path.stem
+            dest = str(new_path)
+
+        chapters = self.fetch_chapters()
+        # a joined volume's metadata would only describe its first book
+        extras = self._meta_files if len(chapters) == 1 else ()
         if book_format == 'cbz':
-            return write_zip(new_path, self.fetch_chapters())
+            return write_zip(dest, chapters, self.settings, extras)
         elif book_format == 'zip':
-            return write_zip(new_path, self.fetch_chapters())
+            return write_zip(dest, chapters, self.settings, extras)
         elif book_format == 'epub':
-            return write_epub(new_path, self.fetch_chapters())
+            return write_epub(dest, chapters, self.settings, title)
         elif book_format == 'mobi':
             raise NotImplementedError
         else:
             raise ValueError
 
+    def append_to(self, file_name:str) -> str:
+        """Convert this book's chapters, and add them to the end of file_name,
+        a cbz/zip volume previously written by join"""
+        mylog(f'Append to: {file_name}', progress=True)
+        return append_zip(file_name, self.fetch_chapters(), self.settings)
+
     def add_page(self, fp, index=-1):
         try:
             assert Path(fp).exists()
@@ -432,9 +1188,13 @@ class ComicArchive():
         return self._index.pop(index)
 
     def cleanup(self):
-        if self._cachedir.exists():
-            mylog(f'cleanup(): {self._cachedir}')
-            try:
-                shutil.rmtree(self._cachedir)
-            except PermissionError:
-                mylog(f"PermissionError, couldn't clean {self._cachedir}")
+        release_cache(self._claim)
+        # including converted copies saved by fanout_page_worker
+        target_dirs = self._cachedir.parent.glob(f'{self._cachedir.name}_*')
+        for cachedir in (self._cachedir, *target_dirs):
+            if cachedir.exists():
+                mylog(f'cleanup(): {cachedir}')
+                try:
+                    shutil.rmtree(cachedir)
+                except PermissionError:
+                    mylog(f"PermissionError, couldn't clean {cachedir}")
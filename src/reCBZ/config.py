@@ -1,18 +1,18 @@
 import os
+import tempfile
+import dataclasses
+from dataclasses import dataclass
 from importlib import resources
+from pathlib import Path
 
 try:
     import tomllib
 except ModuleNotFoundError:
     import tomli as tomllib
-from PIL import Image
 
 import reCBZ
-from reCBZ.formats import FormatList
 from reCBZ.profiles import ProfileDict
 
-# LANCZOS sacrifices performance for optimal upscale quality
-RESAMPLE_TYPE = Image.Resampling.LANCZOS
 ZIPCOMMENT:str = 'repacked with reCBZ'
 _cfg = tomllib.loads(resources.read_text("reCBZ", "defaults.toml"))
 
@@ -23,17 +23,52 @@ no_write:bool = _cfg["general"]["no_write"]
 loglevel:int = _cfg["general"]["loglevel"]
 processes:int = _cfg["general"]["processes"]
 samples_count:int = _cfg["general"]["samples_count"]
+min_savings:float = _cfg["general"]["min_savings"]
+quality_metric:str = _cfg["general"]["quality_metric"]
+quality_floor:float = _cfg["general"]["quality_floor"]
+manifest:bool = _cfg["general"]["manifest"]
+manifest_path:str = _cfg["general"]["manifest_path"]
+watch_interval:float = _cfg["general"]["watch_interval"]
+watch_debounce:float = _cfg["general"]["watch_debounce"]
+serve_host:str = _cfg["general"]["serve_host"]
+serve_port:int = _cfg["general"]["serve_port"]
+serve_queue:int = _cfg["general"]["serve_queue"]
+serve_jobs:int = _cfg["general"]["serve_jobs"]
+metrics_file:str = _cfg["general"]["metrics_file"]
+profile_workers:str = _cfg["general"]["profile_workers"]
+work_dir:str = _cfg["general"]["work_dir"]
+cache_dir:str = _cfg["general"]["cache_dir"]
+cache_min_free:str = _cfg["general"]["cache_min_free"]
+verify_inputs:bool = _cfg["general"]["verify_inputs"]
+queue_lease:float = _cfg["general"]["queue_lease"]
+queue_chunk_pages:int = _cfg["general"]["queue_chunk_pages"]
+queue_poll:float = _cfg["general"]["queue_poll"]
 archive_format:str = _cfg["archive"]["archive_format"]
 compress_zip:int = _cfg["archive"]["compress_zip"]
 right_to_left:bool = _cfg["archive"]["right_to_left"]
+dedupe:bool = _cfg["archive"]["dedupe"]
+dedupe_distance:int = _cfg["archive"]["dedupe_distance"]
+drop_dupes:bool = _cfg["archive"]["drop_dupes"]
+target_size:str = _cfg["archive"]["target_size"]
+target_min_quality:int = _cfg["archive"]["target_min_quality"]
+target_min_scale:float = _cfg["archive"]["target_min_scale"]
 img_format:str = _cfg["image"]["img_format"]
 img_quality:int = _cfg["image"]["img_quality"]
+adaptive_quality:tuple = _cfg["image"]["adaptive_quality"]
 img_size:tuple = _cfg["image"]["img_size"]
 no_upscale:bool = _cfg["image"]["no_upscale"]
 no_downscale:bool = _cfg["image"]["no_downscale"]
 grayscale:bool = _cfg["image"]["grayscale"]
 blacklisted_fmts:str = _cfg["image"]["blacklisted_fmts"]
+size_guard:bool = _cfg["image"]["size_guard"]
+size_guard_threshold:float = _cfg["image"]["size_guard_threshold"]
 ebook_profile = None
+# where outputs are written, empty for the current dir. set per job, e.g. by
+# workqueue for the dir a book was queued from
+out_dir:str = ''
+# (label, settings) pairs, one for each output written when converting a book
+# to several profiles or formats at once. settings replace the ones above
+targets:list = []
 
 
 def pcount() -> int:
@@ -51,8 +86,35 @@ def pcount() -> int:
             return default_value
 
 
+def __getattr__(name):
+    # deferred, PIL is slow to import
+    if name == 'RESAMPLE_TYPE':
+        from PIL import Image
+        # LANCZOS sacrifices performance for optimal upscale quality
+        globals()[name] = Image.Resampling.LANCZOS
+        return globals()[name]
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+_size_warned = False
+
+
+def cache_root() -> Path:
+    """Where the cache goes, see cache_dir. 'ram' falls back to the temp dir
+    when there's no RAM disk"""
+    if cache_dir == 'ram':
+        if Path('/dev/shm').is_dir():
+            return Path('/dev/shm')
+        return Path(tempfile.gettempdir())
+    elif cache_dir:
+        return Path(cache_dir).expanduser()
+    else:
+        return Path(tempfile.gettempdir())
+
+
 def term_width() -> int:
     # limit output message width. ignored if verbose
+    global _size_warned
     try:
         TERM_COLUMNS, TERM_LINES = os.get_terminal_size()
         assert TERM_COLUMNS > 0 and TERM_LINES > 0
@@ -60,33 +122,99 @@ def term_width() -> int:
         elif TERM_COLUMNS < 30: max_width = 30
         else: max_width = TERM_COLUMNS - 2
     except (AssertionError, OSError):
-        print("[!] Can't determine terminal size, defaulting to 78 cols")
+        if not _size_warned:
+            print("[!] Can't determine terminal size, defaulting to 78 cols")
+            _size_warned = True
         max_width = 78
     return max_width
 
 
-def set_profile(name) -> None:
-    global blacklisted_fmts, ebook_profile, archive_format, img_size, grayscale
+def profile_settings(name, blacklist:str=None) -> dict:
+    """Settings which are replaced when using the profile"""
     try:
         profile = ProfileDict[name]
     except KeyError:
         raise ValueError(f"Invalid profile '{name}'")
-    grayscale = profile.gray
-    img_size = profile.size
-    # if profile.prefer_epub:
-    archive_format = 'epub'
-    ebook_profile = profile
-    blacklisted_fmts += profile.blacklisted_fmts
+    if blacklist is None:
+        blacklist = blacklisted_fmts
+    return {'grayscale':profile.gray,
+            'img_size':profile.size,
+            # if profile.prefer_epub:
+            'archive_format':'epub',
+            'ebook_profile':profile,
+            'blacklisted_fmts':f'{blacklist} {profile.blacklisted_fmts}'}
 
 
-def allowed_page_formats() -> tuple:
-    try:
-        blacklist = blacklisted_fmts.lower().split(' ')
-    except AttributeError: # blacklist is None
-        return FormatList
-    valid_fmts = tuple(fmt for fmt in FormatList if fmt.name not in blacklist)
-    assert len(valid_fmts) >= 1, "valid_formats is 0"
-    return valid_fmts
+def set_profile(name) -> None:
+    globals().update(profile_settings(name))
+
+
+@dataclass(frozen=True)
+class Settings:
+    """The settings of a single job, e.g. one book or one server request.
+    Passed explicitly, so jobs with different settings can share a process.
+    Logging, processes, and the like remain module globals"""
+    overwrite:bool
+    ignore_page_err:bool
+    force_write:bool
+    no_write:bool
+    samples_count:int
+    min_savings:float
+    quality_metric:str
+    quality_floor:float
+    archive_format:str
+    compress_zip:int
+    right_to_left:bool
+    dedupe:bool
+    dedupe_distance:int
+    drop_dupes:bool
+    target_size:str
+    target_min_quality:int
+    target_min_scale:float
+    img_format:str
+    img_quality:int
+    adaptive_quality:tuple
+    img_size:tuple
+    no_upscale:bool
+    no_downscale:bool
+    grayscale:bool
+    blacklisted_fmts:str
+    size_guard:bool
+    size_guard_threshold:float
+    ebook_profile:type = None
+    out_dir:str = ''
+    # (label, Settings) pairs, see targets above
+    targets:tuple = ()
+
+    def __post_init__(self):
+        # toml and argparse give lists
+        object.__setattr__(self, 'adaptive_quality', tuple(self.adaptive_quality))
+        object.__setattr__(self, 'img_size', tuple(self.img_size))
+
+    def replace(self, **changes) -> 'Settings':
+        return dataclasses.replace(self, **changes)
+
+    def with_profile(self, name) -> 'Settings':
+        return self.replace(**profile_settings(name, self.blacklisted_fmts))
+
+    def allowed_page_formats(self) -> tuple:
+        from reCBZ.formats import FormatList
+        try:
+            blacklist = self.blacklisted_fmts.lower().split(' ')
+        except AttributeError: # blacklist is None
+            return FormatList
+        valid_fmts = tuple(fmt for fmt in FormatList if fmt.name not in blacklist)
+        assert len(valid_fmts) >= 1, "valid_formats is 0"
+        return valid_fmts
+
+
+def current() -> Settings:
+    """Settings from the present module globals"""
+    names = [field.name for field in dataclasses.fields(Settings)
+             if field.name != 'targets']
+    base = Settings(**{name:globals()[name] for name in names})
+    return base.replace(targets=tuple((label, base.replace(**settings))
+                                      for label, settings in targets))
 
 
 _preload_profile = _cfg["archive"]["ebook_profile"]
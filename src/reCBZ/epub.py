@@ -1,86 +1,207 @@
-# Copyright 2022 Aleksandar Erkalović, Gwyn Vales
-# This program is free software: you can redistribute it and/or modify it under
-# the terms of the Affero GNU General Public License as published by the Free
-# Software Foundation, either version 3 of the License, or (at your option) any
-# later version.
-# This program is distributed in the hope that it will be useful, but WITHOUT
-# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
-# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
-# details.
-# You should have received a copy of the Affero GNU General Public License along
-# with this program. If not, see <https://www.gnu.org/licenses/agpl-3.0.en.html>
-#
-# 'ebooklib', authored by Aleksandar Erkalović, is licensed under the AGPL, and we
-# are linking to it, therefore AGPL applies to this module as well. You may NOT
-# distirubte derivatives using this module (i.e. epub.py) without also
-# distributing the source code, even over a network, and any modifications to
-# either epub.py or ebooklib must be licensed under the AGPL as well.
-# non-commerical private use is explicitly permitted.
-# WORK IN PROGRESS
+"""Streaming EPUB writer: pages are written to the zip as they are added."""
+import time
 from uuid import uuid4
-
-from ebooklib import epub
+from pathlib import Path
+from xml.sax.saxutils import escape, quoteattr
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 
 from reCBZ.util import mylog
-import reCBZ.config as config
 
 POP_COVER = True
+# images are already compressed, deflating them only wastes time
+IMG_COMPRESS = ZIP_STORED
+TEXT_COMPRESS = ZIP_DEFLATED
+ROOT = 'EPUB'
+
+# the layout mirrors what ebooklib used to generate, so books written by older
+# versions and newer ones are indistinguishable to readers
+CONTAINER_XML = '''<?xml version="1.0" encoding="utf-8"?>
+<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+  <rootfiles>
+    <rootfile media-type="application/oebps-package+xml" full-path="{root}/content.opf"/>
+  </rootfiles>
+</container>
+'''
+
+PAGE_XHTML = '''<?xml version='1.0' encoding='utf-8'?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" epub:prefix="z3998: http://www.daisy.org/z3998/2012/vocab/structure/#" lang="en" xml:lang="en">
+  <head>
+    <title>{title}</title>
+  </head>
+  <body><img src={src} {attrs}/>
+  </body>
+</html>
+'''
+
+NAV_XHTML = '''<?xml version='1.0' encoding='utf-8'?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en" xml:lang="en">
+  <head>
+    <title>{title}</title>
+  </head>
+  <body>
+    <nav epub:type="toc" id="id" role="doc-toc">
+      <h2>{title}</h2>
+      <ol>
+{entries}
+      </ol>
+    </nav>
+  </body>
+</html>
+'''
+NAV_ENTRY = '''        <li>
+          <a href={href}>{label}</a>
+        </li>'''
+
+NCX = '''<?xml version='1.0' encoding='utf-8'?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head>
+    <meta content={uid} name="dtb:uid"/>
+    <meta content="0" name="dtb:depth"/>
+    <meta content="0" name="dtb:totalPageCount"/>
+    <meta content="0" name="dtb:maxPageNumber"/>
+  </head>
+  <docTitle>
+    <text>{title}</text>
+  </docTitle>
+  <navMap>
+{entries}
+  </navMap>
+</ncx>
+'''
+NCX_ENTRY = '''    <navPoint id={id}>
+      <navLabel>
+        <text>{label}</text>
+      </navLabel>
+      <content src={href}/>
+    </navPoint>'''
+
+OPF = '''<?xml version='1.0' encoding='utf-8'?>
+<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="3.0" prefix="rendition: http://www.idpf.org/vocab/rendition/#">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <meta property="dcterms:modified">{modified}</meta>
+    <dc:identifier id="id">{uid}</dc:identifier>
+    <dc:title>{title}</dc:title>
+    <dc:creator id="creator">{author}</dc:creator>
+    <dc:language>en</dc:language>
+    <meta name="cover" content="cover-img"></meta>
+{metadata}
+  </metadata>
+  <manifest>
+{manifest}
+  </manifest>
+  <spine toc="ncx"{direction}>
+{spine}
+  </spine>
+</package>
+'''
+MANIFEST_ENTRY = '    <item href={href} id={id} media-type={mime}{properties}/>'
+SPINE_ENTRY = '    <itemref idref={id}/>'
+
 
+def _attrs(attrs:dict) -> str:
+    return ' '.join(f'{key}={quoteattr(str(val))}' for key, val in attrs.items())
 
-def single_chapter_epub(name:str, pages:list) -> str:
-    book = epub.EpubBook()
 
+def _meta(tag:tuple) -> str:
+    # same layout as ebooklib's add_metadata(namespace, name, value, others)
+    namespace, name, value, others = tag
+    if value:
+        return f'    <{name} {_attrs(others)}>{escape(value)}</{name}>'
+    else:
+        return f'    <{name} {_attrs(others)}/>'
+
+
+def _page_size(page, profile) -> str:
+    if profile is not None:
+        if page.landscape:
+            height, width = profile.size
+        else:
+            width, height = profile.size
+    else:
+        width, height = page.size
+    page.close()
+    return f'width="{width}" height="{height}"'
+
+
+def _write_epub(name:str, chapters:list, multi:bool, settings, dest):
+    """Write pages to the zip one at a time, straight from disk. Only the
+    (small) OPF, NCX and nav documents are kept in memory, until the end.
+    dest is a path or a writable binary file, which may be unseekable"""
     # attempt to distinguish author / title
     if ' - ' in name:
         title, author = name.split(' - ', 1)
     else:
         title = name
         author = 'reCBZ'
-    book.set_title(title)
-    book.add_author(author)
-    book.set_language('en')
-    book.set_identifier(str(uuid4()))
+    uid = str(uuid4())
+    profile = settings.ebook_profile
+
+    manifest = []
+    spine = []
+    toc = []
+    epub_zip = ZipFile(dest, 'w')
+    # mimetype must be the first file, and uncompressed
+    epub_zip.writestr(ZipInfo('mimetype'), 'application/epub+zip',
+                      compress_type=ZIP_STORED)
+    epub_zip.writestr('META-INF/container.xml', CONTAINER_XML.format(root=ROOT),
+                      compress_type=TEXT_COMPRESS)
 
     # repacking the same file many times over would lead to additional copies
     # if we did include it
     if POP_COVER:
-        cover = pages.pop(0)
+        cover = chapters[0].pop(0)
     else:
-        cover = pages[0]
-    covert_ops = f'cover{cover.fmt.ext[0]}'
-    book.set_cover(covert_ops, open(cover.fp, 'rb').read())
+        cover = chapters[0][0]
+    if cover.dupe_of is not None:
+        cover = cover.dupe_of
+    cover_dest = f'cover{cover.fmt.ext[0]}'
+    epub_zip.write(cover.fp, f'{ROOT}/{cover_dest}', IMG_COMPRESS)
+    # duplicate pages link to the image of the first copy
+    written = {id(cover):cover_dest}
+    epub_zip.writestr(f'{ROOT}/cover.xhtml',
+                      PAGE_XHTML.format(title='Cover', src=quoteattr(cover_dest),
+                                        attrs='alt="Cover"'),
+                      compress_type=TEXT_COMPRESS)
+    manifest.append((cover_dest, 'cover-img', cover.fmt.mime, 'cover-image'))
+    manifest.append(('cover.xhtml', 'cover', 'application/xhtml+xml', None))
 
-    spine = []
-    for page_i, page in enumerate(pages, start=1):
-        static_dest = f'static/{page_i}{page.fmt.ext[0]}'
-        mime_type = page.fmt.mime
-        if config.ebook_profile is not None:
-            if page.landscape:
-                height, width = config.ebook_profile.size
+    lead_zeroes = len(str(len(chapters)))
+    page_i = 1
+    for chapter_i, chapter in enumerate(chapters, start=1):
+        chapter_name = f'Ch {chapter_i:0{lead_zeroes}d}'
+        for entry in chapter:
+            page = entry.dupe_of if entry.dupe_of is not None else entry
+            if multi:
+                static_dest = f'static/{chapter_name}/{page_i}{page.fmt.ext[0]}'
+                page_title = f'{chapter_name} Page {page_i}'
             else:
-                width, height = config.ebook_profile.size
-        else:
-            width, height = page.size
-        size_str = f'width={width} height={height}'
-        mylog(f'writing {page.fp} to {static_dest} as {mime_type}')
-
-        item = epub.EpubHtml(title=f'Page {page_i}',
-                             file_name=f'page_{page_i}.xhtml', lang='en')
-        item.content=f'''<html>
-                            <head></head>
-                            <body>
-                                <img src="{static_dest}" {size_str}'/>
-                            </body>
-                         </html>'''
-
-        image_content = open(page.fp, 'rb').read()
-        # store read content relative to zip
-        static_img = epub.EpubImage(uid=f'image_{page_i}', file_name=static_dest,
-                                    media_type=mime_type, content=image_content)
-        book.add_item(item)
-        book.add_item(static_img)
-        spine.append(item)
-    book.toc.append(spine[0])
+                static_dest = f'static/{page_i}{page.fmt.ext[0]}'
+                page_title = f'Page {page_i}'
+            mime_type = page.fmt.mime
+            xhtml_dest = f'page_{page_i}.xhtml'
+            xhtml_id = f'chapter_{page_i-1}'
+            if id(page) in written:
+                static_dest = written[id(page)]
+                mylog(f'linking {entry.fp} to {static_dest}')
+
+            xhtml = PAGE_XHTML.format(title=escape(page_title),
+                                      src=quoteattr(static_dest),
+                                      attrs=_page_size(page, profile))
+            epub_zip.writestr(f'{ROOT}/{xhtml_dest}', xhtml,
+                              compress_type=TEXT_COMPRESS)
+            manifest.append((xhtml_dest, xhtml_id, 'application/xhtml+xml', None))
+            if id(page) not in written:
+                mylog(f'writing {page.fp} to {static_dest} as {mime_type}')
+                epub_zip.write(page.fp, f'{ROOT}/{static_dest}', IMG_COMPRESS)
+                manifest.append((static_dest, f'image_{page_i}', mime_type, None))
+                written[id(page)] = static_dest
+            spine.append(xhtml_id)
+            # one toc entry for each chapter, or just the first page
+            if entry is chapter[0] and (multi or chapter_i == 1):
+                toc.append((xhtml_dest, xhtml_id, page_title))
+            page_i += 1
 
     # add navigation files
     # never ask
@@ -91,98 +212,56 @@ def single_chapter_epub(name:str, pages:list) -> str:
     # a programmer
     # what is a Ncx file
     # 2009derp.jpeg
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-    book.spine = (page for page in spine)
+    ncx_entries = '\n'.join(NCX_ENTRY.format(id=quoteattr(xhtml_id),
+                                              label=escape(label),
+                                              href=quoteattr(href))
+                            for href, xhtml_id, label in toc)
+    epub_zip.writestr(f'{ROOT}/toc.ncx',
+                      NCX.format(uid=quoteattr(uid), title=escape(name),
+                                 entries=ncx_entries),
+                      compress_type=TEXT_COMPRESS)
+    nav_entries = '\n'.join(NAV_ENTRY.format(href=quoteattr(href),
+                                              label=escape(label))
+                            for href, xhtml_id, label in toc)
+    epub_zip.writestr(f'{ROOT}/nav.xhtml',
+                      NAV_XHTML.format(title=escape(name), entries=nav_entries),
+                      compress_type=TEXT_COMPRESS)
+    manifest.append(('toc.ncx', 'ncx', 'application/x-dtbncx+xml', None))
+    manifest.append(('nav.xhtml', 'nav', 'application/xhtml+xml', 'nav'))
+    if multi:
+        spine.insert(0, 'nav')
 
-    if config.right_to_left is True:
-        book.set_direction('rtl')
+    metadata = []
+    if profile is not None:
+        metadata = [_meta(tag) for tag in profile.epub_properties]
+    if settings.right_to_left is True:
+        direction = ' page-progression-direction="rtl"'
         # formerly necessary. turns out it's not an issue if you don't set lr in
         # the first place
         # if 'Kindle' in str(Config.ebook_profile):
         #     book.add_metadata(None, 'meta', '', {'name': 'primary-writing-mode',
         #                                          'content': 'horizontal-rl'}),
-
-    if config.ebook_profile is not None:
-        for tag in config.ebook_profile.epub_properties:
-            book.add_metadata(*tag)
-        source_fp = f'{name}{config.ebook_profile.epub_ext}'
     else:
-        source_fp = f'{name}.epub'
+        direction = ''
+    manifest_entries = '\n'.join(
+        MANIFEST_ENTRY.format(href=quoteattr(href), id=quoteattr(item_id),
+                              mime=quoteattr(mime),
+                              properties=f' properties="{props}"' if props else '')
+        for href, item_id, mime, props in manifest)
+    spine_entries = '\n'.join(SPINE_ENTRY.format(id=quoteattr(item_id))
+                               for item_id in spine)
+    opf = OPF.format(modified=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                     uid=escape(uid), title=escape(title), author=escape(author),
+                     metadata='\n'.join(metadata), manifest=manifest_entries,
+                     direction=direction, spine=spine_entries)
+    epub_zip.writestr(f'{ROOT}/content.opf', opf, compress_type=TEXT_COMPRESS)
+    epub_zip.close()
+    return dest
 
-    epub.write_epub(source_fp, book, {})
-    return source_fp
 
+def single_chapter_epub(name:str, pages:list, settings, dest):
+    return _write_epub(name, [pages], False, settings, dest)
 
-def multi_chapter_epub(name:str, chapters:list) -> str:
-    book = epub.EpubBook()
-
-    if ' - ' in name:
-        title, author = name.split(' - ', 1)
-    else:
-        title = name
-        author = 'reCBZ'
-    book.set_title(title)
-    book.add_author(author)
-    book.set_language('en')
-    book.set_identifier(str(uuid4()))
-
-    if POP_COVER:
-        cover = chapters[0].pop(0)
-    else:
-        cover = chapters[0][0]
-    covert_ops = f'cover{cover.fmt.ext[0]}'
-    book.set_cover(covert_ops, open(cover.fp, 'rb').read())
-
-    lead_zeroes = len(str(len(chapters)))
-    page_i = 1
-    spine = []
-    for chapter_i, chapter in enumerate(chapters, start=1):
-        for page in chapter: # must be inverted
-            chapter_name = f'Ch {chapter_i:0{lead_zeroes}d}'
-            static_dest = f'static/{chapter_name}/{page_i}{page.fmt.ext[0]}'
-            mime_type = page.fmt.mime
-            if config.ebook_profile is not None:
-                if page.landscape:
-                    height, width = config.ebook_profile.size
-                else:
-                    width, height = config.ebook_profile.size
-            else:
-                width, height = page.size
-            size_str = f'width={width} height={height}'
-            mylog(f'writing {page.fp} to {static_dest} as {mime_type}')
-
-            item = epub.EpubHtml(title=f'{chapter_name} Page {page_i}',
-                                    file_name=f'page_{page_i}.xhtml', lang='en')
-            item.content=f'''<html>
-                                <head></head>
-                                <body>
-                                    <img src="{static_dest}" {size_str}'/>
-                                </body>
-                             </html>'''
-
-            image_content = open(page.fp, 'rb').read()
-            static_img = epub.EpubImage(uid=f'image_{page_i}', file_name=static_dest,
-                                        media_type=mime_type, content=image_content)
-            book.add_item(item)
-            book.add_item(static_img)
-            spine.append(item)
-            page_i += 1
-        book.toc.append(spine[len(spine)-len(chapter)])
-
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-    book.spine = ['nav', *(page for page in spine)]
-
-    if config.right_to_left is True:
-        book.set_direction('rtl')
-
-    if config.ebook_profile is not None:
-        for tag in config.ebook_profile.epub_properties:
-            book.add_metadata(*tag)
-        source_fp = f'{name}{config.ebook_profile.epub_ext}'
-    else:
-        source_fp = f'{name}.epub'
 
-    epub.write_epub(source_fp, book, {})
-    return source_fp
+def multi_chapter_epub(name:str, chapters:list, settings, dest):
+    return _write_epub(name, chapters, True, settings, dest)
@@ -18,8 +18,9 @@ class Jpeg(LossyFmt):
     mime:str = 'image/jpeg'
 
     @classmethod
-    def save(cls, img:Image.Image, dest):
-        img.save(dest, format='JPEG', optimize=True, quality=cls.quality)
+    def save(cls, img:Image.Image, dest, quality:int=None):
+        if quality is None: quality = cls.quality
+        img.save(dest, format='JPEG', optimize=True, quality=quality)
 
 
 class WebpLossy(LossyFmt):
@@ -31,8 +32,9 @@ class WebpLossy(LossyFmt):
     mime:str = 'image/webp'
 
     @classmethod
-    def save(cls, img:Image.Image, dest):
-        img.save(dest, fomrat='WEBP', lossless=cls.lossless, method=5, quality=cls.quality)
+    def save(cls, img:Image.Image, dest, quality:int=None):
+        if quality is None: quality = cls.quality
+        img.save(dest, format='WEBP', lossless=cls.lossless, method=5, quality=quality)
 
 
 class WebpLossless(LosslessFmt):
@@ -42,7 +44,7 @@ class WebpLossless(LosslessFmt):
     mime:str = 'image/webp'
 
     @classmethod
-    def save(cls, img:Image.Image, dest):
+    def save(cls, img:Image.Image, dest, quality:int=None):
         # for some reason 'quality' is akin to Png compress_level when lossless
         img.save(dest, format='WEBP', lossless=cls.lossless, method=4, quality=100)
 
@@ -54,9 +56,19 @@ class Png(LosslessFmt):
     mime:str = 'image/png'
 
     @classmethod
-    def save(cls, img:Image.Image, dest):
+    def save(cls, img:Image.Image, dest, quality:int=None):
         img.save(dest, format='PNG', optimize=True, compress_level=9)
 
 
 FormatList = (Jpeg, WebpLossy, WebpLossless, Png)
 FormatDict = {cls.name:cls for cls in FormatList}
+
+# enough of a file to tell its format, see is_image
+HEADER_SIZE = 12
+
+
+def is_image(header:bytes) -> bool:
+    """Whether header, the first HEADER_SIZE bytes of a file, belong to one
+    of the formats above"""
+    return (header.startswith((b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n'))
+            or (header[:4] == b'RIFF' and header[8:12] == b'WEBP'))
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from reCBZ.manifest import file_hash
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    key TEXT PRIMARY KEY,
+    book TEXT NOT NULL,
+    file TEXT,
+    info TEXT NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_book ON pages (book);
+CREATE TABLE IF NOT EXISTS books (
+    hash TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    PRIMARY KEY (hash, settings)
+);
+"""
+
+_journal = None
+
+
+def _link_or_copy(source:Path, dest:Path) -> None:
+    try:
+        os.link(source, dest)
+    except OSError: # across filesystems, or unsupported
+        shutil.copyfile(source, dest)
+
+
+def options_key(options:dict) -> str:
+    """Serialize page options, see archive.page_options"""
+    return json.dumps(options, sort_keys=True,
+                      default=lambda value: getattr(value, 'name', str(value)))
+
+
+def page_key(contents:bytes, options:str) -> str:
+    """Identify a page by its contents, see archive.Page.fingerprint, and the
+    options it's converted with"""
+    digest = hashlib.blake2b(options.encode(), digest_size=16)
+    digest.update(contents)
+    return digest.hexdigest()
+
+
+class Journal:
+    """Pages converted so far, and books finished, kept in work_dir so an
+    interrupted run can pick up where it stopped. Pages of a book are
+    forgotten once it's finished. A shared journal may be used by several
+    hosts at once, see workqueue, which rules out WAL"""
+    def __init__(self, work_dir, shared:bool=False):
+        self.work_dir = Path(work_dir).resolve()
+        self.pages_dir = self.work_dir / 'pages'
+        self.pages_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.work_dir / 'journal.sqlite'),
+                                  timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        if not shared:
+            self.db.executescript('PRAGMA journal_mode = WAL;'
+                                  'PRAGMA synchronous = NORMAL;')
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def restore_page(self, key:str, dest_dir:Path, stem:str):
+        """Info of a page converted before, or None. Its converted file is
+        restored to dest_dir. info['kept'] means the source was kept"""
+        with self.lock:
+            row = self.db.execute('SELECT * FROM pages WHERE key = ?',
+                                  (key,)).fetchone()
+        if row is None:
+            return None
+        info = json.loads(row['info'])
+        if row['file'] is not None:
+            source = self.pages_dir / row['file']
+            dest = dest_dir / f'{stem}{source.suffix}'
+            dest_dir.mkdir(parents=True, exist_ok=True) # may not be extracted
+            try:
+                _link_or_copy(source, dest)
+            except FileNotFoundError: # removed from under us
+                return None
+            info['restored'] = str(dest)
+        return info
+
+    def record_page(self, key:str, book, page_fp, info:dict) -> None:
+        """Keep a converted page, page_fp, in the work dir. info is what
+        the worker returned"""
+        name = None
+        if not info.get('kept'):
+            name = f'{key}{Path(page_fp).suffix}'
+            _link_or_copy(Path(page_fp), self.pages_dir / name)
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                            (key, str(Path(book).resolve()), name,
+                             json.dumps(info), time.time()))
+
+    def forget_pages(self, book) -> None:
+        with self.lock, self.db:
+            rows = self.db.execute('SELECT file FROM pages WHERE book = ?',
+                                   (str(Path(book).resolve()),)).fetchall()
+            self.db.execute('DELETE FROM pages WHERE book = ?',
+                            (str(Path(book).resolve()),))
+        for row in rows:
+            if row['file'] is not None:
+                (self.pages_dir / row['file']).unlink(missing_ok=True)
+
+    def finished(self, fp, settings:str):
+        """Outputs of fp, if it was finished before with settings and they
+        still exist"""
+        digest = file_hash(fp)
+        with self.lock:
+            row = self.db.execute('SELECT outputs FROM books WHERE hash = ? '
+                                  'AND settings = ?', (digest, settings)).fetchone()
+        if row is None:
+            return None
+        outputs = json.loads(row['outputs'])
+        if not all(Path(output).exists() for output in outputs):
+            return None
+        return tuple(outputs)
+
+    def finish_book(self, fp, settings:str, outputs) -> None:
+        """Record that fp was finished, forget its pages"""
+        outputs = [str(Path(output).resolve()) for output in outputs]
+        if Path(fp).exists(): # not overwritten
+            with self.lock, self.db:
+                self.db.execute('INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?)',
+                                (file_hash(fp), settings, json.dumps(outputs),
+                                 time.time()))
+        self.forget_pages(fp)
+
+
+def start(work_dir, shared:bool=False) -> Journal:
+    """Open the journal in work_dir for this process"""
+    global _journal
+    _journal = Journal(work_dir, shared)
+    return _journal
+
+
+def active():
+    """The open Journal, or None"""
+    return _journal
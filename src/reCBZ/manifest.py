@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from zipfile import ZipFile, BadZipFile
+
+import reCBZ.config as config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    role TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    source TEXT,
+    out_size INTEGER,
+    seconds REAL,
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_size ON files (size);
+"""
+# settings which change the output of a repack
+OUTPUT_SETTINGS = ('archive_format', 'compress_zip', 'right_to_left', 'dedupe',
+                   'dedupe_distance', 'drop_dupes', 'target_size',
+                   'target_min_quality', 'target_min_scale', 'img_format',
+                   'img_quality', 'adaptive_quality', 'img_size', 'no_upscale',
+                   'no_downscale', 'grayscale', 'blacklisted_fmts', 'size_guard',
+                   'size_guard_threshold', 'quality_metric', 'quality_floor',
+                   'ebook_profile', 'targets')
+
+
+def default_path() -> Path:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(cache_home) / 'reCBZ' / 'manifest.sqlite'
+
+
+def file_hash(path) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def settings_key(mode=None, settings=None) -> str:
+    """Serialize the settings (default: config.current()) which affect the
+    output of mode"""
+    def encode(value):
+        if isinstance(value, config.Settings):
+            return {name:getattr(value, name) for name in OUTPUT_SETTINGS}
+        return getattr(value, 'nickname', str(value))
+    if settings is None:
+        settings = config.current()
+    key = encode(settings)
+    key['mode'] = mode
+    return json.dumps(key, sort_keys=True, default=encode)
+
+
+def has_comment(path) -> bool:
+    """Whether path is a zip whose comment says reCBZ wrote it"""
+    try:
+        with ZipFile(path) as archive:
+            return archive.comment == str.encode(config.ZIPCOMMENT)
+    except (BadZipFile, OSError):
+        return False
+
+
+class Manifest:
+    """Record of the files previously repacked, and the settings used.
+    Files are identified by path, size and mtime, falling back to a hash of
+    their contents when only the mtime or path differ. Hashing means reading
+    every file in full, so unless hashing is set, files are only hashed if
+    lookup needed it anyway"""
+    def __init__(self, db_path=None, hashing=True):
+        self.hashing = hashing
+        # path -> (size, mtime_ns, hash), so a file is read at most once
+        self._hashes = {}
+        self.db_path = Path(db_path or default_path())
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.db_path), timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _hash(self, path:Path, stat) -> str:
+        cached = self._hashes.get(path)
+        if cached is None or cached[:2] != (stat.st_size, stat.st_mtime_ns):
+            cached = (stat.st_size, stat.st_mtime_ns, file_hash(path))
+            self._hashes[path] = cached
+        return cached[2]
+
+    def lookup(self, path):
+        """Row of an unchanged file at path, if there is one"""
+        path = Path(path).resolve()
+        stat = path.stat()
+        row = self.db.execute('SELECT * FROM files WHERE path = ?',
+                              (str(path),)).fetchone()
+        if row is not None and row['size'] == stat.st_size:
+            if row['mtime_ns'] == stat.st_mtime_ns:
+                if row['hash']:
+                    self._hashes[path] = (stat.st_size, stat.st_mtime_ns, row['hash'])
+                return row
+            elif row['hash'] and row['hash'] == self._hash(path, stat): # touched, but not modified
+                with self.db:
+                    self.db.execute('UPDATE files SET mtime_ns = ? WHERE path = ?',
+                                    (stat.st_mtime_ns, str(path)))
+                return row
+            return None
+        # moved or renamed. only read the file if something could match
+        candidates = self.db.execute("SELECT * FROM files WHERE size = ? AND hash != ''",
+                                     (stat.st_size,)).fetchall()
+        if len(candidates) == 0:
+            return None
+        digest = self._hash(path, stat)
+        for candidate in candidates:
+            if candidate['hash'] == digest:
+                return candidate
+        return None
+
+    def is_current(self, path, settings:str) -> bool:
+        """Whether path was written by reCBZ, or already repacked with
+        settings. Files unknown to the manifest count if their zip comment
+        says they were repacked, as before it existed"""
+        row = self.lookup(path)
+        if row is None:
+            return has_comment(path)
+        if row['role'] == 'output' and row['source'] != row['path']:
+            return True # never repack our own output, whatever its settings
+        return row['settings'] == settings
+
+    def record(self, source, outputs, settings:str, seconds:float) -> None:
+        """Record that source was repacked into outputs"""
+        source = Path(source).resolve()
+        outputs = [Path(output).resolve() for output in outputs]
+        now = time.time()
+        def digest(path, stat) -> str:
+            # empty: only matched by path, size and mtime
+            if self.hashing or path in self._hashes:
+                return self._hash(path, stat)
+            return ''
+        rows = []
+        for output in outputs:
+            stat = output.stat()
+            rows.append((str(output), stat.st_size, stat.st_mtime_ns,
+                         digest(output, stat), 'output', settings, str(source),
+                         stat.st_size, seconds, now))
+        if source not in outputs and source.exists(): # not overwritten
+            stat = source.stat()
+            out_size = sum(row[1] for row in rows)
+            rows.append((str(source), stat.st_size, stat.st_mtime_ns,
+                         digest(source, stat), 'source', settings, None,
+                         out_size, seconds, now))
+        for path in outputs + [source]:
+            self._hashes.pop(path, None)
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES '
+                                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
@@ -0,0 +1,177 @@
+import heapq
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# slowest pages kept for the report
+OUTLIERS = 10
+# stages timed inside workers, in the order they happen
+PAGE_STAGES = ('open', 'decode', 'transform', 'encode', 'metric', 'save')
+
+_collector = None
+
+
+class Laps:
+    """Split a worker's time on a page into stages. Cheap enough to always
+    run, results travel back with the page"""
+    def __init__(self):
+        self.timings = {}
+        self.last = time.perf_counter()
+
+    def lap(self, stage:str) -> None:
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self.last
+        self.last = now
+
+
+class Collector:
+    """Timings and sizes, aggregated across books and workers. Thread safe,
+    as compute_fmt_sizes converts each format from its own thread"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_t = time.perf_counter()
+        self.stages = {} # name: [count, seconds]
+        self.formats = {} # 'png -> jpeg': [pages, bytes in, bytes out, seconds]
+        self.pages = {} # task: [pages, failed]
+        self.slowest = [] # heap of (seconds, seq, book, page, timings)
+        self.pool = {'maps':0, 'tasks':0, 'busy':0.0, 'capacity':0.0}
+        self.workers = {} # pid: busy seconds
+
+    def add_stage(self, name:str, seconds:float, count:int=1) -> None:
+        with self.lock:
+            entry = self.stages.setdefault(name, [0, 0.0])
+            entry[0] += count
+            entry[1] += seconds
+
+    def add_page(self, task:str, book:str, name:str, info:dict) -> None:
+        with self.lock:
+            counts = self.pages.setdefault(task, [0, 0])
+            if 'timings' not in info: # couldn't be opened
+                counts[1] += 1
+                return
+            counts[0] += 1
+            timings = info['timings']
+            seconds = sum(timings.values())
+            for stage in PAGE_STAGES:
+                if stage in timings:
+                    entry = self.stages.setdefault(f'page.{stage}', [0, 0.0])
+                    entry[0] += 1
+                    entry[1] += timings[stage]
+            key = f"{info['fmt_in']} -> {info['fmt_out']}"
+            entry = self.formats.setdefault(key, [0, 0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += info['bytes_in']
+            entry[2] += info['bytes_out']
+            entry[3] += seconds
+            item = (seconds, sum(counts), book, name, timings)
+            if len(self.slowest) < OUTLIERS:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+
+    def add_map(self, processes:int, wall:float, busy:list) -> None:
+        """busy is a (pid, seconds) pair for each task of a pool map"""
+        with self.lock:
+            self.pool['maps'] += 1
+            self.pool['tasks'] += len(busy)
+            self.pool['capacity'] += processes * wall
+            for pid, seconds in busy:
+                self.pool['busy'] += seconds
+                self.workers[pid] = self.workers.get(pid, 0.0) + seconds
+
+    def report(self) -> dict:
+        with self.lock:
+            pool = dict(self.pool)
+            pool['utilization'] = (round(pool['busy'] / pool['capacity'], 3)
+                                   if pool['capacity'] > 0 else None)
+            pool['workers'] = len(self.workers)
+            return {
+                'seconds':round(time.perf_counter() - self.start_t, 3),
+                'stages':{name:{'count':count, 'seconds':round(seconds, 4)}
+                          for name, (count, seconds) in self.stages.items()},
+                'pages':{task:{'converted':done, 'failed':failed}
+                         for task, (done, failed) in self.pages.items()},
+                'formats':{key:{'pages':pages, 'bytes_in':bytes_in,
+                                'bytes_out':bytes_out,
+                                'seconds':round(seconds, 4)}
+                           for key, (pages, bytes_in, bytes_out, seconds)
+                           in self.formats.items()},
+                'pool':{key:round(val, 4) if isinstance(val, float) else val
+                        for key, val in pool.items()},
+                'outliers':[{'book':book, 'page':name,
+                             'seconds':round(seconds, 4),
+                             'stages':{stage:round(val, 4)
+                                       for stage, val in timings.items()}}
+                            for seconds, seq, book, name, timings
+                            in sorted(self.slowest, reverse=True)]}
+
+    def write(self, path) -> None:
+        """Write the report as JSON, or as CSV if path ends in .csv"""
+        report = self.report()
+        if str(path).lower().endswith('.csv'):
+            import csv
+            with open(path, 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(('section', 'name', 'count', 'seconds',
+                                 'bytes_in', 'bytes_out'))
+                writer.writerow(('total', '', '', report['seconds'], '', ''))
+                for name, entry in report['stages'].items():
+                    writer.writerow(('stage', name, entry['count'],
+                                     entry['seconds'], '', ''))
+                for key, entry in report['formats'].items():
+                    writer.writerow(('format', key, entry['pages'],
+                                     entry['seconds'], entry['bytes_in'],
+                                     entry['bytes_out']))
+                pool = report['pool']
+                writer.writerow(('pool', f"utilization {pool['utilization']}",
+                                 pool['tasks'], pool['busy'], '', ''))
+                for outlier in report['outliers']:
+                    writer.writerow(('outlier',
+                                     f"{outlier['book']}/{outlier['page']}",
+                                     1, outlier['seconds'], '', ''))
+        else:
+            import json
+            with open(path, 'w') as file:
+                json.dump(report, file, indent=2)
+                file.write('\n')
+
+
+def start() -> Collector:
+    """Start collecting metrics in this process"""
+    global _collector
+    _collector = Collector()
+    return _collector
+
+
+def active():
+    """The running Collector, or None"""
+    return _collector
+
+
+@contextmanager
+def stage(name:str):
+    """Time a stage which runs in this process, e.g. writing the zip"""
+    if _collector is None:
+        yield
+        return
+    start_t = time.perf_counter()
+    try:
+        yield
+    finally:
+        _collector.add_stage(name, time.perf_counter() - start_t)
+
+
+def record_pages(task:str, book, results) -> None:
+    """Add the worker results of a conversion, (success, page, info) tuples"""
+    if _collector is None:
+        return
+    for success, page, info in results:
+        _collector.add_page(task, str(book), info.get('page', page.name), info)
+
+
+def timed_call(func, task) -> tuple:
+    # runs in the worker, see util.map_workers
+    start_t = time.perf_counter()
+    result = func(task)
+    return result, os.getpid(), time.perf_counter() - start_t
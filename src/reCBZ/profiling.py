@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+WORKER_GLOB = 'worker-*.prof'
+MERGED_NAME = 'workers.prof'
+COLLAPSED_NAME = 'workers.collapsed'
+# collapsed stacks: deepest stack, and smallest share of the total time kept
+MAX_DEPTH = 64
+MIN_SHARE = 0.001
+# seconds between saves of what a worker's profiler has gathered
+DUMP_INTERVAL = 5.0
+
+# [profiler, directory, last saved] of each thread in this process
+_profilers = {}
+
+
+def profiled_call(func, directory:str, task):
+    """Run func(task) under this process's profiler. What it has gathered is
+    saved every DUMP_INTERVAL, and when the worker exits, see dump_all"""
+    import cProfile
+    key = (os.getpid(), threading.get_ident())
+    entry = _profilers.get(key)
+    if entry is None:
+        entry = _profilers[key] = [cProfile.Profile(), directory, time.monotonic()]
+    entry[0].enable()
+    try:
+        return func(task)
+    finally:
+        entry[0].disable()
+        if time.monotonic() - entry[2] >= DUMP_INTERVAL:
+            _dump(key)
+
+
+def _dump(key:tuple) -> None:
+    profiler, directory, last = _profilers[key]
+    profiler.dump_stats(str(Path(directory) / f'worker-{key[0]}-{key[1]}.prof'))
+    _profilers[key][2] = time.monotonic()
+
+
+def dump_all() -> None:
+    """Save what every profiler of this process has gathered. Pool workers
+    exit without running atexit handlers, see util.init_pool"""
+    for key in list(_profilers):
+        if key[0] == os.getpid(): # not inherited from our parent
+            _dump(key)
+
+
+def prepare(directory) -> None:
+    """Create directory, remove worker profiles left by previous runs"""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for path in directory.glob(WORKER_GLOB):
+        path.unlink()
+
+
+def _label(func:tuple) -> str:
+    filename, line, name = func
+    if filename == '~': # builtin
+        label = name
+    else:
+        label = f'{name} ({Path(filename).name}:{line})'
+    return label.replace(';', ',')
+
+
+def collapsed(stats) -> list:
+    """Stacks of stats as 'root;caller;callee microseconds' lines, for
+    flamegraph.pl, speedscope, etc. cProfile only records direct callers, so
+    time is split between the paths to a function in proportion to how much
+    of it each direct caller accounts for"""
+    entries = stats.stats # func: (cc, nc, tt, ct, callers)
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in entries.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    total = sum(entry[2] for entry in entries.values())
+    min_time = total * MIN_SHARE
+    weights = {}
+
+    def walk(func, path:tuple, share:float):
+        path = path + (func,)
+        tt, ct = entries[func][2], entries[func][3]
+        stack = ';'.join(_label(item) for item in path)
+        weights[stack] = weights.get(stack, 0.0) + tt * share
+        if len(path) >= MAX_DEPTH:
+            return
+        for child, edge_ct in callees.get(func, ()):
+            child_ct = entries[child][3]
+            if child in path or child_ct <= 0:
+                continue
+            child_share = edge_ct * share / child_ct
+            if child_ct * child_share >= min_time:
+                walk(child, path, child_share)
+
+    for func, entry in entries.items():
+        if not entry[4] and entry[3] >= min_time: # not called by anything
+            walk(func, (), 1.0)
+    return [f'{stack} {round(weight * 1e6)}'
+            for stack, weight in sorted(weights.items()) if weight * 1e6 >= 1]
+
+
+def merge(directory):
+    """Merge worker profiles in directory into a single pstats file, and a
+    collapsed stacks file. Returns the path of the former, None if there
+    was nothing to merge"""
+    import pstats
+    dump_all() # tasks run in this process, without a pool
+    directory = Path(directory)
+    paths = sorted(directory.glob(WORKER_GLOB))
+    if len(paths) == 0:
+        return None
+    stats = pstats.Stats(str(paths[0]))
+    for path in paths[1:]:
+        stats.add(str(path))
+    merged = directory / MERGED_NAME
+    stats.dump_stats(str(merged))
+    lines = collapsed(stats)
+    (directory / COLLAPSED_NAME).write_text('\n'.join(lines) + '\n')
+    return merged
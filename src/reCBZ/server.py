@@ -0,0 +1,283 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import reCBZ
+import reCBZ.config as config
+from reCBZ import wrappers, manifest, metrics, profiling
+from reCBZ.util import mylog, warm_pool
+
+# options a job may change. the rest belong to the server
+JOB_OPTIONS = (tuple(key for key in config._cfg['archive']
+                     if key != 'ebook_profile') +
+               tuple(config._cfg['image']) +
+               ('no_write', 'ignore_page_err', 'samples_count', 'min_savings',
+                'quality_metric', 'quality_floor'))
+JOB_MODES = (None, 'auto')
+# names the server may be reached by, besides the address it's bound to.
+# anything else in Host or Origin is a page in a browser (DNS rebinding)
+LOOPBACK_NAMES = ('localhost', '127.0.0.1', '[::1]')
+
+
+def job_settings(options:dict, base) -> tuple:
+    """Validate the options of a job, return its mode and its Settings, those
+    of base with options applied"""
+    options = dict(options)
+    mode = options.pop('mode', None)
+    if mode not in JOB_MODES:
+        raise ValueError(f"Invalid mode '{mode}'")
+    settings = {}
+    profile = options.pop('profile', None)
+    if profile is not None:
+        settings.update(config.profile_settings(str(profile).upper(),
+                                                base.blacklisted_fmts))
+    for key, val in options.items():
+        if key not in JOB_OPTIONS:
+            raise ValueError(f"Invalid option '{key}'")
+        default = getattr(base, key)
+        if isinstance(default, (list, tuple)):
+            valid = isinstance(val, list) and len(val) == len(default)
+        elif isinstance(default, float):
+            valid = type(val) in (int, float)
+        else:
+            valid = type(val) is type(default)
+        if not valid:
+            raise ValueError(f"Invalid value for '{key}': {val!r}")
+        settings[key] = type(default)(val)
+    return mode, base.replace(**settings)
+
+
+class JobQueue:
+    """Jobs submitted to the server, run by run(). Each has its own Settings,
+    based on base, so they can run side by side"""
+    def __init__(self, base, max_queued:int=64, workers:int=1):
+        self.base = base
+        self.workers = workers
+        self.pending = queue.Queue(maxsize=max_queued)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+    def submit(self, path:str, options:dict) -> dict:
+        """Queue a job. Raises ValueError for invalid requests, queue.Full
+        when too many are waiting"""
+        if not Path(path).is_file():
+            raise ValueError(f"'{path}': no such file")
+        mode, settings = job_settings(options, self.base)
+        with self.lock:
+            job = {'id':self.next_id, 'path':str(Path(path).resolve()),
+                   'options':options, 'status':'queued', 'outputs':[],
+                   'stats':{}, 'error':None, 'submitted':time.time()}
+            self.pending.put_nowait((job, mode, settings))
+            self.jobs[job['id']] = job
+            self.next_id += 1
+        return self.view(job['id'])
+
+    def view(self, job_id:int):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def all(self) -> list:
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def stop(self) -> None:
+        for i in range(self.workers):
+            self.pending.put(None)
+
+    def _update(self, job:dict, **fields) -> None:
+        with self.lock:
+            job.update(fields)
+
+    def run(self) -> None:
+        """Run up to workers jobs at a time, until stop() is called"""
+        runners = [threading.Thread(target=self._runner, daemon=True)
+                   for i in range(self.workers)]
+        for runner in runners:
+            runner.start()
+        for runner in runners:
+            runner.join()
+
+    def _runner(self) -> None:
+        # sqlite connections can't be shared between threads
+        records = None
+        if config.manifest:
+            try: # jobs never consult it, no need to hash what's recorded
+                records = manifest.Manifest(config.manifest_path or None, hashing=False)
+            except (sqlite3.Error, OSError) as err:
+                print(f'{reCBZ.CMDNAME}: manifest: {err}, continuing without it')
+        try:
+            while True:
+                item = self.pending.get()
+                if item is None:
+                    break
+                self._run_job(*item, records)
+        finally:
+            if records is not None:
+                records.close()
+
+    def _run_job(self, job:dict, mode, settings, records) -> None:
+        self._update(job, status='running')
+        start_t = time.perf_counter()
+        try:
+            source_size = Path(job['path']).stat().st_size
+            status, new_fps = wrappers.process_archive(job['path'], mode,
+                                                       records, settings)
+        except Exception as err: # report it, keep serving
+            self._update(job, status='failed', error=repr(err))
+            return
+        new_fps = [str(Path(new_fp).resolve()) for new_fp in new_fps]
+        stats = {'source_size':source_size,
+                 'new_size':sum(Path(new_fp).stat().st_size for new_fp in new_fps),
+                 'seconds':round(time.perf_counter() - start_t, 3)}
+        status = {'aborted':'failed'}.get(status, status)
+        self._update(job, status=status, outputs=new_fps, stats=stats)
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """GET /jobs, /jobs/ID, /jobs/ID/outputs/N, /metrics. POST /jobs with
+    {"path": ..., "options": {...}}"""
+    server_version = f'reCBZ/{reCBZ.__version__}'
+
+    def log_message(self, format, *args):
+        mylog(f'serve: {self.address_string()} {format % args}')
+
+    def send_json(self, code:int, obj) -> None:
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, code:int, message:str) -> None:
+        self.send_json(code, {'error':message})
+
+    def check_origin(self) -> bool:
+        """Refuse requests made by web pages rather than local clients. Host
+        must name the server, and Origin, which browsers send with
+        cross-site requests, too"""
+        host = self.headers.get('Host')
+        origin = self.headers.get('Origin')
+        if host not in self.server.allowed_hosts or (
+                origin is not None and
+                origin.removeprefix('http://') not in self.server.allowed_hosts):
+            self.send_error_json(HTTPStatus.FORBIDDEN, 'forbidden host or origin')
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.check_origin():
+            return
+        jobs = self.server.jobs
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        if parts == []:
+            self.send_json(HTTPStatus.OK, {'version':reCBZ.__version__,
+                                           'queued':jobs.pending.qsize()})
+            return
+        if parts == ['metrics'] and metrics.active() is not None:
+            self.send_json(HTTPStatus.OK, metrics.active().report())
+            return
+        if parts[0] != 'jobs':
+            self.send_error_json(HTTPStatus.NOT_FOUND, 'not found')
+            return
+        if len(parts) == 1:
+            self.send_json(HTTPStatus.OK, jobs.all())
+            return
+        job = jobs.view(int(parts[1])) if parts[1].isdigit() else None
+        if job is None:
+            self.send_error_json(HTTPStatus.NOT_FOUND, 'no such job')
+        elif len(parts) == 2:
+            self.send_json(HTTPStatus.OK, job)
+        elif len(parts) == 4 and parts[2] == 'outputs' and parts[3].isdigit() \
+                and int(parts[3]) < len(job['outputs']):
+            self.send_file(Path(job['outputs'][int(parts[3])]))
+        else:
+            self.send_error_json(HTTPStatus.NOT_FOUND, 'not found')
+
+    def send_file(self, path:Path) -> None:
+        try:
+            size = path.stat().st_size
+            file = open(path, 'rb')
+        except OSError:
+            self.send_error_json(HTTPStatus.GONE, 'output no longer exists')
+            return
+        with file:
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size))
+            self.send_header('Content-Disposition',
+                             f'attachment; filename="{path.name}"')
+            self.end_headers()
+            while chunk := file.read(1 << 20):
+                self.wfile.write(chunk)
+
+    def do_POST(self):
+        if not self.check_origin():
+            return
+        if self.path.rstrip('/') != '/jobs':
+            self.send_error_json(HTTPStatus.NOT_FOUND, 'not found')
+            return
+        # forms can't send it, so cross-site requests can't skip the checks
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.split(';')[0].strip().lower() != 'application/json':
+            self.send_error_json(HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+                                 'expected application/json')
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            options = request.get('options', {})
+            if not isinstance(request['path'], str) or not isinstance(options, dict):
+                raise ValueError('path must be a string, options an object')
+            job = self.server.jobs.submit(request['path'], options)
+        except (ValueError, KeyError, TypeError, AttributeError) as err:
+            self.send_error_json(HTTPStatus.BAD_REQUEST, str(err))
+        except queue.Full:
+            self.send_error_json(HTTPStatus.SERVICE_UNAVAILABLE, 'queue is full')
+        else:
+            self.send_json(HTTPStatus.ACCEPTED, job)
+
+
+def make_server(host:str, port:int, jobs:JobQueue) -> ThreadingHTTPServer:
+    """HTTP server for jobs. Port 0 picks a free one"""
+    httpd = ThreadingHTTPServer((host, port), JobHandler)
+    httpd.daemon_threads = True
+    httpd.jobs = jobs
+    port = httpd.server_address[1]
+    names = (f'[{host}]' if ':' in host else host, *LOOPBACK_NAMES)
+    httpd.allowed_hosts = {f'{name}:{port}' for name in names}
+    return httpd
+
+
+def serve(host:str, port:int) -> None:
+    """Serve the job API until interrupted"""
+    # start the pool before any threads, so workers are forked from a
+    # single threaded process
+    if config.metrics_file:
+        metrics.start()
+    if config.profile_workers:
+        profiling.prepare(config.profile_workers)
+    with warm_pool():
+        jobs = JobQueue(config.current(), config.serve_queue,
+                        config.serve_jobs)
+        httpd = make_server(host, port, jobs)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        host, port = httpd.server_address[:2]
+        print(f'[i] Serving on http://{host}:{port}, press Ctrl+C to stop')
+        try:
+            jobs.run()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            if config.metrics_file:
+                metrics.active().write(config.metrics_file)
+            if config.profile_workers:
+                profiling.merge(config.profile_workers)
@@ -0,0 +1,101 @@
+"""Objective image metrics, computed on luminance"""
+import math
+
+import numpy as np
+from PIL import Image
+
+# https://en.wikipedia.org/wiki/Structural_similarity
+SSIM_WINDOW:int = 7
+SSIM_C1:float = (0.01 * 255) ** 2
+SSIM_C2:float = (0.03 * 255) ** 2
+# metrics are computed this many rows at a time, so memory doesn't grow with
+# the page
+STRIP_ROWS:int = 256
+# complexity is estimated on a thumbnail no larger than this
+THUMB_SIZE:int = 512
+# neighbouring pixels differing by more than this are considered an edge
+EDGE_THRESHOLD:int = 24
+# edge density at which a page is considered as detailed as it gets. dense
+# screentone is around 0.3, flat pages with dialogue are usually below 0.05
+EDGE_SATURATION:float = 0.3
+
+
+def _luma(img:Image.Image) -> np.ndarray:
+    return np.asarray(img.convert('L'))
+
+
+def _box_mean(arr:np.ndarray, win:int) -> np.ndarray:
+    # mean of every win x win window, via a summed-area table
+    table = np.pad(arr, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+    total = (table[win:, win:] - table[:-win, win:]
+             - table[win:, :-win] + table[:-win, :-win])
+    return total / (win * win)
+
+
+def complexity(img:Image.Image) -> float:
+    """Estimate how detailed an image is from its edge density, 0 to 1"""
+    thumb = img.convert('L')
+    # nearest neighbour doesn't average away high frequency detail, such as
+    # screentone, it aliases it instead
+    thumb.thumbnail((THUMB_SIZE, THUMB_SIZE), Image.Resampling.NEAREST)
+    arr = np.asarray(thumb, dtype=np.int16)
+    if min(arr.shape) < 2:
+        return 0.0
+    grad_x = np.abs(np.diff(arr, axis=1))[:-1, :]
+    grad_y = np.abs(np.diff(arr, axis=0))[:, :-1]
+    density = float(np.mean(np.maximum(grad_x, grad_y) > EDGE_THRESHOLD))
+    return min(density / EDGE_SATURATION, 1.0)
+
+
+def dhash(img:Image.Image) -> int:
+    """64 bit difference hash. Survives re-encoding and rescaling, so
+    nearly identical images differ by only a few bits"""
+    # let the decoder skip most of the work where it can (JPEG)
+    img.draft('L', (64, 64))
+    thumb = img.convert('L').resize((9, 8), Image.Resampling.BILINEAR)
+    arr = np.asarray(thumb, dtype=np.int16)
+    bits = (arr[:, 1:] > arr[:, :-1]).flatten()
+    return sum(1 << i for i, bit in enumerate(bits) if bit)
+
+
+def ssim(reference:Image.Image, new:Image.Image) -> float:
+    """Mean structural similarity, 0 to 1. 1 means identical. Both images must
+    have the same dimensions"""
+    luma_x = _luma(reference)
+    luma_y = _luma(new)
+    win = min(SSIM_WINDOW, *luma_x.shape)
+    windows = luma_x.shape[0] - win + 1
+    total = 0.0
+    for start in range(0, windows, STRIP_ROWS):
+        # rows of every window starting in this strip
+        stop = min(start + STRIP_ROWS, windows) + win - 1
+        x = luma_x[start:stop].astype(np.float64)
+        y = luma_y[start:stop].astype(np.float64)
+        mu_x = _box_mean(x, win)
+        mu_y = _box_mean(y, win)
+        var_x = _box_mean(x * x, win) - mu_x * mu_x
+        var_y = _box_mean(y * y, win) - mu_y * mu_y
+        cov_xy = _box_mean(x * y, win) - mu_x * mu_y
+        num = (2 * mu_x * mu_y + SSIM_C1) * (2 * cov_xy + SSIM_C2)
+        den = (mu_x * mu_x + mu_y * mu_y + SSIM_C1) * (var_x + var_y + SSIM_C2)
+        total += float(np.sum(num / den))
+    return total / (windows * (luma_x.shape[1] - win + 1))
+
+
+def psnr(reference:Image.Image, new:Image.Image) -> float:
+    """Peak signal-to-noise ratio in dB. inf means identical. Both images must
+    have the same dimensions"""
+    luma_x = _luma(reference)
+    luma_y = _luma(new)
+    squared = 0
+    for start in range(0, luma_x.shape[0], STRIP_ROWS):
+        diff = (luma_x[start:start + STRIP_ROWS].astype(np.int32)
+                - luma_y[start:start + STRIP_ROWS])
+        squared += int(np.sum(diff * diff))
+    mse = squared / luma_x.size
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+MetricDict = {'ssim':ssim, 'psnr':psnr}
@@ -1,19 +1,36 @@
+import os
 import textwrap
 import signal
 import platform
+import shutil
+import time
 from re import split
-from multiprocessing import Pool
-from multiprocessing.pool import ThreadPool
-from functools import wraps
+from pathlib import Path
+from functools import wraps, partial
+from contextlib import contextmanager
 
 import reCBZ.config as config
+from reCBZ import metrics, profiling
+
+
+# long-lived process pool, see warm_pool()
+_pool = None
+# where books being converted claim cache space, in the cache root, and
+# seconds between checks while waiting for it. see reserve_cache()
+CLAIMS_DIR = 'reCBZCLAIMS'
+CACHE_POLL = 1.0
+# seconds between progress updates, when overwriting the line / streaming
+PROGRESS_INTERVAL = 0.2
+PROGRESS_INTERVAL_STREAM = 2.0
 
 
 class MPrunnerInterrupt(KeyboardInterrupt):
     """KeyboardInterrupt gracefully caught in MP_runner, please catch me"""
 
 
-def shorten(*args, width=config.term_width()) -> str:
+def shorten(*args, width:int=None) -> str:
+    if width is None:
+        width = config.term_width()
     text = ' '.join(args)
     return textwrap.shorten(text, width=width, placeholder='...')
 
@@ -59,6 +76,173 @@ def human_bytes(b:float) -> str:
     return f"{b:.2f}Y{suffix}"
 
 
+def parse_ratio(text:str) -> float:
+    """Convert a percentage or fraction to a fraction: '10%', '0.1' -> 0.1"""
+    text = str(text).strip()
+    try:
+        if text.endswith('%'):
+            return float(text[:-1]) / 100
+        else:
+            return float(text)
+    except ValueError:
+        raise ValueError(f"Invalid ratio '{text}'")
+
+
+def parse_size(text:str, base:int) -> int:
+    """Convert a human readable size to bytes: '80M', '512K', '1.5G', '1000'.
+    A ratio ('0.5', '50%') is relative to base"""
+    text = text.strip().upper().rstrip('B')
+    units = {'K':1024, 'M':1024**2, 'G':1024**3, 'T':1024**4}
+    if text.endswith('%'):
+        return int(base * parse_ratio(text))
+    try:
+        if text[-1:] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        elif float(text) <= 1:
+            return int(base * float(text))
+        else:
+            return int(float(text))
+    except ValueError:
+        raise ValueError(f"Invalid size '{text}'")
+
+
+def _claim_outstanding(claim) -> int:
+    # bytes claimed by a book which it hasn't written yet. None if its process
+    # is gone, e.g. killed before cleaning up
+    try:
+        pid, nbytes, cachedir = claim.read_text().split(' ', 2)
+        pid, nbytes = int(pid), int(nbytes)
+    except (OSError, ValueError): # removed meanwhile, or not ours to read
+        return 0
+    if platform.system() != 'Windows': # where kill() terminates it
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError: # alive, but another user's
+            pass
+    cachedir = Path(cachedir)
+    used = 0
+    for directory in (cachedir, *cachedir.parent.glob(f'{cachedir.name}_*')):
+        for path in directory.rglob('*'):
+            try:
+                if path.is_file():
+                    used += path.stat().st_size
+            except OSError: # removed meanwhile
+                pass
+    return max(0, nbytes - used)
+
+
+def _claims_dir() -> Path:
+    # shared by every user of the cache root, like /tmp itself. the sticky
+    # bit keeps them from removing each other's claims
+    claims_dir = config.cache_root() / CLAIMS_DIR
+    try:
+        claims_dir.mkdir()
+        claims_dir.chmod(0o1777)
+    except FileExistsError:
+        pass
+    return claims_dir
+
+
+def reserve_cache(cachedir, nbytes:int):
+    """Wait until nbytes fit on the cache's disk, leaving cache_min_free, and
+    what other books being converted have claimed but not used. Then claim
+    them for cachedir. A book never waits on a cache no other book is using,
+    so one always proceeds. Returns the claim, see release_cache"""
+    if not config.cache_min_free:
+        return None
+    try:
+        claims_dir = _claims_dir()
+    except OSError as err:
+        mylog(f"cache: can't claim space: {err}")
+        return None
+    claim = claims_dir / f'{os.getpid()}_{Path(cachedir).name}'
+    waiting = False
+    while True:
+        usage = shutil.disk_usage(claims_dir)
+        min_free = parse_size(config.cache_min_free, usage.total)
+        others = []
+        for other in claims_dir.iterdir():
+            if other == claim or other.suffix == '.tmp': # ours, or being written
+                continue
+            outstanding = _claim_outstanding(other)
+            if outstanding is not None:
+                others.append(outstanding)
+                continue
+            try:
+                other.unlink(missing_ok=True)
+            except OSError: # another user's, left for them
+                pass
+        if usage.free - sum(others) - nbytes >= min_free:
+            break
+        elif len(others) == 0:
+            if config.loglevel >= 0:
+                print(f'[!] Cache: {human_bytes(nbytes)} needed, '
+                      f'{human_bytes(max(0, usage.free - min_free))} to spare')
+            break
+        if not waiting and config.loglevel >= 0:
+            print(f'[i] Cache: waiting for {human_bytes(nbytes)} to free up')
+        waiting = True
+        time.sleep(CACHE_POLL)
+    # written whole, so others never read half of it
+    partial_claim = claim.with_suffix('.tmp')
+    try:
+        partial_claim.write_text(f'{os.getpid()} {nbytes} {cachedir}')
+        os.replace(partial_claim, claim)
+    except OSError as err:
+        mylog(f"cache: can't claim space: {err}")
+        return None
+    return claim
+
+
+def release_cache(claim) -> None:
+    if claim is not None:
+        try:
+            claim.unlink(missing_ok=True)
+        except OSError as err:
+            mylog(f"cache: can't release claim: {err}")
+
+
+class Progress:
+    """Progress of a map_workers call, rendered by the parent as results
+    come in, rather than printed by each worker. saved(result) -> bytes saved
+    by a single task, optional"""
+    def __init__(self, label:str, total:int, saved=None):
+        self.label = label
+        self.total = total
+        self.saved = saved
+        self.done = 0
+        self.saved_bytes = 0
+        self.start_t = time.perf_counter()
+        self.shown_t = 0.0
+        if config.loglevel == 1:
+            self.interval = PROGRESS_INTERVAL_STREAM
+        else:
+            self.interval = PROGRESS_INTERVAL
+
+    def update(self, result) -> None:
+        self.done += 1
+        if self.saved is not None:
+            self.saved_bytes += self.saved(result)
+        now = time.perf_counter()
+        if now - self.shown_t >= self.interval or self.done == self.total:
+            self.shown_t = now
+            self.show(now - self.start_t)
+
+    def show(self, elapsed:float) -> None:
+        if config.loglevel not in (0, 1):
+            return
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        msg = f'{self.label}: {self.done}/{self.total}, {rate:.1f}/s'
+        if 0 < self.done < self.total and rate > 0:
+            msg += f', ETA {(self.total - self.done) / rate:.0f}s'
+        if self.saved is not None:
+            sign = '-' if self.saved_bytes < 0 else ''
+            msg += f', saved {sign}{human_bytes(abs(self.saved_bytes))}'
+        mylog(msg, progress=True)
+
+
 def pct_change(base:float, new:float) -> str:
     diff = new - base
     pct_change = diff / base * 100
@@ -79,6 +263,9 @@ def init_pool():
     global default_sigint_handler
     ctrl_c_entered = False
     default_sigint_handler = signal.signal(signal.SIGINT, pool_CTRL_C_handler)
+    # workers which exit when the pool is closed run these, unlike atexit
+    from multiprocessing.util import Finalize
+    Finalize(None, profiling.dump_all, exitpriority=10)
 
 
 def worker_sigint_CTRL_C(func):
@@ -103,15 +290,102 @@ def worker_sigint_CTRL_C(func):
     return wrapper
 
 
-def map_workers(func, tasks, multithread=False):
+@contextmanager
+def warm_pool():
+    """Reuse a single process pool for every map_workers call made within,
+    rather than spawning one for each. Must be entered after config is set,
+    as workers keep the config they were forked with"""
+    from multiprocessing import Pool
+    global _pool
+    if config.pcount() == 1:
+        yield
+        return
+    with Pool(processes=config.pcount(), initializer=init_pool) as MPpool:
+        _pool = MPpool
+        try:
+            yield
+        finally:
+            _pool = None
+        # let workers exit on their own, rather than being terminated
+        MPpool.close()
+        MPpool.join()
+
+
+def map_workers(func, tasks, multithread=False, progress:str=None, saved=None,
+                each=None):
+    """list(map(func, tasks)), over processes or threads. If progress is
+    given, it's shown as a label alongside the aggregate progress, see
+    Progress. each(i, result) is called in this process as soon as the
+    result of tasks[i] arrives"""
+    callback = None
+    if progress is not None or each is not None:
+        if progress is not None:
+            progress = Progress(progress, len(tasks), saved)
+        def callback(i, result):
+            if progress is not None:
+                progress.update(result)
+            if each is not None:
+                each(i, result)
+    if config.profile_workers and not multithread:
+        # threads only wait on processes, see compute_fmt_sizes
+        func = partial(profiling.profiled_call, func, config.profile_workers)
+    collector = metrics.active()
+    pcount = min(len(tasks), config.pcount())
+    if collector is None or pcount == 1 or multithread:
+        return _map_workers(func, tasks, multithread, callback)
+    # time each task in its worker, to tell how busy the pool was kept
+    start_t = time.perf_counter()
+    results = _map_workers(partial(metrics.timed_call, func), tasks,
+                           callback=callback and
+                           (lambda i, timed: callback(i, timed[0])))
+    collector.add_map(pcount, time.perf_counter() - start_t,
+                      [(pid, seconds) for result, pid, seconds in results])
+    return [result for result, pid, seconds in results]
+
+
+def _indexed_call(func, item) -> tuple:
+    i, task = item
+    return i, func(task)
+
+
+def _pool_map(pool, pcount:int, func, tasks, callback) -> list:
+    if callback is None:
+        return pool.map(func, tasks)
+    # results as they finish, so progress doesn't stall behind a slow task.
+    # in chunks, like map, so small pages aren't a round trip each
+    chunksize = max(1, len(tasks) // (pcount * 4))
+    results = [None] * len(tasks)
+    for i, result in pool.imap_unordered(partial(_indexed_call, func),
+                                         enumerate(tasks), chunksize):
+        results[i] = result
+        callback(i, result)
+    return results
+
+
+def _map_workers(func, tasks, multithread=False, callback=None):
+    from multiprocessing import Pool
+    from multiprocessing.pool import ThreadPool
     pcount = min(len(tasks), config.pcount())
-    if pcount == 1:
-        return map(func, tasks)
+    if pcount == 0: # e.g. every page was restored from the journal
+        return []
+    elif pcount == 1:
+        results = []
+        for i, task in enumerate(tasks):
+            results.append(func(task))
+            if callback is not None:
+                callback(i, results[-1])
+        return results
+    elif _pool is not None and not multithread:
+        try:
+            return _pool_map(_pool, config.pcount(), func, tasks, callback)
+        except KeyboardInterrupt:
+            _pool.terminate()
+            raise MPrunnerInterrupt()
     elif multithread:
         # mourn the day they inevitably condense the parallel modules in
         # python and I have to recall how any of this works
         with ThreadPool(processes=pcount) as Tpool:
-            return Tpool.map(func, tasks)
+            return _pool_map(Tpool, pcount, func, tasks, callback)
     else:
         if platform.system == 'windows':
             # this hangs on Unix, but prevents hanging on Windows (insanity)
@@ -119,9 +393,13 @@ def map_workers(func, tasks, multithread=False):
             signal.signal(signal.SIGINT, signal.SIG_IGN)
         with Pool(processes=pcount, initializer=init_pool) as MPpool:
             try:
-                return MPpool.map(func, tasks)
+                results = _pool_map(MPpool, pcount, func, tasks, callback)
             except KeyboardInterrupt:
                 mylog("MAY YOUR WOES BE MANY")
                 MPpool.terminate()
                 mylog("AND YOUR DAYS FEW")
                 raise MPrunnerInterrupt()
+            # let workers exit on their own, rather than being terminated
+            MPpool.close()
+            MPpool.join()
+            return results
@@ -0,0 +1,125 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from pathlib import Path
+
+import reCBZ.config as config
+from reCBZ.util import mylog
+
+ARCHIVE_EXTS = ('.cbz', '.zip', '.epub')
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify:
+    """Minimal inotify binding, reports files written to or moved into a
+    directory. Raises OSError where unavailable"""
+    def __init__(self, directory:Path):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError('libc not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            self.fd = libc.inotify_init1(IN_NONBLOCK)
+        except AttributeError:
+            raise OSError('inotify unavailable')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                    IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def changed(self, timeout:float) -> set:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        names = set()
+        offset = 0
+        while offset < len(buffer):
+            _, _, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class _Poller:
+    """Fallback for _Inotify, compares directory listings"""
+    def __init__(self, directory:Path):
+        self.directory = directory
+        self.listing = self.scan()
+
+    def scan(self) -> dict:
+        listing = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                listing[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return listing
+
+    def changed(self, timeout:float) -> set:
+        time.sleep(timeout)
+        listing = self.scan()
+        names = {name for name, stat in listing.items()
+                 if self.listing.get(name) != stat}
+        self.listing = listing
+        return names
+
+    def close(self) -> None:
+        pass
+
+
+def watch(directory:str, ignore=None):
+    """Yield archives written to directory from now on, once they've stopped
+    changing for watch_debounce seconds. Runs until interrupted.
+    ignore(path) -> bool filters out files, e.g. ones we wrote ourselves"""
+    directory = Path(directory).resolve()
+    try:
+        watcher = _Inotify(directory)
+        mylog(f'watch: inotify on {directory}')
+    except OSError as err:
+        watcher = _Poller(directory)
+        mylog(f'watch: {err}, polling {directory}')
+    pending = {} # path: (size, mtime, last change)
+    try:
+        while True:
+            for name in watcher.changed(config.watch_interval):
+                path = directory / name
+                if path.suffix.lower() in ARCHIVE_EXTS:
+                    pending[path] = None
+            now = time.monotonic()
+            for path, last in tuple(pending.items()):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError: # moved away or deleted
+                    del pending[path]
+                    continue
+                current = (stat.st_size, stat.st_mtime_ns)
+                if last is None or last[:2] != current:
+                    pending[path] = (*current, now)
+                elif now - last[2] >= config.watch_debounce:
+                    del pending[path]
+                    if ignore is None or not ignore(path):
+                        yield str(path)
+    finally:
+        watcher.close()
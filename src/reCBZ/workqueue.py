@@ -0,0 +1,305 @@
+import dataclasses
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from zipfile import ZipFile, BadZipFile
+
+import reCBZ.config as config
+from reCBZ import wrappers, journal
+from reCBZ.archive import index_members
+from reCBZ.profiles import ProfileDict
+from reCBZ.util import mylog, shorten, warm_pool
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    out_dir TEXT NOT NULL,
+    mode TEXT,
+    settings TEXT NOT NULL,
+    status TEXT NOT NULL,
+    outputs TEXT,
+    error TEXT,
+    submitted REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    book INTEGER NOT NULL REFERENCES books (id),
+    kind TEXT NOT NULL,
+    start INTEGER,
+    stop INTEGER,
+    status TEXT NOT NULL,
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);
+"""
+# a task which failed this many times is given up on, and so is its book
+MAX_ATTEMPTS = 3
+
+
+def dump_settings(settings) -> str:
+    def encode(value):
+        if isinstance(value, type): # a profile
+            return value.nickname
+        raise TypeError(f'{value!r} is not serializable')
+    fields = dataclasses.asdict(settings)
+    fields['targets'] = [(label, dataclasses.asdict(target))
+                         for label, target in settings.targets]
+    return json.dumps(fields, default=encode)
+
+
+def load_settings(text:str):
+    def decode(fields:dict):
+        if fields['ebook_profile'] is not None:
+            fields['ebook_profile'] = ProfileDict[fields['ebook_profile']]
+        return fields
+    fields = decode(json.loads(text))
+    targets = tuple((label, config.Settings(**decode(target)))
+                    for label, target in fields.pop('targets'))
+    return config.Settings(**fields, targets=targets)
+
+
+def chunkable(mode, settings) -> bool:
+    """Whether pages of a book can be converted apart from each other. Modes
+    which sample the book first convert it whole"""
+    return (mode is None and len(settings.targets) == 0
+            and not settings.target_size and not settings.min_savings)
+
+
+class WorkQueue:
+    """Books to repack, in a SQLite database on storage shared by every node.
+    Large books are split into chunks of pages, which nodes claim with a
+    lease, so work held by a node which died is eventually taken over.
+    Converted pages go in a journal next to the database, where the node
+    which finishes the last chunk of a book collects them"""
+    def __init__(self, directory):
+        self.directory = Path(directory).resolve()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.directory / 'queue.sqlite'),
+                                  timeout=60, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+
+    def close(self) -> None:
+        self.db.close()
+
+    @contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock up front, so claims can't race
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def enqueue(self, source, mode, settings) -> int:
+        """Add a book, split into chunks if it's large enough. Returns the
+        number of tasks added"""
+        source = Path(source).resolve()
+        chunk = config.queue_chunk_pages
+        starts = [0]
+        if chunkable(mode, settings) and chunk > 0:
+            try:
+                with ZipFile(source) as archive:
+                    members = index_members(archive, source.suffix == '.epub')
+                    count = len(members['image'])
+            except BadZipFile:
+                raise ValueError(f"'{source}': not a zip file")
+            starts = list(range(0, count, chunk)) or [0]
+        with self.transaction() as db:
+            book = db.execute('INSERT INTO books (source, out_dir, mode, settings, '
+                              'status, submitted) VALUES (?, ?, ?, ?, ?, ?)',
+                              (str(source), os.getcwd(), mode,
+                               dump_settings(settings), 'queued',
+                               time.time())).lastrowid
+            if len(starts) == 1:
+                db.execute('INSERT INTO tasks (book, kind, status) VALUES '
+                           '(?, ?, ?)', (book, 'book', 'pending'))
+            else:
+                # the last chunk is open ended, whatever the count was
+                stops = starts[1:] + [None]
+                db.executemany('INSERT INTO tasks (book, kind, start, stop, status) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               [(book, 'chunk', start, stop, 'pending')
+                                for start, stop in zip(starts, stops)])
+        return len(starts)
+
+    def claim(self):
+        """Lease the next pending task (or one whose lease expired). Returns
+        it, or None"""
+        now = time.time()
+        with self.transaction() as db:
+            task = db.execute("SELECT * FROM tasks WHERE status = 'pending' OR "
+                              "(status = 'leased' AND lease_until < ?) "
+                              "ORDER BY id LIMIT 1", (now,)).fetchone()
+            if task is None:
+                return None
+            db.execute("UPDATE tasks SET status = 'leased', owner = ?, "
+                       "lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                       (self.owner, now + config.queue_lease, task['id']))
+            db.execute("UPDATE books SET status = 'running' WHERE id = ?",
+                       (task['book'],))
+        return dict(task, attempts=task['attempts'] + 1)
+
+    def renew(self, task_id:int) -> None:
+        with self.transaction() as db:
+            db.execute("UPDATE tasks SET lease_until = ? WHERE id = ? AND "
+                       "owner = ? AND status = 'leased'",
+                       (time.time() + config.queue_lease, task_id, self.owner))
+
+    def book(self, book_id:int) -> dict:
+        with self.lock:
+            return dict(self.db.execute('SELECT * FROM books WHERE id = ?',
+                                        (book_id,)).fetchone())
+
+    def complete(self, task:dict, outputs=None):
+        """Mark task done. If it was the last chunk of its book, returns the
+        task to assemble the book, leased to us"""
+        with self.transaction() as db:
+            updated = db.execute("UPDATE tasks SET status = 'done', error = NULL "
+                                 "WHERE id = ? AND owner = ? AND status = 'leased'",
+                                 (task['id'], self.owner)).rowcount
+            if updated == 0: # our lease expired, another node took it over
+                return None
+            if task['kind'] != 'chunk':
+                db.execute("UPDATE books SET status = 'done', outputs = ? "
+                           "WHERE id = ?", (json.dumps(outputs), task['book']))
+                return None
+            left = db.execute("SELECT COUNT(*) FROM tasks WHERE book = ? AND "
+                              "status != 'done'", (task['book'],)).fetchone()[0]
+            if left > 0:
+                return None
+            assemble_id = db.execute("INSERT INTO tasks (book, kind, status, owner, "
+                                     "lease_until, attempts) VALUES "
+                                     "(?, 'assemble', 'leased', ?, ?, 1)",
+                                     (task['book'], self.owner,
+                                      time.time() + config.queue_lease)).lastrowid
+            return dict(db.execute('SELECT * FROM tasks WHERE id = ?',
+                                   (assemble_id,)).fetchone())
+
+    def fail(self, task:dict, error:str) -> None:
+        """Put task back in the queue, or give up on its book after
+        MAX_ATTEMPTS"""
+        with self.transaction() as db:
+            owned = db.execute("SELECT 1 FROM tasks WHERE id = ? AND owner = ? "
+                               "AND status = 'leased'",
+                               (task['id'], self.owner)).fetchone()
+            if owned is None: # taken over, it's up to the new owner now
+                return
+            if task['attempts'] < MAX_ATTEMPTS:
+                db.execute("UPDATE tasks SET status = 'pending', owner = NULL, "
+                           "error = ? WHERE id = ?", (error, task['id']))
+                return
+            db.execute("UPDATE tasks SET status = 'failed', error = ? "
+                       "WHERE id = ?", (error, task['id']))
+            db.execute("UPDATE tasks SET status = 'failed', error = 'book failed' "
+                       "WHERE book = ? AND status = 'pending'", (task['book'],))
+            db.execute("UPDATE books SET status = 'failed', error = ? WHERE id = ?",
+                       (error, task['book']))
+
+    def counts(self) -> dict:
+        """Number of books and tasks by status"""
+        with self.lock:
+            books = dict(self.db.execute('SELECT status, COUNT(*) FROM books '
+                                         'GROUP BY status').fetchall())
+            tasks = dict(self.db.execute('SELECT status, COUNT(*) FROM tasks '
+                                         'GROUP BY status').fetchall())
+        return {'books':books, 'tasks':tasks}
+
+    def failures(self) -> list:
+        """(source, error) of each book given up on"""
+        with self.lock:
+            return [tuple(row) for row in self.db.execute(
+                "SELECT source, error FROM books WHERE status = 'failed'")]
+
+    def run_task(self, task:dict) -> None:
+        """Run a claimed task, and the book's assembly if it was the last
+        chunk. Failures are put back in the queue"""
+        book = self.book(task['book'])
+        # outputs go where the book was queued from
+        settings = load_settings(book['settings']).replace(out_dir=book['out_dir'])
+        name = Path(book['source']).name
+        # keep the lease while we work
+        stop = threading.Event()
+        def renew():
+            while not stop.wait(config.queue_lease / 3):
+                self.renew(task['id'])
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            outputs = self._run(task, book, settings)
+        except Exception as err:
+            mylog(f'queue: task {task["id"]} failed: {err!r}')
+            if config.loglevel >= 0:
+                print(shorten(f'[!] {task["kind"]} of', name, f'failed: {err!r}'))
+            self.fail(task, repr(err))
+            return
+        finally:
+            stop.set()
+            renewer.join()
+        assemble = self.complete(task, outputs)
+        if assemble is not None:
+            self.run_task(assemble)
+
+    def _run(self, task:dict, book:dict, settings):
+        source = book['source']
+        if task['kind'] == 'chunk':
+            span = (task['start'], task['stop'])
+            if config.loglevel >= 0:
+                print(shorten(f'[i] Converting pages {span[0]}-'
+                              f'{"end" if span[1] is None else span[1]} of',
+                              Path(source).name))
+            wrappers.convert_chunk(source, span, settings)
+            return None
+        # whole books, and assembling chunks, whose pages are all in the
+        # journal by now
+        status, new_fps = wrappers.process_archive(source, book['mode'], None,
+                                                   settings)
+        if status == 'aborted':
+            raise wrappers.AbortedRepackError(f"'{source}': couldn't convert pages")
+        return list(new_fps)
+
+    def work(self) -> int:
+        """Run tasks until none are left, including those leased by other
+        nodes. Returns the number run"""
+        done = 0
+        while True:
+            task = self.claim()
+            if task is not None:
+                self.run_task(task)
+                done += 1
+                continue
+            counts = self.counts()['tasks']
+            if counts.get('leased', 0) == 0:
+                return done
+            # others are still working. wait, in case they die or finish a
+            # book we can help with
+            time.sleep(config.queue_poll)
+
+
+def work(directory) -> int:
+    """Work on the queue in directory as one of its nodes"""
+    queue = WorkQueue(directory)
+    # the journal is shared with every node, so any of them can assemble
+    journal.start(queue.directory / 'journal', shared=True)
+    try:
+        # start the pool before the lease renewing threads
+        with warm_pool():
+            return queue.work()
+    finally:
+        journal.active().close()
+        queue.close()
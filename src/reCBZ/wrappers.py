@@ -1,16 +1,16 @@
 import time
-import re
 from pathlib import Path
 
 from PIL import UnidentifiedImageError
 
 import reCBZ
 import reCBZ.config as config
-from reCBZ.archive import ComicArchive
-from reCBZ.util import human_bytes, pct_change, shorten, mylog
-
-actual_stem = ''
-
+from reCBZ import journal
+from reCBZ.archive import (ComicArchive, get_format_class, chapter_numbering,
+                           verify_archive_worker)
+from reCBZ.manifest import settings_key
+from reCBZ.util import (human_bytes, pct_change, shorten, mylog, parse_size,
+                        map_workers)
 
 class AbortedRepackError(IOError):
     """Some files couldn't be converted and are missing from the archive"""
@@ -20,28 +20,35 @@ class AbortedCompareError(IOError):
     """Caught PIL.UnidentifiedImageError in Archive.compute_fmt_sizes"""
 
 
-def pprint_fmt_stats(base:tuple, totals:tuple) -> None:
-    lines = f'┌─ Disk size ({config.samples_count}' + \
+class LowSavingsError(IOError):
+    """Projected savings are below min_savings, the archive was skipped"""
+
+
+def pprint_fmt_stats(base:tuple, totals:tuple, settings) -> None:
+    lines = f'┌─ Disk size ({settings.samples_count}' + \
              ' pages) with present settings:\n'
     # justify to the left and right respectively. effectively the same
     # as using f'{part1: <25} | {part2: >8}\n'
     part1 = f'│   {base[1]}'.ljust(37)
     part2 = f'{human_bytes(base[0])}'.rjust(8)
-    lines += f'{part1} {part2} |  0.00%\n'
+    lines += f'{part1} {part2} |   0.00%\n'
     for i, total in enumerate(totals):
         if i == len(totals)-1:
             prefix = '└─'
         else:
             prefix = '├─'
-        change = pct_change(base[0], total[0])
+        change = pct_change(base[0], total[0]).rjust(8)
         part1 = f'{prefix}{i+1} {total[1]}'.ljust(37)
         part2 = f'{human_bytes(total[0])}'.rjust(8)
-        lines += f'{part1} {part2} | {change}\n'
+        lines += f'{part1} {part2} | {change}'
+        if total[3] is not None:
+            lines += f' | {settings.quality_metric.upper()} {total[3]:.4f}'
+        lines += '\n'
     mylog('', progress=True)
     print(lines[0:-1]) # strip last newline
 
 
-def pprint_repack_stats(source:dict, new:dict, start_t:float) -> None:
+def pprint_repack_stats(source:dict, new:dict, start_t:float, settings) -> None:
     end_t = time.perf_counter()
     elapsed = f'{end_t - start_t:.2f}s'
     max_width = config.term_width()
@@ -57,26 +64,50 @@ def pprint_repack_stats(source:dict, new:dict, start_t:float) -> None:
         verb = 'decrease'
     change = pct_change(source_size, new_size)
     line1 = f"┌─ {op}: '{name}' completed in {elapsed}\n"
+    skipped = new.get('skipped', 0)
+    if skipped > 0:
+        line1 += f"├─ kept {skipped} source pages (no savings when converted)\n"
+    dupes = new.get('dupes', 0)
+    if dupes > 0:
+        if settings.drop_dupes and new['type'] in ('cbz', 'zip'):
+            line1 += f"├─ dropped {dupes} duplicate pages\n"
+        else:
+            line1 += f"├─ converted {dupes} duplicate pages once\n"
+    if 'predicted' in new:
+        line1 += f"├─ Target: {human_bytes(new['target'])} ■ Predicted: " + \
+                 f"{human_bytes(new['predicted'])} ({new['fit']})\n"
     line2 = f"└───■■ Source: {human_bytes(source_size)} ■ New: " +\
             f"{human_bytes(new_size)} ■ {change} {verb} ■■"
-    length = len(line1) if len(line1) > len(line2) else len(line2)
+    length = max(len(line) for line in line1.split('\n') + [line2])
     splitter = ''.rjust(length, '-')
     lines = line1 + line2 + '\n' + splitter
     mylog('', progress=True)
     if config.loglevel >= 0: print(lines)
 
 
-def save(book):
-    global actual_stem
+def verify_archives(paths:list) -> dict:
+    """Check every archive in paths for corruption, in parallel, without
+    converting anything. Prints and returns what's wrong with the broken
+    ones, as path: [(member, problem)]"""
+    results = map_workers(verify_archive_worker, paths, progress='Verifying')
+    mylog('', progress=True)
+    broken = {path:problems for path, problems in zip(paths, results)
+              if isinstance(problems, list) and len(problems) > 0}
+    for path, problems in broken.items():
+        for member, problem in problems:
+            print(shorten(f'[!] {Path(path).name}:',
+                          f'{member}:' if member else '', problem))
+    if config.loglevel >= 0:
+        print(f'[i] Verified {len(paths)} files, {len(broken)} broken')
+    return broken
+
+
+def check_bad_files(book) -> None:
+    """Raise AbortedRepackError if pages couldn't be converted, unless
+    force_write is set"""
     bad_files = book.bad_files
     if len(bad_files) > 0:
-        if re.compile('\\.epub$').match(book.fp.suffix):
-            old_len = len(bad_files)
-            bad_files = [f for f in bad_files if not reCBZ.EPUB_FILES.match(str(f))]
-            filtered = old_len - len(bad_files)
-            if config.loglevel >= 0:
-                print(f'[i] EPUB: filtered {filtered} files')
-        if not config.force_write and len(bad_files) > 0:
+        if not book.settings.force_write:
             print(f'{book.fp.name}:')
             [print(f'error: {file.name}') for file in bad_files]
             print(f"[!] {len(bad_files)} files couldn't be converted")
@@ -84,99 +115,273 @@ def save(book):
             print(''.rjust(config.term_width(), '^'))
             raise AbortedRepackError
 
-    # fix suffix when source has two suffixes (kobo epub)
+
+def save(book, suffix:str='', cleanup:bool=True):
+    """Write book with its settings
+    Returns path to the new archive"""
+    settings = book.settings
     try:
-        actual_stem = reCBZ.KEPUB_EPUB.match(book.fp.name).group(0)
-        # suffix = '.kepub.epub'
-    except AttributeError:
-        actual_stem = book.fp.stem
-        # suffix = book.fp.suffix
-    if not config.no_write:
-        if config.overwrite:
-            name = str(Path.joinpath(book.fp.parents[0], actual_stem))
-            book.fp.unlink()
-        # elif savedir TODO
+        check_bad_files(book)
+
+        # fix suffix when source has two suffixes (kobo epub)
+        try:
+            actual_stem = reCBZ.KEPUB_EPUB.match(book.fp.name).group(0)
+            # suffix = '.kepub.epub'
+        except AttributeError:
+            actual_stem = book.fp.stem
+            # suffix = book.fp.suffix
+        if not settings.no_write:
+            if settings.overwrite:
+                name = str(Path.joinpath(book.fp.parents[0], actual_stem))
+                book.fp.unlink()
+            # elif savedir TODO
+            else:
+                out_dir = Path(settings.out_dir) if settings.out_dir else Path.cwd()
+                name = str(Path.joinpath(out_dir, f'{actual_stem} [reCBZ]{suffix}'))
+            new_fp = Path(book.write_archive(settings.archive_format, file_name=name))
         else:
-            name = str(Path.joinpath(Path.cwd(), f'{actual_stem} [reCBZ]'))
-        new_fp = Path(book.write_archive(config.archive_format, file_name=name))
-    else:
-        new_fp = book.fp
-    book.cleanup()
+            new_fp = book.fp
+    finally: # aborted or not, free the cache and its claim
+        if cleanup:
+            book.cleanup()
     return str(new_fp)
 
 
-def compare_fmts_archive(fp:str, quiet=False) -> tuple:
+def compare_fmts_archive(fp:str, quiet=False, settings=None) -> tuple:
     """Run a sample with each image format, return the results"""
+    book = ComicArchive(fp, settings)
     try:
-        results = ComicArchive(fp).compute_fmt_sizes()
+        results = book.compute_fmt_sizes()
     except UnidentifiedImageError as err:
         print("[!] Can't calculate size: PIL.UnidentifiedImageError. Aborting")
         raise AbortedCompareError
     if not quiet:
-        pprint_fmt_stats(results[0], results[1:])
+        pprint_fmt_stats(results[0], results[1:], book.settings)
     return results
 
 
-def unpack_archive(fp:str) -> None:
+def unpack_archive(fp:str, settings=None) -> None:
     # not implemented yet
     """Unpack the archive, converting all images within
     Returns path to repacked archive"""
     if config.loglevel >= 0: print(shorten('[i] Unpacking', fp))
-    unpacked = ComicArchive(fp).extract()
+    unpacked = ComicArchive(fp, settings).extract()
     for file in unpacked:
         print(file)
     exit(1)
 
 
-def repack_archive(fp:str) -> str:
-    """Repack the archive, converting all images within
+def fit_archive(fp:str, fmt_names:tuple, settings) -> dict:
+    """Search for the quality (and scale) which fits the archive in
+    settings.target_size, by converting a sample of its pages with each format
+    Returns the selected settings and predicted size"""
+    book = ComicArchive(fp, settings)
+    book_bytes = book.book_size()
+    target = parse_size(settings.target_size, book_bytes)
+    fmts = tuple(get_format_class(name) for name in fmt_names)
+    try:
+        fit = book.fit_target_size(target, fmts)
+    finally:
+        book.cleanup()
+    fit['target'] = target
+    fit['book_size'] = book_bytes
+    fmt_name = fit['format'] if fit['format'] is not None else 'source format'
+    fit['desc'] = f"{fmt_name} @ quality {fit['quality']}"
+    if fit['scale'] != 1.0:
+        fit['desc'] += f", scale {fit['scale']:.2f}"
+    if config.loglevel >= 0:
+        print(f"[i] Fit {human_bytes(target)}: {fit['desc']}")
+        if not fit['fits']:
+            print(f"[!] Predicted {human_bytes(fit['predicted'])}, can't " +
+                  "fit with target_min_quality and target_min_scale")
+    return fit
+
+
+def check_savings(fp:str, settings, savings:float=None) -> None:
+    """Raise LowSavingsError if converting the archive is projected to save
+    less than settings.min_savings. If savings isn't known, it's estimated by
+    converting a sample of pages"""
+    if savings is None:
+        book = ComicArchive(fp, settings)
+        try:
+            book_bytes, predicted = book.predict_size()
+        except ValueError: # fewer pages than samples, can't tell
+            return
+        finally:
+            book.cleanup()
+        savings = 1 - predicted / book_bytes
+    if savings < settings.min_savings:
+        if config.loglevel >= 0:
+            print(shorten(f'[i] Skipping: projected savings {savings*100:.1f}%',
+                          f'< {settings.min_savings*100:.1f}%:', fp))
+        raise LowSavingsError
+
+
+def repack_archive(fp:str, fmt_names:tuple=None, savings:float=None,
+                   settings=None) -> str:
+    """Repack the archive, converting all images within. If target_size is
+    set, search fmt_names (defaults to img_format) for the settings to use.
+    If min_savings is set, savings (or a sample) decides whether to proceed
     Returns path to repacked archive"""
     if config.loglevel >= 0: print(shorten('[i] Repacking', fp))
+    if settings is None:
+        settings = config.current()
     source_fp = Path(fp)
     start_t = time.perf_counter()
-    book = ComicArchive(str(source_fp))
-    book.extract()
+    fit = None
+    if settings.target_size:
+        if fmt_names is None:
+            fmt_names = (settings.img_format,)
+        fit = fit_archive(fp, fmt_names, settings)
+        savings = 1 - fit['predicted'] / fit['book_size']
+    if settings.min_savings > 0:
+        check_savings(fp, settings, savings)
+    book = ComicArchive(str(source_fp), settings)
     source_stats = {'name':source_fp.stem,
                     'size':source_fp.stat().st_size,
                     'type':source_fp.suffix[1:]}
-    book.convert_pages() # page attributes are inherited from Config at init
-    new_fp = Path(save(book))
+    try:
+        book.extract()
+        if fit is not None:
+            book.convert_pages(fmt=fit['format'], quality=fit['quality'],
+                               scale=fit['scale'], adaptive=(0, 0))
+        else:
+            book.convert_pages() # page attributes are inherited from settings at init
+        new_fp = Path(save(book, cleanup=False))
+    finally:
+        book.cleanup()
     new_stats = {'name':new_fp.name,
                  'size':new_fp.stat().st_size,
-                 'type':new_fp.suffix[1:]}
-    pprint_repack_stats(source_stats, new_stats, start_t)
+                 'type':new_fp.suffix[1:],
+                 'skipped':len(book.skipped_files),
+                 'dupes':len(book.dupe_files)}
+    if fit is not None:
+        new_stats['target'] = fit['target']
+        new_stats['predicted'] = fit['predicted']
+        new_stats['fit'] = fit['desc']
+    pprint_repack_stats(source_stats, new_stats, start_t, settings)
     return str(new_fp)
 
 
-def join_archives(main_path:str, paths:list) -> str:
+def fanout_archive(fp:str, settings=None) -> tuple:
+    """Repack the archive once for each of settings.targets, decoding each
+    page only once
+    Returns paths to repacked archives"""
+    if config.loglevel >= 0: print(shorten('[i] Repacking', fp))
+    source_fp = Path(fp)
+    start_t = time.perf_counter()
+    book = ComicArchive(str(source_fp), settings)
+    targets = book.settings.targets
+    book.extract()
+    source_stats = {'name':source_fp.stem,
+                    'size':source_fp.stat().st_size,
+                    'type':source_fp.suffix[1:]}
+    new_fps = []
+    try:
+        target_books = book.convert_targets(targets)
+        for target_book in target_books:
+            profile = target_book.settings.ebook_profile
+            if profile is not None:
+                suffix = f' [{profile.nickname}]'
+            else:
+                suffix = ''
+            new_fp = Path(save(target_book, suffix, cleanup=False))
+            new_stats = {'name':new_fp.name,
+                         'size':new_fp.stat().st_size,
+                         'type':new_fp.suffix[1:],
+                         'skipped':len(target_book.skipped_files),
+                         'dupes':len(target_book.dupe_files)}
+            pprint_repack_stats(source_stats, new_stats, start_t,
+                                target_book.settings)
+            new_fps.append(str(new_fp))
+    finally:
+        book.cleanup()
+    return tuple(new_fps)
+
+
+def convert_chunk(fp:str, span:tuple, settings=None) -> int:
+    """Convert a (start, stop) slice of the archive's pages into the journal,
+    for whichever node assembles the book, see workqueue. Returns the number
+    of pages converted"""
+    if settings is None:
+        settings = config.current()
+    book = ComicArchive(fp, settings)
+    try:
+        return len(book.convert_pages(span=span))
+    finally:
+        book.cleanup()
+
+
+def join_archives(main_path:str, paths:list, settings=None) -> str:
     """Concatenates the contents of paths to main_path and repacks
     Returns path to concatenated archive"""
     if config.loglevel >= 0: print(shorten('[i] Repacking', main_path))
     source_fp = Path(main_path)
     start_t = time.perf_counter()
-    main_book = ComicArchive(main_path)
+    main_book = ComicArchive(main_path, settings)
     sum_size = sum(Path(file).stat().st_size for file in paths)
     source_stats = {'name':source_fp.stem,
                     'size':sum_size,
                     'type':source_fp.suffix[1:]}
     for file in paths:
-        book = ComicArchive(file)
+        book = ComicArchive(file, main_book.settings)
         main_book.add_chapter(book)
-    main_book.convert_pages()
-    new_fp = Path(save(main_book))
+    try:
+        main_book.convert_pages()
+        new_fp = Path(save(main_book, cleanup=False))
+    finally:
+        main_book.cleanup()
     new_stats = {'name':new_fp.name,
                  'size':new_fp.stat().st_size,
-                 'type':new_fp.suffix[1:]}
-    pprint_repack_stats(source_stats, new_stats, start_t)
-    main_book.cleanup()
+                 'type':new_fp.suffix[1:],
+                 'skipped':len(main_book.skipped_files),
+                 'dupes':len(main_book.dupe_files)}
+    pprint_repack_stats(source_stats, new_stats, start_t, main_book.settings)
+    if journal.active() is not None:
+        journal.active().forget_pages(main_path)
     return str(new_fp)
 
 
-def assist_repack_archive(fp:str) -> str:
+def append_archives(main_path:str, paths:list, settings=None) -> str:
+    """Converts the contents of paths and adds them to main_path, a volume
+    previously created with join_archives, as new chapters. Pages already in
+    main_path aren't touched
+    Returns path to the volume"""
+    if config.loglevel >= 0: print(shorten('[i] Appending to', main_path))
+    main_fp = Path(main_path)
+    start_t = time.perf_counter()
+    chapter_numbering(main_path) # fail early if it's not a volume
+    source_stats = {'name':main_fp.stem,
+                    'size':main_fp.stat().st_size,
+                    'type':main_fp.suffix[1:]}
+    book = ComicArchive(paths[0], settings)
+    for file in paths[1:]:
+        book.add_chapter(ComicArchive(file, book.settings))
+    try:
+        book.convert_pages()
+        check_bad_files(book)
+        if not book.settings.no_write:
+            book.append_to(str(main_fp))
+    finally:
+        book.cleanup()
+    if journal.active() is not None:
+        journal.active().forget_pages(paths[0])
+    new_stats = {'name':main_fp.name,
+                 'size':main_fp.stat().st_size,
+                 'type':main_fp.suffix[1:],
+                 'skipped':len(book.skipped_files),
+                 'dupes':len(book.dupe_files)}
+    pprint_repack_stats(source_stats, new_stats, start_t, book.settings)
+    return str(main_fp)
+
+
+def assist_repack_archive(fp:str, settings=None) -> str:
     """Run a sample with each image format, then ask which to repack
     the rest of the archive with
     Returns path to repacked archive"""
-    results = compare_fmts_archive(fp)
+    if settings is None:
+        settings = config.current()
+    results = compare_fmts_archive(fp, settings=settings)
     options_dic = {i : total[2] for i, total in enumerate(results[1:])}
     metavar = f'[1-{len(options_dic)}]'
     while True:
@@ -190,17 +395,78 @@ def assist_repack_archive(fp:str) -> str:
         except KeyboardInterrupt:
             print('[!] Aborting')
             exit(1)
-    config.img_format = selection
-    return repack_archive(fp)
+    return repack_archive(fp, settings=settings.replace(img_format=selection))
 
 
-def auto_repack_archive(fp:str) -> str:
+def auto_repack_archive(fp:str, settings=None) -> str:
     """Run a sample with each image format, then automatically pick
     the smallest format to repack the rest of the archive with
     Returns path to repacked archive"""
-    results = compare_fmts_archive(fp, quiet=True)
-    selection = {"desc":results[1][1], "name":results[1][2]}
+    if settings is None:
+        settings = config.current()
+    if settings.target_size:
+        # the search already samples each format, and picks the best fit
+        fmt_names = tuple(fmt.name for fmt in settings.allowed_page_formats())
+        return repack_archive(fp, fmt_names, settings=settings)
+    results = compare_fmts_archive(fp, quiet=True, settings=settings)
+    # smallest format which meets the quality floor. if none do, the one
+    # closest to it
+    passing = [total for total in results[1:]
+               if total[3] is None or total[3] >= settings.quality_floor]
+    if len(passing) > 0:
+        best = passing[0]
+    else:
+        best = max(results[1:], key=lambda total: total[3])
+    selection = {"desc":best[1], "name":best[2]}
     fmt_name = selection['name']
     fmt_desc = selection['desc']
-    config.img_format = fmt_name
-    return repack_archive(fp)
+    savings = 1 - best[0] / results[0][0]
+    return repack_archive(fp, savings=savings,
+                          settings=settings.replace(img_format=fmt_name))
+
+
+def process_archive(fp:str, mode=None, records=None, settings=None) -> tuple:
+    """Run mode on the archive and record the result in records (a
+    Manifest), if any. Returns 'skipped', 'aborted' or 'done', and the paths
+    written"""
+    if settings is None:
+        settings = config.current()
+    start_t = time.perf_counter()
+    records_key = settings_key(mode, settings)
+    work = journal.active()
+    if work is not None and mode in (None, 'auto') and not settings.no_write:
+        new_fps = work.finished(fp, records_key)
+        if new_fps is not None:
+            if config.loglevel >= 0:
+                print(shorten('[i] Finished by a previous run:', fp))
+            return 'done', new_fps
+    new_fps = None
+    try:
+        if mode is None and len(settings.targets) > 0:
+            new_fps = fanout_archive(fp, settings)
+        elif mode is None:
+            new_fps = (repack_archive(fp, settings=settings),)
+        elif mode == 'unpack':
+            unpack_archive(fp, settings)
+        elif mode == 'compare':
+            compare_fmts_archive(fp, settings=settings)
+        elif mode == 'assist':
+            new_fps = (assist_repack_archive(fp, settings),)
+        elif mode == 'auto':
+            new_fps = (auto_repack_archive(fp, settings),)
+    except LowSavingsError:
+        if work is not None:
+            work.forget_pages(fp)
+        return 'skipped', ()
+    except (AbortedRepackError, AbortedCompareError):
+        return 'aborted', () # pages are kept, for the next run
+    if settings.no_write or not new_fps:
+        if work is not None:
+            work.forget_pages(fp)
+        return 'done', ()
+    if work is not None:
+        work.finish_book(fp, records_key, new_fps)
+    if records is not None:
+        records.record(fp, new_fps, records_key,
+                       time.perf_counter() - start_t)
+    return 'done', new_fps
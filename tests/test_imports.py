@@ -0,0 +1,27 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import reCBZ
+
+# only imported once there's work for them
+HEAVY = ('PIL', 'numpy', 'sqlite3')
+
+
+def imported_after(module:str) -> set:
+    code = (f'import json, sys; import {module}; '
+            f'print(json.dumps(sorted(sys.modules)))')
+    # a fresh interpreter, this one has imported everything already
+    env = dict(os.environ, PYTHONPATH=str(Path(reCBZ.__file__).parents[1]))
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                            text=True, check=True, env=env)
+    return {name.split('.')[0] for name in json.loads(result.stdout)}
+
+
+@pytest.mark.parametrize('module', ['reCBZ', 'reCBZ.__main__'])
+def test_no_heavy_imports(module):
+    assert imported_after(module).isdisjoint(HEAVY)
@@ -0,0 +1,126 @@
+import http.client
+import json
+import threading
+import time
+from io import BytesIO
+from zipfile import ZipFile
+
+import pytest
+from PIL import Image
+
+import reCBZ
+import reCBZ.config as config
+from reCBZ import server
+
+
+@pytest.fixture
+def book(tmp_path):
+    path = tmp_path / 'book.cbz'
+    with ZipFile(path, 'w') as archive:
+        for i in range(3):
+            data = BytesIO()
+            Image.new('L', (64, 96), i * 80).save(data, 'PNG')
+            archive.writestr(f'p{i:03d}.png', data.getvalue())
+    return path
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    # outputs are written to the current dir
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(reCBZ, 'GLOBAL_CACHEDIR',
+                        tmp_path / f'{reCBZ.CACHE_PREFIX}test')
+    monkeypatch.setattr(config, 'loglevel', -1)
+    monkeypatch.setattr(config, 'manifest', False)
+    monkeypatch.setattr(config, 'processes', 1)
+    jobs = server.JobQueue(config.current())
+    httpd = server.make_server('127.0.0.1', 0, jobs)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    runner = threading.Thread(target=jobs.run, daemon=True)
+    runner.start()
+    yield httpd
+    jobs.stop()
+    runner.join()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def request(httpd, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection(*httpd.server_address[:2], timeout=30)
+    try:
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def post_job(httpd, path, options=None):
+    body = json.dumps({'path':str(path), 'options':options or {}})
+    return request(httpd, 'POST', '/jobs', body,
+                   {'Content-Type':'application/json'})
+
+
+def test_status(api):
+    status, body = request(api, 'GET', '/')
+    assert status == 200
+    assert json.loads(body)['queued'] == 0
+
+
+@pytest.mark.parametrize('headers', [
+    {'Host':'attacker.example'},
+    {'Host':'attacker.example:8250'},
+    {'Origin':'http://attacker.example'},
+    {'Origin':'null'},
+])
+def test_refuses_foreign_host_or_origin(api, book, headers):
+    assert request(api, 'GET', '/jobs', headers=headers)[0] == 403
+    body = json.dumps({'path':str(book)})
+    headers = {'Content-Type':'application/json', **headers}
+    assert request(api, 'POST', '/jobs', body, headers)[0] == 403
+    assert json.loads(request(api, 'GET', '/jobs')[1]) == []
+
+
+def test_accepts_localhost(api):
+    port = api.server_address[1]
+    headers = {'Host':f'localhost:{port}', 'Origin':f'http://localhost:{port}'}
+    assert request(api, 'GET', '/', headers=headers)[0] == 200
+
+
+@pytest.mark.parametrize('content_type', [None, 'text/plain',
+                                          'application/x-www-form-urlencoded'])
+def test_requires_json_content_type(api, book, content_type):
+    headers = {} if content_type is None else {'Content-Type':content_type}
+    body = json.dumps({'path':str(book)})
+    assert request(api, 'POST', '/jobs', body, headers)[0] == 415
+
+
+@pytest.mark.parametrize('options', [{'overwrite':True}, {'force_write':True},
+                                     {'nonsense':1}, {'img_quality':'high'},
+                                     {'mode':'join'}])
+def test_refuses_invalid_options(api, book, options):
+    assert post_job(api, book, options)[0] == 400
+
+
+def test_refuses_missing_file(api, tmp_path):
+    assert post_job(api, tmp_path / 'missing.cbz')[0] == 400
+
+
+def test_job_runs_and_output_downloads(api, book):
+    status, body = post_job(api, book, {'img_format':'jpeg'})
+    assert status == 202
+    job_id = json.loads(body)['id']
+    deadline = time.monotonic() + 60
+    while True:
+        job = json.loads(request(api, 'GET', f'/jobs/{job_id}')[1])
+        if job['status'] not in ('queued', 'running'):
+            break
+        assert time.monotonic() < deadline, 'job never finished'
+        time.sleep(0.1)
+    assert job['status'] == 'done', job['error']
+    assert book.exists()
+    status, data = request(api, 'GET', f'/jobs/{job_id}/outputs/0')
+    assert status == 200
+    with ZipFile(BytesIO(data)) as archive:
+        assert len(archive.namelist()) == 3
+    assert request(api, 'GET', f'/jobs/{job_id}/outputs/1')[0] == 404
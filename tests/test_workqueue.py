@@ -0,0 +1,219 @@
+import os
+import subprocess
+import sys
+from io import BytesIO
+from pathlib import Path
+from zipfile import ZipFile
+
+import pytest
+from PIL import Image
+
+import reCBZ
+import reCBZ.config as config
+from reCBZ import journal, workqueue
+
+
+def make_book(path, pages:int, shade:int=0):
+    with ZipFile(path, 'w') as archive:
+        for i in range(pages):
+            data = BytesIO()
+            Image.new('L', (64, 96), shade + i * 20).save(data, 'PNG')
+            archive.writestr(f'p{i:03d}.png', data.getvalue())
+    return path
+
+
+def page_count(path) -> int:
+    with ZipFile(path) as archive:
+        return len([name for name in archive.namelist() if not name.endswith('/')])
+
+
+@pytest.fixture
+def queue_dir(tmp_path, monkeypatch):
+    # books are repacked to the dir they were queued from
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(reCBZ, 'GLOBAL_CACHEDIR',
+                        tmp_path / f'{reCBZ.CACHE_PREFIX}test')
+    monkeypatch.setattr(config, 'loglevel', -1)
+    monkeypatch.setattr(config, 'manifest', False)
+    monkeypatch.setattr(config, 'processes', 1)
+    monkeypatch.setattr(config, 'queue_chunk_pages', 4)
+    monkeypatch.setattr(config, 'queue_poll', 0.1)
+    # workqueue.work starts one
+    monkeypatch.setattr(journal, '_journal', None)
+    return tmp_path / 'queue'
+
+
+@pytest.fixture
+def queue(queue_dir):
+    queue = workqueue.WorkQueue(queue_dir)
+    yield queue
+    queue.close()
+
+
+def other_node(queue_dir):
+    node = workqueue.WorkQueue(queue_dir)
+    node.owner = 'other:1'
+    return node
+
+
+def expire_leases(queue):
+    queue.db.execute("UPDATE tasks SET lease_until = 0 WHERE status = 'leased'")
+
+
+def task_row(queue, task_id:int) -> dict:
+    return dict(queue.db.execute('SELECT * FROM tasks WHERE id = ?',
+                                 (task_id,)).fetchone())
+
+
+def test_enqueue_splits_large_books(queue, tmp_path):
+    settings = config.current()
+    assert queue.enqueue(make_book(tmp_path / 'big.cbz', 10), None, settings) == 3
+    assert queue.enqueue(make_book(tmp_path / 'small.cbz', 3), None, settings) == 1
+    # sampling modes need the whole book
+    assert queue.enqueue(tmp_path / 'big.cbz', 'auto', settings) == 1
+    tasks = [(row['book'], row['kind'], row['start'], row['stop'])
+             for row in queue.db.execute('SELECT * FROM tasks ORDER BY id')]
+    assert tasks == [(1, 'chunk', 0, 4), (1, 'chunk', 4, 8), (1, 'chunk', 8, None),
+                     (2, 'book', None, None), (3, 'book', None, None)]
+
+
+def test_enqueue_refuses_non_zip(queue, tmp_path):
+    (tmp_path / 'bad.cbz').write_bytes(b'not a zip')
+    with pytest.raises(ValueError):
+        queue.enqueue(tmp_path / 'bad.cbz', None, config.current())
+
+
+def test_last_chunk_leads_to_assembly(queue, tmp_path):
+    queue.enqueue(make_book(tmp_path / 'big.cbz', 10), None, config.current())
+    chunks = [queue.claim() for i in range(3)]
+    assert [task['start'] for task in chunks] == [0, 4, 8]
+    assert queue.claim() is None
+    # out of order, assembly waits for every chunk regardless
+    assert queue.complete(chunks[2]) is None
+    assert queue.complete(chunks[0]) is None
+    assemble = queue.complete(chunks[1])
+    assert assemble['kind'] == 'assemble'
+    assert assemble['owner'] == queue.owner and assemble['status'] == 'leased'
+    assert queue.claim() is None # already ours
+    assert queue.complete(assemble, ['out.cbz']) is None
+    assert queue.book(1)['status'] == 'done'
+    assert queue.book(1)['outputs'] == '["out.cbz"]'
+
+
+def test_claim_is_exclusive(queue, queue_dir, tmp_path):
+    queue.enqueue(make_book(tmp_path / 'small.cbz', 3), None, config.current())
+    other = other_node(queue_dir)
+    try:
+        task = queue.claim()
+        assert task is not None and task['attempts'] == 1
+        assert other.claim() is None
+        # not other's to finish
+        assert other.complete(task) is None
+        assert task_row(queue, task['id'])['status'] == 'leased'
+        assert queue.book(1)['status'] == 'running'
+    finally:
+        other.close()
+
+
+def test_expired_lease_is_reclaimed(queue, queue_dir, tmp_path):
+    queue.enqueue(make_book(tmp_path / 'small.cbz', 3), None, config.current())
+    other = other_node(queue_dir)
+    try:
+        task = queue.claim()
+        expire_leases(queue)
+        # renewing in time keeps it
+        queue.renew(task['id'])
+        assert other.claim() is None
+        expire_leases(queue)
+        taken = other.claim()
+        assert taken['id'] == task['id'] and taken['attempts'] == 2
+        # the old owner can't renew, finish or fail it anymore
+        lease = task_row(queue, task['id'])['lease_until']
+        queue.renew(task['id'])
+        assert task_row(queue, task['id'])['lease_until'] == lease
+        assert queue.complete(task) is None
+        queue.fail(task, 'too late')
+        row = task_row(queue, task['id'])
+        assert (row['owner'], row['status'], row['error']) == ('other:1', 'leased', None)
+        assert other.complete(taken, []) is None
+        assert queue.book(1)['status'] == 'done'
+    finally:
+        other.close()
+
+
+def test_fail_retries_then_gives_up(queue, tmp_path):
+    queue.enqueue(make_book(tmp_path / 'big.cbz', 10), None, config.current())
+    for attempt in range(1, workqueue.MAX_ATTEMPTS):
+        task = queue.claim()
+        assert task['id'] == 1 and task['attempts'] == attempt
+        queue.fail(task, f'error {attempt}')
+        row = task_row(queue, 1)
+        assert (row['status'], row['owner'], row['error']) == ('pending', None, f'error {attempt}')
+    queue.fail(queue.claim(), 'for good')
+    statuses = [(row['status'], row['error']) for row in
+                queue.db.execute('SELECT * FROM tasks ORDER BY id')]
+    assert statuses == [('failed', 'for good'), ('failed', 'book failed'),
+                        ('failed', 'book failed')]
+    assert queue.failures() == [(str(tmp_path / 'big.cbz'), 'for good')]
+    assert queue.claim() is None
+
+
+def test_work_repacks_every_book(queue_dir, tmp_path):
+    queue = workqueue.WorkQueue(queue_dir)
+    try:
+        settings = config.current()
+        queue.enqueue(make_book(tmp_path / 'big.cbz', 10), None, settings)
+        queue.enqueue(make_book(tmp_path / 'small.cbz', 3), None, settings)
+    finally:
+        queue.close()
+    # 3 chunks and a book. assembly runs along with the last chunk
+    assert workqueue.work(queue_dir) == 4
+    queue = workqueue.WorkQueue(queue_dir)
+    try:
+        assert queue.counts() == {'books':{'done':2}, 'tasks':{'done':5}}
+        assert queue.failures() == []
+    finally:
+        queue.close()
+    assert page_count(tmp_path / 'big [reCBZ].cbz') == 10
+    assert page_count(tmp_path / 'small [reCBZ].cbz') == 3
+
+
+NODE = """
+import sys
+from pathlib import Path
+import reCBZ
+import reCBZ.config as config
+reCBZ.GLOBAL_CACHEDIR = Path(sys.argv[2])
+config.loglevel = -1
+config.processes = 1
+config.queue_poll = 0.1
+from reCBZ import workqueue
+print(workqueue.work(sys.argv[1]))
+"""
+
+
+def test_nodes_share_the_queue(queue_dir, tmp_path):
+    queue = workqueue.WorkQueue(queue_dir)
+    try:
+        # distinct, the journal knows identical books by their contents
+        for i, name in enumerate(('a', 'b', 'c')):
+            queue.enqueue(make_book(tmp_path / f'{name}.cbz', 10, i), None,
+                          config.current())
+    finally:
+        queue.close()
+    env = dict(os.environ, PYTHONPATH=str(Path(reCBZ.__file__).parents[1]))
+    nodes = [subprocess.Popen([sys.executable, '-c', NODE, str(queue_dir),
+                               str(tmp_path / f'{reCBZ.CACHE_PREFIX}node{i}')],
+                              stdout=subprocess.PIPE, text=True,
+                              env=env)
+             for i in range(3)]
+    ran = [int(node.communicate(timeout=120)[0].split()[-1]) for node in nodes]
+    assert [node.returncode for node in nodes] == [0, 0, 0]
+    assert sum(ran) == 9 # every chunk ran exactly once
+    queue = workqueue.WorkQueue(queue_dir)
+    try:
+        assert queue.counts() == {'books':{'done':3}, 'tasks':{'done':12}}
+    finally:
+        queue.close()
+    for name in ('a', 'b', 'c'):
+        assert page_count(tmp_path / f'{name} [reCBZ].cbz') == 10